@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""Benchmarks for the stages of the relatednessFinder commands. Each stage is
+timed at several cohort sizes against a synthetic database and the results
+are written to a json file that can be compared against an earlier run to
+find regressions"""
+
+import json
+import logging
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "relatednessFinder"))
+
+import database  # noqa: E402
+import utilities  # noqa: E402
+from synthetic_database import create_database, write_grid_file  # noqa: E402
+
+app = typer.Typer(add_completion=False)
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+
+DEFAULT_COHORT_SIZES = "1000,10000,50000"
+
+# the logger is kept at the warning level so that logging doesn't add to the
+# measured times
+logger = logging.getLogger("benchmarks")
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def time_stage(
+    stage: str,
+    cohort_size: int,
+    function: Callable[[], int],
+    repeats: int,
+) -> dict[str, Any]:
+    """Function that runs a stage several times and records how long it took.
+    The stage is then run once more while tracing the memory that python
+    allocates because tracing slows down the stage too much to time it
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage
+
+    cohort_size : int
+        number of individuals in the grid file for this run
+
+    function : Callable[[], int]
+        function that runs the stage and returns the number of rows that it
+        processed
+
+    repeats : int
+        number of times to run the stage. The best time is used for the
+        throughput because it is the least affected by other processes
+
+    Returns
+    -------
+    dict[str, Any]
+        returns the measurements for the stage
+    """
+    seconds = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = function()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(seconds)
+
+    result = {
+        "stage": stage,
+        "cohort_size": cohort_size,
+        "rows": rows,
+        "seconds": seconds,
+        "best_seconds": best,
+        "median_seconds": statistics.median(seconds),
+        "rows_per_second": rows / best if best > 0 else None,
+        "peak_python_memory_bytes": peak_memory,
+    }
+
+    print(
+        f"{stage:<32} {cohort_size:>9} {rows:>12} rows {best:>10.4f}s {peak_memory / 2**20:>10.1f} MiB"
+    )
+
+    return result
+
+
+def benchmark_cohort(
+    db_obj: database.dbResults,
+    grid_file: Path,
+    output_dir: Path,
+    cohort_size: int,
+    repeats: int,
+) -> list[dict[str, Any]]:
+    """Function that times each stage for one cohort. The stages are timed
+    separately so a slowdown can be traced to reading the grid file, the
+    query, writing the output, or counting the distributions"""
+
+    def read_grids() -> int:
+        with utilities.FileReader(grid_file) as file_reader:
+            cases, controls = file_reader.read_in_grids(
+                logger=logger, cases_and_control=True
+            )
+        return len(cases) + len(controls)
+
+    with utilities.FileReader(grid_file) as file_reader:
+        cases, controls = file_reader.read_in_grids(
+            logger=logger, cases_and_control=True
+        )
+
+    grid_list = cases + controls
+
+    def query(all_connections: bool) -> Callable[[], int]:
+        def run() -> int:
+            return sum(
+                len(batch)
+                for batch in database.get_relatedness(
+                    grid_list, db_obj, logger=logger, all_connections=all_connections
+                )
+            )
+
+        return run
+
+    # the results are collected once so that writing them can be timed
+    # without the query
+    results = list(
+        database.get_relatedness(grid_list, db_obj, logger=logger, all_connections=True)
+    )
+
+    def write() -> int:
+        return utilities.write_to_file(iter(results), output_dir / "pairs.txt")
+
+    def gather_distributions() -> int:
+        counts = database.get_classified_relatedness_counts(
+            cases, controls, db_obj, logger=logger
+        )
+        return sum(sum(class_counts.values()) for class_counts in counts.values())
+
+    return [
+        time_stage("read_in_grids", cohort_size, read_grids, repeats),
+        time_stage("get_relatedness", cohort_size, query(False), repeats),
+        time_stage(
+            "get_relatedness_all_connections", cohort_size, query(True), repeats
+        ),
+        time_stage("write_to_file", cohort_size, write, repeats),
+        time_stage("gather_distributions", cohort_size, gather_distributions, repeats),
+    ]
+
+
+@app.command()
+def run(
+    output: Path = typer.Option(
+        None,
+        "-o",
+        "--output",
+        help="json file to write the results to. By default the results are written to benchmarks/results with the current time in the name.",
+    ),
+    database_path: Path = typer.Option(
+        None,
+        "-d",
+        "--database-path",
+        help="synthetic database to use. It has to have been created by synthetic_database.py so that its parameters are known. By default a new database is generated in a temporary directory.",
+    ),
+    individuals: int = typer.Option(
+        200_000,
+        "--individuals",
+        help="number of individuals in the generated database.",
+    ),
+    pairs_per_individual: float = typer.Option(
+        50.0,
+        "--pairs-per-individual",
+        help="average number of pairs for each individual in the generated database.",
+    ),
+    cohort_sizes: str = typer.Option(
+        DEFAULT_COHORT_SIZES,
+        "--cohort-sizes",
+        help="comma separated sizes of the cohorts to benchmark.",
+    ),
+    repeats: int = typer.Option(
+        3, "--repeats", help="number of times to run each stage.", min=1
+    ),
+    seed: int = typer.Option(0, "--seed", help="seed for the synthetic data."),
+) -> None:
+    """Time each stage at several cohort sizes and write the results to json"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+
+        if database_path is None:
+            database_path = temp_dir / "synthetic.db"
+
+            print(f"Generating a synthetic database in {database_path}")
+
+            parameters = create_database(
+                database_path,
+                "ersa",
+                individuals,
+                pairs_per_individual,
+                seed=seed,
+            )
+        else:
+            parameters = json.loads(database_path.with_suffix(".json").read_text())
+
+        db_obj = database.dbResults(database_path, parameters["table_name"])
+
+        results = []
+
+        for cohort_size in (int(size) for size in cohort_sizes.split(",")):
+            grid_file = write_grid_file(
+                temp_dir / f"cohort_{cohort_size}.txt",
+                parameters["individuals"],
+                cohort_size,
+                seed=seed,
+            )
+
+            results.extend(
+                benchmark_cohort(db_obj, grid_file, temp_dir, cohort_size, repeats)
+            )
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "sqlite": database.database_methods.sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "database": parameters,
+        "repeats": repeats,
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "results": results,
+    }
+
+    if output is None:
+        output = BENCHMARK_DIR / "results" / f"{datetime.now():%Y%m%d_%H%M%S}.json"
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=4))
+
+    print(f"Wrote the benchmark results to {output}")
+
+
+@app.command()
+def compare(
+    baseline: Path = typer.Argument(..., help="json results of the earlier run."),
+    current: Path = typer.Argument(..., help="json results of the new run."),
+    tolerance: float = typer.Option(
+        0.1,
+        "--tolerance",
+        help="fraction that a stage can be slower than the baseline before it is reported as a regression.",
+    ),
+) -> None:
+    """Compare two benchmark runs and exit with an error if any stage got
+    slower than the tolerance"""
+    baseline_report = json.loads(baseline.read_text())
+    current_report = json.loads(current.read_text())
+
+    # the database path is different for every generated database
+    baseline_report["database"].pop("database_path")
+    current_report["database"].pop("database_path")
+
+    if baseline_report["database"] != current_report["database"]:
+        print("Warning: the runs used different synthetic databases")
+
+    baseline_results = {
+        (result["stage"], result["cohort_size"]): result
+        for result in baseline_report["results"]
+    }
+
+    regressions = 0
+
+    for result in current_report["results"]:
+        key = (result["stage"], result["cohort_size"])
+
+        if key not in baseline_results:
+            continue
+
+        ratio = result["best_seconds"] / max(
+            baseline_results[key]["best_seconds"], 1e-9
+        )
+
+        flag = ""
+
+        if ratio > 1 + tolerance:
+            flag = "REGRESSION"
+            regressions += 1
+
+        print(f"{key[0]:<32} {key[1]:>9} {ratio:>8.2f}x {flag}")
+
+    if regressions:
+        print(f"{regressions} stages were more than {tolerance:.0%} slower")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Generator for synthetic ERSA style pair tables used by the benchmarks.
+The tables have the same columns as the real table (ID, ID1, ID2,
+estimated_relatedness) so every command can be run against them"""
+
+import json
+import logging
+import sqlite3
+import sys
+from pathlib import Path
+
+import numpy as np
+import typer
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "relatednessFinder"))
+
+import database  # noqa: E402
+
+app = typer.Typer(add_completion=False)
+
+# default probability of each estimated relatedness value from 1 to 9. Real
+# tables are dominated by distant relatives so the weights increase with the
+# degree of relatedness
+DEFAULT_RELATEDNESS_WEIGHTS = (0.001, 0.004, 0.01, 0.025, 0.05, 0.1, 0.16, 0.26, 0.39)
+
+# number of rows inserted into the database at a time
+INSERT_BATCH_SIZE = 500_000
+
+
+def format_grid(individual: int) -> str:
+    # the prefix can't contain "grid" or "iid" because the grid file reader
+    # treats lines with those words as a header
+    return f"SYN{individual:09d}"
+
+
+def generate_pairs(
+    individuals: int,
+    pairs_per_individual: float,
+    relatedness_weights: tuple[float, ...] = DEFAULT_RELATEDNESS_WEIGHTS,
+    missing_fraction: float = 0.0,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Function that generates random pairs of individuals
+
+    Parameters
+    ----------
+    individuals : int
+        number of individuals in the table
+
+    pairs_per_individual : float
+        average number of pairs that each individual is in. Each pair is
+        stored once so the table has about individuals * pairs_per_individual
+        / 2 rows
+
+    relatedness_weights : tuple[float, ...]
+        relative probability of each estimated relatedness value starting at 1
+
+    missing_fraction : float
+        fraction of the pairs that have no relatedness value (NULL)
+
+    seed : int
+        seed for the random number generator so that the same table is
+        generated every time
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        returns the ID1 and ID2 individual numbers and the relatedness values
+        where missing values are -1
+    """
+    rng = np.random.default_rng(seed)
+
+    pair_count = int(individuals * pairs_per_individual / 2)
+
+    id1 = rng.integers(0, individuals, pair_count, dtype=np.int64)
+    # adding an offset between 1 and individuals - 1 means that an
+    # individual is never paired with itself
+    id2 = (id1 + rng.integers(1, individuals, pair_count)) % individuals
+
+    # a pair should only be in the table once no matter which individual is
+    # ID1 so the duplicates are removed from the unordered pairs
+    _, unique_rows = np.unique(
+        np.minimum(id1, id2) * individuals + np.maximum(id1, id2), return_index=True
+    )
+    unique_rows.sort()
+    id1 = id1[unique_rows]
+    id2 = id2[unique_rows]
+
+    weights = np.asarray(relatedness_weights, dtype=float)
+
+    relatedness = rng.choice(
+        np.arange(1, len(weights) + 1), size=len(id1), p=weights / weights.sum()
+    )
+
+    relatedness[rng.random(len(id1)) < missing_fraction] = -1
+
+    return id1, id2, relatedness
+
+
+def create_database(
+    database_path: Path,
+    table_name: str,
+    individuals: int,
+    pairs_per_individual: float,
+    relatedness_weights: tuple[float, ...] = DEFAULT_RELATEDNESS_WEIGHTS,
+    missing_fraction: float = 0.0,
+    seed: int = 0,
+    build_indexes: bool = True,
+) -> dict:
+    """Function that writes a synthetic pair table to a sqlite database. The
+    arguments are described in generate_pairs
+
+    Returns
+    -------
+    dict
+        returns the parameters of the database which are also written to a
+        json file next to the database
+    """
+    id1, id2, relatedness = generate_pairs(
+        individuals, pairs_per_individual, relatedness_weights, missing_fraction, seed
+    )
+
+    database_path.unlink(missing_ok=True)
+
+    connection = sqlite3.connect(database_path)
+
+    with connection:
+        connection.execute(
+            f"CREATE TABLE {table_name} (ID INTEGER PRIMARY KEY, ID1 TEXT, ID2 TEXT, estimated_relatedness INTEGER)"
+        )
+
+        for start in range(0, len(id1), INSERT_BATCH_SIZE):
+            end = start + INSERT_BATCH_SIZE
+
+            connection.executemany(
+                f"INSERT INTO {table_name} (ID1, ID2, estimated_relatedness) VALUES (?, ?, ?)",
+                (
+                    (
+                        format_grid(first),
+                        format_grid(second),
+                        None if value < 0 else value,
+                    )
+                    for first, second, value in zip(
+                        id1[start:end].tolist(),
+                        id2[start:end].tolist(),
+                        relatedness[start:end].tolist(),
+                    )
+                ),
+            )
+
+    connection.close()
+
+    if build_indexes:
+        database.build_indexes(
+            database.dbResults(database_path, table_name),
+            logger=logging.getLogger("benchmarks"),
+        )
+
+    parameters = {
+        "database_path": str(database_path),
+        "table_name": table_name,
+        "individuals": individuals,
+        "pairs_per_individual": pairs_per_individual,
+        "pairs": int(len(id1)),
+        "relatedness_weights": list(relatedness_weights),
+        "missing_fraction": missing_fraction,
+        "seed": seed,
+        "indexed": build_indexes,
+    }
+
+    database_path.with_suffix(".json").write_text(json.dumps(parameters, indent=4))
+
+    return parameters
+
+
+def write_grid_file(
+    output_path: Path,
+    individuals: int,
+    cohort_size: int,
+    case_fraction: float = 0.5,
+    seed: int = 0,
+) -> Path:
+    """Function that writes a grid file for a random cohort of individuals
+    from a synthetic database
+
+    Parameters
+    ----------
+    output_path : Path
+        path to write the grid file to
+
+    individuals : int
+        number of individuals in the synthetic database
+
+    cohort_size : int
+        number of individuals in the cohort
+
+    case_fraction : float
+        fraction of the cohort that are cases. The rest are controls
+
+    seed : int
+        seed for the random number generator
+
+    Returns
+    -------
+    Path
+        returns the path to the grid file
+    """
+    rng = np.random.default_rng(seed)
+
+    cohort = rng.choice(individuals, size=min(cohort_size, individuals), replace=False)
+    statuses = rng.random(len(cohort)) < case_fraction
+
+    with open(output_path, "w", encoding="utf-8") as grid_file:
+        grid_file.writelines(
+            f"{format_grid(individual)}\t{int(status)}\n"
+            for individual, status in zip(cohort.tolist(), statuses.tolist())
+        )
+
+    return output_path
+
+
+@app.command()
+def main(
+    database_path: Path = typer.Option(
+        ..., "-d", "--database-path", help="path to write the sqlite database to."
+    ),
+    table_name: str = typer.Option(
+        "ersa", "-t", "--table-name", help="name of the table to create."
+    ),
+    individuals: int = typer.Option(
+        100_000, "--individuals", help="number of individuals in the table.", min=2
+    ),
+    pairs_per_individual: float = typer.Option(
+        50.0,
+        "--pairs-per-individual",
+        help="average number of pairs that each individual is in.",
+        min=0,
+    ),
+    relatedness_weights: str = typer.Option(
+        ",".join(str(weight) for weight in DEFAULT_RELATEDNESS_WEIGHTS),
+        "--relatedness-weights",
+        help="comma separated relative probability of each estimated relatedness value starting at 1.",
+    ),
+    missing_fraction: float = typer.Option(
+        0.0,
+        "--missing-fraction",
+        help="fraction of the pairs without a relatedness value.",
+        min=0,
+        max=1,
+    ),
+    seed: int = typer.Option(0, "--seed", help="seed for the random number generator."),
+    no_indexes: bool = typer.Option(
+        False,
+        "--no-indexes",
+        help="Optional flag to skip building the covering indexes.",
+        is_flag=True,
+    ),
+) -> None:
+    """Generate a synthetic ERSA style pair table"""
+    parameters = create_database(
+        database_path,
+        table_name,
+        individuals,
+        pairs_per_individual,
+        tuple(float(weight) for weight in relatedness_weights.split(",")),
+        missing_fraction,
+        seed,
+        not no_indexes,
+    )
+
+    print(json.dumps(parameters, indent=4))
+
+
+if __name__ == "__main__":
+    app()
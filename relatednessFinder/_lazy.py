@@ -0,0 +1,44 @@
+from importlib import import_module
+from typing import Any, Callable
+
+
+def lazy_exports(
+    namespace: dict[str, Any], exports: dict[str, str]
+) -> tuple[Callable[[str], Any], Callable[[], list[str]]]:
+    """Function that builds the module level __getattr__ and __dir__ for a
+    package whose names are only imported once they are used. This means a
+    command doesn't import numpy, matplotlib, or the query code unless it
+    needs them
+
+    Parameters
+    ----------
+    namespace : dict[str, Any]
+        globals() of the package's __init__ module
+
+    exports : dict[str, str]
+        dictionary of each exported name and the relative name of the module
+        that it is defined in
+
+    Returns
+    -------
+    tuple[Callable[[str], Any], Callable[[], list[str]]]
+        returns the __getattr__ and __dir__ functions for the package
+    """
+    package_name = namespace["__name__"]
+
+    def __getattr__(name: str) -> Any:
+        if name not in exports:
+            raise AttributeError(f"module {package_name!r} has no attribute {name!r}")
+
+        value = getattr(import_module(exports[name], package_name), name)
+
+        # storing the value means that this is only called the first time
+        # that each name is used
+        namespace[name] = value
+
+        return value
+
+    def __dir__() -> list[str]:
+        return sorted([*namespace, *exports])
+
+    return __getattr__, __dir__
@@ -1 +1,26 @@
-from .distributions import generate_results_list, plot_distribution
+from _lazy import lazy_exports
+
+# module that each exported name is defined in. The modules are only imported
+# once one of their names is used so that a command doesn't import numpy or
+# matplotlib unless it needs them
+_EXPORTS = {
+    "plot_distribution": ".distributions",
+    "summarize_distribution": ".distributions",
+    "write_distribution_table": ".distributions",
+    "EnrichmentResults": ".enrichment",
+    "permutation_test": ".enrichment",
+    "write_enrichment_table": ".enrichment",
+    "RelatednessGraph": ".pruning",
+    "build_graph": ".pruning",
+    "find_clusters": ".pruning",
+    "find_removal_set": ".pruning",
+    "prune_related": ".pruning",
+    "write_pruning_results": ".pruning",
+    "RelativeSummary": ".relatives",
+    "summarize_relatives": ".relatives",
+    "write_relative_summary": ".relatives",
+}
+
+__all__ = list(_EXPORTS)
+
+__getattr__, __dir__ = lazy_exports(globals(), _EXPORTS)
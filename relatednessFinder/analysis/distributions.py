@@ -1,52 +1,110 @@
 from logging import Logger
 from pathlib import Path
-from typing import Generator
 
-import matplotlib.pyplot as plt
 from log import log_msg_debug
 
 
-def generate_results_list(
-    case_results: Generator[list[tuple[int, str, str, int]], None, None], logger: Logger
-) -> list[int]:
-    """Function that will gather all of the output from the database generator into a list of relatedness values. The pair ids are not kept
+def summarize_distribution(relatedness_counts: dict[int, int]) -> dict[str, float]:
+    """Function that will calculate summary statistics for the relatedness
+    values from the counts at each value rather than the individual values
 
     Parameters
     ----------
-    case_results : Generator[list[tuple[int, str, str, int]], None, None]
-        generator object that has the row results from the dataframe
-        where each row is a tuple
+    relatedness_counts : dict[int, int]
+        dictionary where the keys are the estimated relatedness values and the
+        values are the number of pairs with that value. Pairs without a
+        relatedness value (None) are not included in the statistics
 
-    logger : logging.Logger
-        logging object
+    Returns
+    -------
+    dict[str, float]
+        returns a dictionary with the number of pairs, and the mean, median,
+        minimum, and maximum relatedness values. The statistics are None if
+        there are no pairs
+    """
+    counts = sorted(
+        (value, count)
+        for value, count in relatedness_counts.items()
+        if value is not None and count > 0
+    )
+
+    total = sum(count for _, count in counts)
+
+    summary = {"pairs": total, "mean": None, "median": None, "min": None, "max": None}
+
+    if total == 0:
+        return summary
+
+    summary["mean"] = sum(value * count for value, count in counts) / total
+    summary["min"] = counts[0][0]
+    summary["max"] = counts[-1][0]
+
+    # walking through the cumulative counts to find the value(s) in the
+    # middle of the distribution
+    middle_positions = {(total - 1) // 2, total // 2}
+    middle_values = []
+    seen = 0
+    for value, count in counts:
+        middle_values.extend(
+            value for position in middle_positions if seen <= position < seen + count
+        )
+        seen += count
+
+    summary["median"] = sum(middle_values) / len(middle_values)
+
+    return summary
+
+
+def write_distribution_table(
+    distributions: dict[str, dict[int, int]], output_path: Path
+) -> Path:
+    """Function that will write the counts at each relatedness value for each
+    group to a tab separated file
+
+    Parameters
+    ----------
+    distributions : dict[str, dict[int, int]]
+        dictionary where the keys are the group names (such as cases and
+        controls) and the values are the counts at each relatedness value
+
+    output_path : Path
+        path object representing the path to write the output to. The file
+        name will have _relatedness_counts.txt appended to it
 
     Returns
     -------
-    list[int]
-        returns a list of the relatedness values where each value is
-        an integer
+    Path
+        returns the path of the file that was written
     """
-    return_rel_list = []
-    for val in case_results:
-        for relatedness_tuple in val:
-            rel_val = relatedness_tuple[3]
-            return_rel_list.append(rel_val)
+    output_file = output_path.parent / f"{output_path.name}_relatedness_counts.txt"
+
+    with open(output_file, "w", encoding="utf-8") as output:
+        output.write("group\tEstimated_relatedness\tcount\n")
+        for group, relatedness_counts in distributions.items():
+            for value, count in relatedness_counts.items():
+                output.write(f"{group}\t{value}\t{count}\n")
 
-    return return_rel_list
+    return output_file
 
 
 @log_msg_debug("creating a plot of the relatedness distributions")
 def plot_distribution(
-    relatedness_dist: list[int], output_path: Path, file_suffix: str, logger=Logger
+    relatedness_counts: dict[int, int],
+    output_path: Path,
+    file_suffix: str,
+    logger=Logger,
 ) -> None:
-    """Function that creates histograms of the relatedness values
+    """Function that creates histograms of the relatedness values from the
+    counts at each value
 
-    relatedness_dist : list[int]
-        list of relatedness values
+    relatedness_counts : dict[int, int]
+        dictionary where the keys are the estimated relatedness values and the
+        values are the number of pairs with that value
 
     output_path : Path
         path object representing the path to write the output paths
-        to
+        to. Only the name is used so the plot is written to the current
+        working directory
 
     file_suffix : str
         ending to add to the output file
@@ -54,15 +112,31 @@ def plot_distribution(
     logger : logging.Logger
         logging object
     """
+    # matplotlib is only imported when a plot is made because importing it
+    # takes longer than the rest of the program's startup. The figure is
+    # drawn with the Agg canvas rather than pyplot so that no GUI backend is
+    # loaded and the plots can be made on servers without a display
+    from matplotlib import style
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    values = [value for value in relatedness_counts if value is not None]
+
     # we are going to set the theme of the plot
-    plt.style.use("seaborn-v0_8-paper")
+    with style.context("seaborn-v0_8-paper"):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+
+        ax = fig.subplots()
 
-    _ = plt.hist(relatedness_dist)
+        # weighting each value by its count gives the same histogram as
+        # plotting every individual value
+        _ = ax.hist(values, weights=[relatedness_counts[value] for value in values])
 
-    plt.title("Distribution of relatedness values")
+        ax.set_title("Distribution of relatedness values")
 
-    plt.xlabel("Estimated relatedness")
+        ax.set_xlabel("Estimated relatedness")
 
-    plt.ylabel("Counts")
+        ax.set_ylabel("Counts")
 
-    plt.savefig("_".join([output_path.name, file_suffix]))
+        fig.savefig("_".join([output_path.name, file_suffix]))
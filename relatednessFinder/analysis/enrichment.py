@@ -0,0 +1,512 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from logging import Logger
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from database import MISSING_RELATEDNESS, IdDictionary, PairResults
+from log import log_msg_debug
+
+# seed for the label permutations so that a run can be repeated
+PERMUTATION_SEED = 0
+
+# number of permutations that are given to a worker at a time. Each chunk
+# gets its own random stream from the seed so the results are the same no
+# matter how many workers are used
+PERMUTATION_CHUNK_SIZE = 256
+
+# largest number of labels (permutations times pairs) that are handled in
+# one block. The case labels of both individuals of every pair are looked up
+# for a block of permutations at once so this caps the size of those arrays
+PERMUTATION_BLOCK_SIZE = 1 << 24
+
+# the two individuals and the relatedness of each pair are packed into one
+# int64 key while the pairs are read so the cohort has to fit in 24 bits
+MAX_COHORT_SIZE = 1 << 24
+
+# edges of the relatedness graph shared with each worker process
+_worker_edges = None
+
+
+@dataclass
+class EnrichmentResults:
+    """Results of the permutation test. Column j of each count array is the
+    pairs at relatedness_values[j] and the last column is the pairs at every
+    relatedness value
+
+    Attributes
+    ----------
+    relatedness_values : np.ndarray
+        uint8 array of the relatedness values in ascending order. Missing
+        values are MISSING_RELATEDNESS so they are last
+
+    pairs : np.ndarray
+        int64 array of the number of pairs between the cases and controls
+
+    case_case : np.ndarray
+        int64 array of the observed number of case-case pairs
+
+    control_control : np.ndarray
+        int64 array of the observed number of control-control pairs
+
+    permuted_case_case : np.ndarray
+        int64 array with a row for each permutation of the number of
+        case-case pairs after the case labels were shuffled
+
+    permuted_control_control : np.ndarray
+        int64 array with a row for each permutation of the number of
+        control-control pairs after the case labels were shuffled
+
+    case_count : int
+        number of cases
+
+    control_count : int
+        number of controls
+    """
+
+    relatedness_values: np.ndarray
+    pairs: np.ndarray
+    case_case: np.ndarray
+    control_control: np.ndarray
+    permuted_case_case: np.ndarray
+    permuted_control_control: np.ndarray
+    case_count: int
+    control_count: int
+
+    @property
+    def permutations(self) -> int:
+        return len(self.permuted_case_case)
+
+    def _pair_rates(
+        self, case_case: np.ndarray, control_control: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Method that divides the pair counts by the number of possible
+        case-case and control-control pairs"""
+        case_pairs = self.case_count * (self.case_count - 1) / 2
+        control_pairs = self.control_count * (self.control_count - 1) / 2
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (
+                np.divide(case_case, case_pairs) if case_pairs else case_case * 0.0,
+                (
+                    np.divide(control_control, control_pairs)
+                    if control_pairs
+                    else control_control * 0.0
+                ),
+            )
+
+    def statistics(self) -> dict[str, np.ndarray]:
+        """Method that calculates the statistics for each relatedness value.
+        The p-values are the fraction of permutations with a statistic at
+        least as large as the observed one, counting the observed labels as
+        one of the permutations so a p-value is never 0
+
+        Returns
+        -------
+        dict[str, np.ndarray]
+            returns the expected number of case-case pairs, the enrichment
+            (observed / expected case-case pairs) and its p-value, the rate
+            of case-case and control-control pairs out of every possible
+            pair in each group, and the p-value for the difference between
+            the two rates
+        """
+        expected = self.permuted_case_case.mean(axis=0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            enrichment = np.where(expected > 0, self.case_case / expected, np.nan)
+
+        case_case_p_value = (
+            1 + np.count_nonzero(self.permuted_case_case >= self.case_case, axis=0)
+        ) / (1 + self.permutations)
+
+        case_rate, control_rate = self._pair_rates(self.case_case, self.control_control)
+        permuted_case_rate, permuted_control_rate = self._pair_rates(
+            self.permuted_case_case, self.permuted_control_control
+        )
+
+        difference = case_rate - control_rate
+        permuted_difference = permuted_case_rate - permuted_control_rate
+
+        # the rates are floats so differences that only differ by rounding
+        # are counted as equal to the observed difference
+        at_least = (permuted_difference > difference) | np.isclose(
+            permuted_difference, difference, rtol=1e-12, atol=0
+        )
+
+        return {
+            "expected_case_case": expected,
+            "enrichment": enrichment,
+            "case_case_p_value": case_case_p_value,
+            "case_case_rate": case_rate,
+            "control_control_rate": control_rate,
+            "rate_difference_p_value": (1 + np.count_nonzero(at_least, axis=0))
+            / (1 + self.permutations),
+        }
+
+
+def _count_group_pairs(
+    labels: np.ndarray, id1: np.ndarray, id2: np.ndarray, starts: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Function that counts the case-case and control-control pairs at each
+    relatedness value for a block of labels. The pairs are sorted by
+    relatedness so each value is a contiguous range of pairs starting at
+    starts
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        boolean array with a row of case labels for each permutation
+
+    id1 : np.ndarray
+        first individual of each pair
+
+    id2 : np.ndarray
+        second individual of each pair
+
+    starts : np.ndarray
+        index of the first pair at each relatedness value
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        returns the number of case-case and control-control pairs with a
+        row for each permutation and a column for each relatedness value
+        followed by a column for every value
+    """
+    if not len(id1):
+        empty = np.zeros((len(labels), 1), dtype=np.int64)
+        return empty, empty.copy()
+
+    case1 = labels[:, id1]
+    case2 = labels[:, id2]
+
+    ends = np.append(starts[1:], len(id1))
+
+    counts = []
+
+    # counting the True values in each range of pairs is much faster than
+    # np.add.reduceat on a boolean array
+    for group_pairs in (case1 & case2, ~(case1 | case2)):
+        value_counts = np.stack(
+            [
+                np.count_nonzero(group_pairs[:, start:end], axis=1)
+                for start, end in zip(starts, ends)
+            ],
+            axis=1,
+        ).astype(np.int64)
+
+        counts.append(
+            np.hstack([value_counts, value_counts.sum(axis=1, keepdims=True)])
+        )
+
+    return counts[0], counts[1]
+
+
+def _permute_chunk(
+    id1: np.ndarray,
+    id2: np.ndarray,
+    starts: np.ndarray,
+    is_case: np.ndarray,
+    permutations: int,
+    seed: np.random.SeedSequence,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Function that shuffles the case labels and counts the pairs for a
+    chunk of permutations. The permutations are done in blocks so that the
+    label arrays stay under PERMUTATION_BLOCK_SIZE"""
+    rng = np.random.default_rng(seed)
+
+    block_size = max(1, PERMUTATION_BLOCK_SIZE // max(len(id1), len(is_case), 1))
+
+    case_case = []
+    control_control = []
+
+    for start in range(0, permutations, block_size):
+        labels = rng.permuted(
+            np.broadcast_to(
+                is_case, (min(block_size, permutations - start), len(is_case))
+            ),
+            axis=1,
+        )
+
+        block_case_case, block_control_control = _count_group_pairs(
+            labels, id1, id2, starts
+        )
+
+        case_case.append(block_case_case)
+        control_control.append(block_control_control)
+
+    return np.vstack(case_case), np.vstack(control_control)
+
+
+def _init_worker(
+    id1: np.ndarray, id2: np.ndarray, starts: np.ndarray, is_case: np.ndarray
+) -> None:
+    """Initializer for the worker processes that stores the pairs so that
+    they are only sent to each worker once"""
+    global _worker_edges
+
+    _worker_edges = (id1, id2, starts, is_case)
+
+
+def _permute_chunk_in_worker(
+    permutations: int, seed: np.random.SeedSequence
+) -> tuple[np.ndarray, np.ndarray]:
+    return _permute_chunk(*_worker_edges, permutations, seed)
+
+
+def _read_edges(
+    pairs: Iterable[PairResults],
+    dictionary: IdDictionary,
+    cohort: np.ndarray,
+    positions: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Function that reads the pairs into integer arrays of the position of
+    each individual in the cohort and the relatedness. cohort is the sorted
+    dictionary integers of the individuals and positions is the position of
+    each of them. Pairs with an individual outside of the cohort and self
+    pairs are dropped and a pair that is returned more than once with the
+    same relatedness is only kept once"""
+    keys = []
+
+    for batch in pairs:
+        if not len(cohort):
+            continue
+
+        if batch.dictionary is not dictionary:
+            batch = batch.remap(dictionary)
+
+        id1, id2, relatedness = batch.arrays()
+
+        # IDs that were added to the dictionary by the query aren't in the
+        # cohort so they don't match the cohort at their sorted position
+        index1 = np.minimum(np.searchsorted(cohort, id1), len(cohort) - 1)
+        index2 = np.minimum(np.searchsorted(cohort, id2), len(cohort) - 1)
+
+        in_cohort = (cohort[index1] == id1) & (cohort[index2] == id2) & (id1 != id2)
+
+        position1 = positions[index1]
+        position2 = positions[index2]
+
+        low = np.minimum(position1, position2)[in_cohort].astype(np.int64)
+        high = np.maximum(position1, position2)[in_cohort].astype(np.int64)
+
+        keys.append(relatedness[in_cohort].astype(np.int64) << 48 | low << 24 | high)
+
+    # the keys are sorted by relatedness first so each relatedness value is
+    # a contiguous range of pairs
+    edges = np.unique(np.concatenate(keys or [np.empty(0, dtype=np.int64)]))
+
+    mask = MAX_COHORT_SIZE - 1
+
+    return (
+        (edges >> 24 & mask).astype(np.int32),
+        (edges & mask).astype(np.int32),
+        (edges >> 48).astype(np.uint8),
+    )
+
+
+@log_msg_debug("Running the permutation test for relatedness among the cases")
+def permutation_test(
+    pairs: Iterable[PairResults],
+    cases: list[str],
+    controls: list[str],
+    logger: Logger,
+    permutations: int,
+    workers: int = 1,
+    seed: int = PERMUTATION_SEED,
+    dictionary: IdDictionary | None = None,
+) -> EnrichmentResults:
+    """Function that tests whether the cases are more related to each other
+    than expected by shuffling the case and control labels. The pairs are
+    read once into integer arrays and every permutation counts the
+    case-case and control-control pairs at each relatedness value. Blocks of
+    permutations are done with a few array operations and the chunks of
+    permutations can be split across a pool of processes
+
+    Parameters
+    ----------
+    pairs : Iterable[PairResults]
+        batches of the pairs between the cases and controls such as the
+        results of database.get_relatedness for the cases and controls
+
+    cases : list[str]
+        list of case IDs
+
+    controls : list[str]
+        list of control IDs. An ID that is listed as both a case and a
+        control is treated as a case
+
+    logger : logging.Logger
+        logging object
+
+    permutations : int
+        number of times to shuffle the labels
+
+    workers : int
+        number of processes to split the permutations across
+
+    seed : int
+        seed for the random shuffles
+
+    dictionary : IdDictionary | None
+        dictionary that the pairs are encoded with. Passing the dictionary
+        that was given to database.get_relatedness means the pairs don't
+        have to be re-encoded
+
+    Returns
+    -------
+    EnrichmentResults
+        returns the observed and permuted pair counts
+
+    Raises
+    ------
+    ValueError
+        if there are more than MAX_COHORT_SIZE cases and controls
+    """
+    dictionary = dictionary if dictionary is not None else IdDictionary()
+
+    cohort_ids = np.frombuffer(dictionary.encode(cases + controls), dtype=np.int32)
+
+    cohort, first_listed = np.unique(cohort_ids, return_index=True)
+
+    # each individual's position is the order that they are first listed in
+    # so the shuffles for a seed don't depend on the order that the IDs were
+    # added to the dictionary. The cases are listed first
+    listed_order = np.argsort(first_listed)
+
+    positions = np.empty(len(cohort), dtype=np.int64)
+    positions[listed_order] = np.arange(len(cohort))
+
+    is_case = first_listed[listed_order] < len(cases)
+
+    if len(cohort) > MAX_COHORT_SIZE:
+        raise ValueError(
+            f"The permutation test can only be run on up to {MAX_COHORT_SIZE} cases and controls"
+        )
+
+    id1, id2, relatedness = _read_edges(pairs, dictionary, cohort, positions)
+
+    relatedness_values, starts = np.unique(relatedness, return_index=True)
+
+    logger.info(
+        f"Running {permutations} permutations of the labels of {int(is_case.sum())} cases and {int((~is_case).sum())} controls with {len(id1)} pairs"
+    )
+
+    case_case, control_control = _count_group_pairs(
+        is_case[np.newaxis, :], id1, id2, starts
+    )
+
+    chunk_sizes = [
+        min(PERMUTATION_CHUNK_SIZE, permutations - start)
+        for start in range(0, permutations, PERMUTATION_CHUNK_SIZE)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    if workers > 1 and len(chunk_sizes) > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(id1, id2, starts, is_case),
+        ) as executor:
+            chunks = list(executor.map(_permute_chunk_in_worker, chunk_sizes, seeds))
+    else:
+        chunks = [
+            _permute_chunk(id1, id2, starts, is_case, chunk_size, chunk_seed)
+            for chunk_size, chunk_seed in zip(chunk_sizes, seeds)
+        ]
+
+    column_count = case_case.shape[1]
+
+    results = EnrichmentResults(
+        relatedness_values,
+        np.append(np.diff(np.append(starts, len(id1))), len(id1)),
+        case_case[0],
+        control_control[0],
+        np.vstack(
+            [chunk[0] for chunk in chunks]
+            or [np.empty((0, column_count), dtype=np.int64)]
+        ),
+        np.vstack(
+            [chunk[1] for chunk in chunks]
+            or [np.empty((0, column_count), dtype=np.int64)]
+        ),
+        int(is_case.sum()),
+        int((~is_case).sum()),
+    )
+
+    statistics = results.statistics()
+
+    logger.info(
+        f"Observed {results.case_case[-1]} case-case pairs compared to {statistics['expected_case_case'][-1]:.1f} expected (p-value {statistics['case_case_p_value'][-1]:.4g})"
+    )
+
+    return results
+
+
+def _format_value(value: float) -> str:
+    return "NA" if np.isnan(value) else f"{value:.6g}"
+
+
+def write_enrichment_table(results: EnrichmentResults, output_path: Path) -> Path:
+    """Function that writes the statistics from the permutation test for
+    each relatedness value and for every value together
+
+    Parameters
+    ----------
+    results : EnrichmentResults
+        results returned by permutation_test
+
+    output_path : Path
+        path object representing the path to write the output to. The file
+        name will have _enrichment.txt appended to it
+
+    Returns
+    -------
+    Path
+        returns the path of the file that was written
+    """
+    output_file = output_path.parent / f"{output_path.name}_enrichment.txt"
+
+    statistics = results.statistics()
+
+    labels = [
+        "None" if value == MISSING_RELATEDNESS else str(value)
+        for value in results.relatedness_values.tolist()
+    ] + ["all"]
+
+    with open(output_file, "w", encoding="utf-8") as output:
+        output.write(
+            "Estimated_relatedness\tpairs\tcase_case\texpected_case_case\tenrichment\tcase_case_p_value\tcontrol_control\tcase_case_rate\tcontrol_control_rate\trate_difference_p_value\n"
+        )
+
+        for column, label in enumerate(labels):
+            output.write(
+                "\t".join(
+                    [
+                        label,
+                        str(results.pairs[column]),
+                        str(results.case_case[column]),
+                        *(
+                            _format_value(statistics[name][column])
+                            for name in (
+                                "expected_case_case",
+                                "enrichment",
+                                "case_case_p_value",
+                            )
+                        ),
+                        str(results.control_control[column]),
+                        *(
+                            _format_value(statistics[name][column])
+                            for name in (
+                                "case_case_rate",
+                                "control_control_rate",
+                                "rate_difference_p_value",
+                            )
+                        ),
+                    ]
+                )
+                + "\n"
+            )
+
+    return output_file
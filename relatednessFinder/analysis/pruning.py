@@ -0,0 +1,417 @@
+from dataclasses import dataclass
+from logging import Logger
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from database import IdDictionary, PairResults
+from log import log_msg_debug
+
+# priority used to break ties between individuals with the same number of
+# relatives. The individual with the lower priority is removed first
+CONTROL_PRIORITY = 0
+CASE_PRIORITY = 1
+
+# seed for the order that breaks the remaining ties between individuals
+TIE_BREAK_SEED = 0
+
+
+@dataclass
+class RelatednessGraph:
+    """Graph of the related pairs stored as compressed sparse rows. The
+    neighbours of vertex i are neighbors[offsets[i]:offsets[i + 1]]. Each
+    vertex is an ID in the dictionary
+
+    Attributes
+    ----------
+    dictionary : IdDictionary
+        dictionary used to convert the vertices back to IDs
+
+    id1 : np.ndarray
+        int32 array of the first vertex of each edge. Each edge is only
+        stored once with the smaller vertex first
+
+    id2 : np.ndarray
+        int32 array of the second vertex of each edge
+
+    offsets : np.ndarray
+        int64 array of where the neighbours of each vertex start
+
+    neighbors : np.ndarray
+        int32 array of the neighbours of every vertex
+    """
+
+    dictionary: IdDictionary
+    id1: np.ndarray
+    id2: np.ndarray
+    offsets: np.ndarray
+    neighbors: np.ndarray
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.offsets) - 1
+
+    def degrees(self) -> np.ndarray:
+        """Method that returns the number of neighbours of each vertex"""
+        return np.diff(self.offsets)
+
+
+def build_graph(
+    pairs: Iterable[PairResults], dictionary: IdDictionary
+) -> RelatednessGraph:
+    """Function that builds the graph of related pairs. Self pairs are
+    dropped and a pair that is in the table in both directions is only one
+    edge
+
+    Parameters
+    ----------
+    pairs : Iterable[PairResults]
+        batches of related pairs. Batches that use a different dictionary are
+        re-encoded with the dictionary
+
+    dictionary : IdDictionary
+        dictionary to encode the vertices with. Every ID in the dictionary is
+        a vertex even if it isn't in any pairs
+
+    Returns
+    -------
+    RelatednessGraph
+        returns the graph of the pairs
+    """
+    id1_batches = []
+    id2_batches = []
+
+    for batch in pairs:
+        if batch.dictionary is not dictionary:
+            batch = batch.remap(dictionary)
+
+        id1, id2, _ = batch.arrays()
+
+        id1_batches.append(id1.copy())
+        id2_batches.append(id2.copy())
+
+    id1 = np.concatenate(id1_batches or [np.empty(0, dtype=np.int32)])
+    id2 = np.concatenate(id2_batches or [np.empty(0, dtype=np.int32)])
+
+    # each edge is stored once as (smaller vertex, larger vertex)
+    low = np.minimum(id1, id2).astype(np.int64)
+    high = np.maximum(id1, id2).astype(np.int64)
+
+    edges = np.unique((low << 32 | high)[low != high])
+
+    id1 = (edges >> 32).astype(np.int32)
+    id2 = (edges & 0xFFFFFFFF).astype(np.int32)
+
+    vertex_count = len(dictionary)
+
+    # every edge is added in both directions and sorted by the first vertex
+    # to give the neighbours of each vertex
+    sources = np.concatenate([id1, id2])
+    targets = np.concatenate([id2, id1])
+
+    order = np.argsort(sources, kind="stable")
+
+    offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=vertex_count), out=offsets[1:])
+
+    return RelatednessGraph(dictionary, id1, id2, offsets, targets[order])
+
+
+def find_clusters(graph: RelatednessGraph) -> np.ndarray:
+    """Function that finds the clusters of relatives with a union-find that
+    processes every edge at once. Each round links the root of the larger
+    vertex of every edge whose ends have different roots to the smallest
+    root it is paired with, and then compresses the paths by pointer jumping
+    until every vertex points at its root
+
+    Parameters
+    ----------
+    graph : RelatednessGraph
+        graph of the related pairs
+
+    Returns
+    -------
+    np.ndarray
+        returns the root of each vertex. Vertices with the same root are in
+        the same cluster and the root is the smallest vertex in the cluster
+    """
+    parent = np.arange(graph.vertex_count, dtype=np.int32)
+
+    id1, id2 = graph.id1, graph.id2
+
+    while True:
+        root1 = parent[id1]
+        root2 = parent[id2]
+
+        unlinked = root1 != root2
+
+        if not unlinked.any():
+            return parent
+
+        # edges that are already inside of one cluster stay that way so they
+        # are not checked again
+        id1, id2 = id1[unlinked], id2[unlinked]
+        root1, root2 = root1[unlinked], root2[unlinked]
+
+        # roots are always linked to a smaller root so there are no cycles
+        np.minimum.at(parent, np.maximum(root1, root2), np.minimum(root1, root2))
+
+        while True:
+            grandparent = parent[parent]
+
+            if np.array_equal(grandparent, parent):
+                break
+
+            parent = grandparent
+
+
+def _local_maxima(
+    scores: np.ndarray, id1: np.ndarray, id2: np.ndarray, candidates: np.ndarray
+) -> np.ndarray:
+    """Function that returns which of the candidate vertices have a higher
+    score than all of their neighbours along the edges. The scores are
+    unique so two neighbours are never both local maxima"""
+    is_maximum = candidates.copy()
+
+    is_maximum[id1[scores[id2] > scores[id1]]] = False
+    is_maximum[id2[scores[id1] > scores[id2]]] = False
+
+    return is_maximum
+
+
+def find_removal_set(
+    graph: RelatednessGraph, statuses: np.ndarray, keep_cases: bool = False
+) -> np.ndarray:
+    """Function that finds a small set of individuals to remove so that no
+    two of the remaining individuals are related. This is a vertex cover of
+    the graph found with a greedy heuristic that removes the individuals with
+    the most remaining relatives first. Rather than removing one individual
+    at a time, each round removes every individual that has more remaining
+    relatives than all of its remaining relatives, so each round is a few
+    array operations over the edges. Removed individuals whose relatives
+    were all removed are then added back in the same way
+
+    Parameters
+    ----------
+    graph : RelatednessGraph
+        graph of the related pairs
+
+    statuses : np.ndarray
+        int8 array of the case (1) or control (0) status of each vertex
+
+    keep_cases : bool
+        whether to remove the control when a case and a control have the same
+        number of remaining relatives. Otherwise these ties are broken in a
+        random but repeatable order
+
+    Returns
+    -------
+    np.ndarray
+        returns a boolean array that is True for each vertex that is removed
+    """
+    vertex_count = graph.vertex_count
+
+    priorities = (
+        np.where(statuses == 1, CASE_PRIORITY, CONTROL_PRIORITY).astype(np.int64)
+        if keep_cases
+        else np.zeros(vertex_count, dtype=np.int64)
+    )
+
+    # The remaining ties are broken by a random order instead of by the
+    # vertex. With the vertex order a chain of relatives would only lose
+    # one individual per round
+    tie_breaks = (
+        np.random.default_rng(TIE_BREAK_SEED).permutation(vertex_count).astype(np.int64)
+    )
+
+    removed = np.zeros(vertex_count, dtype=bool)
+
+    id1, id2 = graph.id1, graph.id2
+
+    while len(id1):
+        degrees = np.bincount(id1, minlength=vertex_count) + np.bincount(
+            id2, minlength=vertex_count
+        )
+
+        scores = (
+            degrees.astype(np.int64) << 33
+            | (CASE_PRIORITY - priorities) << 32
+            | tie_breaks
+        )
+
+        removed |= _local_maxima(scores, id1, id2, degrees > 0)
+
+        remaining = ~(removed[id1] | removed[id2])
+        id1, id2 = id1[remaining], id2[remaining]
+
+    # cases are added back before controls if keep_cases is True
+    scores = priorities << 32 | tie_breaks
+
+    while True:
+        has_kept_relative = np.zeros(vertex_count, dtype=bool)
+        has_kept_relative[graph.id1[~removed[graph.id2]]] = True
+        has_kept_relative[graph.id2[~removed[graph.id1]]] = True
+
+        candidates = removed & ~has_kept_relative
+
+        if not candidates.any():
+            return removed
+
+        between = candidates[graph.id1] & candidates[graph.id2]
+
+        removed &= ~_local_maxima(
+            scores, graph.id1[between], graph.id2[between], candidates
+        )
+
+
+@log_msg_debug("Finding the individuals to remove so that none are related")
+def prune_related(
+    pairs: Iterable[PairResults],
+    cases: list[str],
+    controls: list[str],
+    logger: Logger,
+    keep_cases: bool = False,
+    dictionary: IdDictionary | None = None,
+) -> tuple[list[str], list[str], dict[str, tuple[int, int, bool]]]:
+    """Function that finds clusters of relatives and the individuals to
+    remove so that no remaining pair is related
+
+    Parameters
+    ----------
+    pairs : Iterable[PairResults]
+        batches of the related pairs such as the results of
+        database.get_relatedness with a relatedness threshold
+
+    cases : list[str]
+        list of case IDs
+
+    controls : list[str]
+        list of control IDs. An ID that is listed as both a case and a
+        control is treated as a case
+
+    logger : logging.Logger
+        logging object
+
+    keep_cases : bool
+        whether to remove controls before cases when they have the same
+        number of relatives
+
+    dictionary : IdDictionary | None
+        dictionary that the pairs are encoded with. Passing the dictionary
+        that was given to database.get_relatedness means the pairs don't
+        have to be re-encoded
+
+    Returns
+    -------
+    tuple[list[str], list[str], dict[str, tuple[int, int, bool]]]
+        returns the list of IDs to remove, the list of IDs to keep, and a
+        dictionary with the cluster, number of relatives, and whether the
+        individual was removed for every individual that has a relative.
+        Clusters are numbered from 1 starting with the largest cluster
+    """
+    dictionary = dictionary if dictionary is not None else IdDictionary()
+
+    # the IDs are encoded before the pairs are read so that every individual
+    # is a vertex even if they have no relatives
+    case_vertices = np.frombuffer(dictionary.encode(cases), dtype=np.int32)
+    dictionary.encode(controls)
+
+    graph = build_graph(pairs, dictionary)
+
+    statuses = np.zeros(graph.vertex_count, dtype=np.int8)
+    statuses[case_vertices] = 1
+
+    logger.info(
+        f"Built a graph of {len(graph.id1)} related pairs between {graph.vertex_count} individuals"
+    )
+
+    roots = find_clusters(graph)
+
+    removed = find_removal_set(graph, statuses, keep_cases)
+
+    degrees = graph.degrees()
+    related = np.flatnonzero(degrees)
+
+    # numbering the clusters by size so that the largest cluster is 1
+    cluster_roots, cluster_sizes = np.unique(roots[related], return_counts=True)
+    cluster_order = np.argsort(-cluster_sizes, kind="stable")
+    cluster_numbers = np.empty(len(cluster_roots), dtype=np.int64)
+    cluster_numbers[cluster_order] = np.arange(1, len(cluster_roots) + 1)
+
+    clusters = dict(
+        zip(
+            dictionary.decode(related),
+            zip(
+                cluster_numbers[
+                    np.searchsorted(cluster_roots, roots[related])
+                ].tolist(),
+                degrees[related].tolist(),
+                removed[related].tolist(),
+            ),
+        )
+    )
+
+    removed_ids = dictionary.decode(np.flatnonzero(removed))
+    kept_ids = dictionary.decode(np.flatnonzero(~removed))
+
+    logger.info(
+        f"Found {len(cluster_roots)} clusters of relatives. The largest cluster has {cluster_sizes.max(initial=0)} individuals"
+    )
+    logger.info(
+        f"Removing {len(removed_ids)} individuals ({int(statuses[removed].sum())} cases) and keeping {len(kept_ids)} individuals ({int(statuses[~removed].sum())} cases)"
+    )
+
+    return removed_ids, kept_ids, clusters
+
+
+def write_pruning_results(
+    removed_ids: list[str],
+    kept_ids: list[str],
+    clusters: dict[str, tuple[int, int, bool]],
+    output_path: Path,
+) -> tuple[Path, Path, Path]:
+    """Function that writes the IDs to remove, the IDs to keep, and the
+    cluster of each related individual
+
+    Parameters
+    ----------
+    removed_ids : list[str]
+        list of the IDs to remove
+
+    kept_ids : list[str]
+        list of the IDs to keep
+
+    clusters : dict[str, tuple[int, int, bool]]
+        dictionary from prune_related with the cluster, number of relatives,
+        and whether each related individual was removed
+
+    output_path : Path
+        path object representing the path to write the output to. The file
+        names will have _removed.txt, _kept.txt, and _clusters.txt appended
+        to it
+
+    Returns
+    -------
+    tuple[Path, Path, Path]
+        returns the paths of the removed, kept, and clusters files
+    """
+    removed_file = output_path.parent / f"{output_path.name}_removed.txt"
+    kept_file = output_path.parent / f"{output_path.name}_kept.txt"
+    clusters_file = output_path.parent / f"{output_path.name}_clusters.txt"
+
+    for output_file, ids in [(removed_file, removed_ids), (kept_file, kept_ids)]:
+        with open(output_file, "w", encoding="utf-8") as output:
+            output.write("".join(f"{grid}\n" for grid in ids))
+
+    with open(clusters_file, "w", encoding="utf-8") as output:
+        output.write("ID\tcluster\trelatives\tremoved\n")
+        output.write(
+            "".join(
+                f"{grid}\t{cluster}\t{relatives}\t{int(removed)}\n"
+                for grid, (cluster, relatives, removed) in sorted(
+                    clusters.items(), key=lambda item: item[1][0]
+                )
+            )
+        )
+
+    return removed_file, kept_file, clusters_file
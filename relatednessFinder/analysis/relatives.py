@@ -0,0 +1,312 @@
+import gzip
+from dataclasses import dataclass
+from logging import Logger
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from database import MISSING_RELATEDNESS, IdDictionary, PairResults
+from log import log_msg_debug
+
+# number of individuals that are formatted before a block is written to the
+# summary file
+SUMMARY_BLOCK_SIZE = 65_536
+
+
+@dataclass
+class RelativeSummary:
+    """Counts of the relatives of each queried individual. Row i of each
+    array is the individual at position i of the ID list that was queried
+
+    Attributes
+    ----------
+    dictionary : IdDictionary
+        dictionary used to convert the closest relatives back to IDs
+
+    ids : list[str]
+        IDs of the queried individuals
+
+    relatedness_values : np.ndarray
+        uint8 array of the estimated relatedness value of each column of
+        counts in ascending order. Missing values are MISSING_RELATEDNESS so
+        they are the last column
+
+    counts : np.ndarray
+        int64 array with a row for each individual and a column for each
+        relatedness value
+
+    closest_relatedness : np.ndarray
+        uint8 array of the closest relatedness of each individual.
+        Individuals without a relative that has a relatedness value have
+        MISSING_RELATEDNESS
+
+    closest_relative : np.ndarray
+        int32 array of the dictionary integer of the closest relative of
+        each individual or -1 if there isn't one
+    """
+
+    dictionary: IdDictionary
+    ids: list[str]
+    relatedness_values: np.ndarray
+    counts: np.ndarray
+    closest_relatedness: np.ndarray
+    closest_relative: np.ndarray
+
+    def relative_counts(self) -> np.ndarray:
+        """Method that returns the total number of relatives of each
+        individual"""
+        return self.counts.sum(axis=1)
+
+
+class _RelativeCounter:
+    """Class that adds up the relatives of the queried individuals one batch
+    of pairs at a time. The counts are kept in a table with a row for each
+    individual and a column for each relatedness value that has been seen,
+    so only the counters are held in memory and not the pairs"""
+
+    def __init__(self, dictionary: IdDictionary, ids: list[str]) -> None:
+        self.dictionary = dictionary
+
+        people = np.frombuffer(dictionary.encode(ids), dtype=np.int32)
+
+        # row of each dictionary integer in the table. IDs that are only
+        # found as relatives with --all-connections don't have a row
+        self.rows = np.full(len(dictionary), -1, dtype=np.int64)
+        self.rows[people] = np.arange(len(people))
+
+        # column of each relatedness value. Columns are added as new values
+        # are found so a table with only a few degrees stays narrow
+        self.columns = np.full(MISSING_RELATEDNESS + 1, -1, dtype=np.int64)
+        self.relatedness_values = np.empty(0, dtype=np.uint8)
+
+        self.counts = np.zeros((len(people), 0), dtype=np.int64)
+        self.closest_relatedness = np.full(
+            len(people), MISSING_RELATEDNESS, dtype=np.uint8
+        )
+        self.closest_relative = np.full(len(people), -1, dtype=np.int32)
+
+    def _add_columns(self, values: np.ndarray) -> None:
+        new_values = np.setdiff1d(values, self.relatedness_values)
+
+        if not len(new_values):
+            return
+
+        self.columns[new_values] = np.arange(
+            len(self.relatedness_values),
+            len(self.relatedness_values) + len(new_values),
+        )
+        self.relatedness_values = np.concatenate([self.relatedness_values, new_values])
+
+        self.counts = np.hstack(
+            [self.counts, np.zeros((len(self.counts), len(new_values)), np.int64)]
+        )
+
+    def add(self, pairs: PairResults) -> None:
+        if pairs.dictionary is not self.dictionary:
+            pairs = pairs.remap(self.dictionary)
+
+        if len(self.dictionary) > len(self.rows):
+            self.rows = np.concatenate(
+                [
+                    self.rows,
+                    np.full(len(self.dictionary) - len(self.rows), -1, np.int64),
+                ]
+            )
+
+        id1, id2, relatedness = pairs.arrays()
+
+        # each pair is a relative of both individuals so it is added once
+        # from each side. The two sides are interleaved so the relatives stay
+        # in the order they were returned. Self pairs are skipped
+        people = np.column_stack([self.rows[id1], self.rows[id2]]).ravel()
+        relatives = np.column_stack([id2, id1]).ravel()
+        values = np.repeat(relatedness, 2)
+
+        keep = (people >= 0) & np.repeat(id1 != id2, 2)
+
+        people, relatives, values = people[keep], relatives[keep], values[keep]
+
+        if not len(people):
+            return
+
+        self._add_columns(np.unique(values))
+
+        # numpy 1.24 doesn't have a fast np.add.at so the counters are
+        # grouped with a sort before they are added to the table
+        cells, cell_counts = np.unique(
+            people * self.counts.shape[1] + self.columns[values], return_counts=True
+        )
+        self.counts.reshape(-1)[cells] += cell_counts
+
+        # the closest relative of each individual in this batch is the first
+        # one after sorting by individual and then relatedness
+        order = np.lexsort((values, people))
+        first = np.empty(len(order), dtype=bool)
+        first[0] = True
+        np.not_equal(people[order[1:]], people[order[:-1]], out=first[1:])
+        order = order[first]
+
+        closer = values[order] < self.closest_relatedness[people[order]]
+        order = order[closer]
+
+        self.closest_relatedness[people[order]] = values[order]
+        self.closest_relative[people[order]] = relatives[order]
+
+    def summary(self, ids: list[str]) -> RelativeSummary:
+        column_order = np.argsort(self.relatedness_values)
+
+        return RelativeSummary(
+            self.dictionary,
+            ids,
+            self.relatedness_values[column_order],
+            self.counts[:, column_order],
+            self.closest_relatedness,
+            self.closest_relative,
+        )
+
+
+@log_msg_debug("Counting the relatives of each individual")
+def summarize_relatives(
+    pairs: Iterable[PairResults],
+    ind_list: list[str],
+    logger: Logger,
+    dictionary: IdDictionary | None = None,
+) -> RelativeSummary:
+    """Function that counts the relatives of each individual at each
+    estimated relatedness value and finds their closest relative in one
+    pass over the pairs. Each batch of pairs is added to integer counters
+    and then dropped so the memory used depends on the number of
+    individuals and not the number of pairs. A pair that is returned twice
+    is counted twice
+
+    Parameters
+    ----------
+    pairs : Iterable[PairResults]
+        batches of pairs such as the results of database.get_relatedness
+
+    ind_list : list[str]
+        list of the individuals to summarize. Every individual in the list
+        has a row in the summary even if they have no relatives. With
+        --all-connections the relatives that aren't in the list are counted
+        but don't get a row
+
+    logger : logging.Logger
+        logging object
+
+    dictionary : IdDictionary | None
+        dictionary that the pairs are encoded with. Passing the dictionary
+        that was given to database.get_relatedness means the pairs don't
+        have to be re-encoded
+
+    Returns
+    -------
+    RelativeSummary
+        returns the counts and closest relative of each individual. If
+        several relatives are equally close then the first one that was
+        returned is used
+    """
+    dictionary = dictionary if dictionary is not None else IdDictionary()
+
+    counter = _RelativeCounter(dictionary, ind_list)
+
+    pair_count = 0
+
+    for batch in pairs:
+        counter.add(batch)
+
+        pair_count += len(batch)
+
+    summary = counter.summary(ind_list)
+
+    logger.info(
+        f"Counted {pair_count} pairs for {len(ind_list)} individuals. {int(np.count_nonzero(summary.relative_counts()))} individuals have at least one relative"
+    )
+
+    return summary
+
+
+def _format_relatedness(value: int) -> str:
+    return "None" if value == MISSING_RELATEDNESS else str(value)
+
+
+def write_relative_summary(
+    summary: RelativeSummary,
+    output_path: Path,
+    compression_level: int | None = None,
+) -> int:
+    """Function that writes one row for each individual with their number of
+    relatives, their closest relatedness and closest relative, and their
+    number of relatives at each relatedness value
+
+    Parameters
+    ----------
+    summary : RelativeSummary
+        summary returned by summarize_relatives
+
+    output_path : Path
+        path to write the tab separated summary to
+
+    compression_level : int | None
+        if this is given then the file is gzip compressed at this level
+
+    Returns
+    -------
+    int
+        returns the number of rows written
+    """
+    header = [
+        "ID",
+        "Relatives",
+        "Closest_relatedness",
+        "Closest_relative",
+        *(
+            f"Relatedness_{_format_relatedness(value)}"
+            for value in summary.relatedness_values.tolist()
+        ),
+    ]
+
+    closest_relatives = np.full(len(summary.ids), "None", dtype=object)
+    has_closest = summary.closest_relative >= 0
+    closest_relatives[has_closest] = summary.dictionary.decode(
+        summary.closest_relative[has_closest]
+    )
+
+    if compression_level is None:
+        output = open(output_path, "w", encoding="utf-8")
+    else:
+        output = gzip.open(
+            output_path, "wt", compresslevel=compression_level, encoding="utf-8"
+        )
+
+    relative_counts = summary.relative_counts().tolist()
+    closest_relatedness = summary.closest_relatedness.tolist()
+
+    with output:
+        output.write("\t".join(header) + "\n")
+
+        for start in range(0, len(summary.ids), SUMMARY_BLOCK_SIZE):
+            end = start + SUMMARY_BLOCK_SIZE
+
+            output.write(
+                "".join(
+                    "\t".join(
+                        [
+                            grid,
+                            str(relatives),
+                            _format_relatedness(closest),
+                            relative,
+                            *map(str, counts),
+                        ]
+                    )
+                    + "\n"
+                    for grid, relatives, closest, relative, counts in zip(
+                        summary.ids[start:end],
+                        relative_counts[start:end],
+                        closest_relatedness[start:end],
+                        closest_relatives[start:end],
+                        summary.counts[start:end].tolist(),
+                    )
+                )
+            )
+
+    return len(summary.ids)
@@ -1 +1,47 @@
-from .database_methods import dbResults, get_relatedness
+from _lazy import lazy_exports
+
+# module that each exported name is defined in. The modules are only imported
+# once one of their names is used so that a command doesn't import numpy or the
+# query code unless it needs them
+_EXPORTS = {
+    "get_batch_relatedness": ".batch_query",
+    "CompiledIndex": ".compiled_index",
+    "compile_database": ".compiled_index",
+    "AdaptiveFetchSize": ".database_methods",
+    "PAIR_CLASSES": ".database_methods",
+    "PROFILE_SETTINGS": ".database_methods",
+    "PairClassCounter": ".database_methods",
+    "build_indexes": ".database_methods",
+    "dbResults": ".database_methods",
+    "get_classified_relatedness": ".database_methods",
+    "get_classified_relatedness_counts": ".database_methods",
+    "get_connection": ".database_methods",
+    "get_relatedness": ".database_methods",
+    "get_relatedness_counts": ".database_methods",
+    "build_sources": ".federation",
+    "get_federated_classified_relatedness": ".federation",
+    "get_federated_classified_relatedness_counts": ".federation",
+    "get_federated_relatedness": ".federation",
+    "merge_sources": ".federation",
+    "Watermark": ".incremental",
+    "get_incremental_relatedness": ".incremental",
+    "read_watermark": ".incremental",
+    "write_watermark": ".incremental",
+    "Backend": ".options",
+    "ConflictResolution": ".options",
+    "ConnectionProfile": ".options",
+    "DEFAULT_CACHE_DIR": ".options",
+    "DEFAULT_CACHE_SIZE": ".options",
+    "IdDictionary": ".pair_results",
+    "MISSING_RELATEDNESS": ".pair_results",
+    "PairChunkWriter": ".pair_results",
+    "PairResults": ".pair_results",
+    "read_pair_chunks": ".pair_results",
+    "read_pair_dictionary": ".pair_results",
+    "ResultCache": ".result_cache",
+    "get_cached_relatedness": ".result_cache",
+}
+
+__all__ = list(_EXPORTS)
+
+__getattr__, __dir__ = lazy_exports(globals(), _EXPORTS)
@@ -0,0 +1,173 @@
+import logging
+from typing import Generator
+
+import numpy as np
+from log import log_msg_debug
+
+from .database_methods import dbResults, get_relatedness
+from .pair_results import IdDictionary, PairResults
+
+# minimum number of pairs to collect from the query before they are routed
+# to the cohorts. Routing is done with one numpy operation per cohort so
+# larger batches keep the per batch overhead small
+ROUTE_BATCH_SIZE = 65_536
+
+
+def build_membership(cohorts: list[list[str]], dictionary: IdDictionary) -> np.ndarray:
+    """Function that encodes the IDs of every cohort into the dictionary and
+    returns a boolean matrix of which cohorts each ID is in
+
+    Parameters
+    ----------
+    cohorts : list[list[str]]
+        list of the IDs in each cohort
+
+    dictionary : IdDictionary
+        dictionary to encode the IDs with
+
+    Returns
+    -------
+    np.ndarray
+        returns a boolean array with a row for each cohort and a column for
+        each ID in the dictionary. There is one extra column that is never
+        set which is used for IDs that are not in any cohort
+    """
+    encoded_cohorts = [dictionary.encode(cohort) for cohort in cohorts]
+
+    membership = np.zeros((len(cohorts), len(dictionary) + 1), dtype=bool)
+
+    for cohort_index, encoded in enumerate(encoded_cohorts):
+        membership[cohort_index, np.frombuffer(encoded, dtype=np.int32)] = True
+
+    return membership
+
+
+def route_pairs(
+    pairs: PairResults, membership: np.ndarray, all_connections: bool = False
+) -> dict[int, PairResults]:
+    """Function that splits a batch of pairs into the pairs for each cohort.
+    A pair can be in several cohorts
+
+    Parameters
+    ----------
+    pairs : PairResults
+        batch of pairs encoded with the dictionary used for the membership
+        matrix
+
+    membership : np.ndarray
+        boolean matrix from build_membership
+
+    all_connections : bool
+        If this is False a pair is in a cohort when both individuals are in
+        the cohort. Otherwise the pair is in a cohort when either individual
+        is in the cohort
+
+    Returns
+    -------
+    dict[int, PairResults]
+        returns a dictionary where the keys are the index of each cohort that
+        has pairs in the batch and the values are those pairs
+    """
+    id1, id2, relatedness = pairs.arrays()
+
+    # IDs that are not in any cohort are added to the dictionary after the
+    # membership matrix is built when all connections are returned, so they
+    # are mapped to the extra column that is never set
+    unset_column = membership.shape[1] - 1
+
+    id1_columns = np.minimum(id1, unset_column)
+    id2_columns = np.minimum(id2, unset_column)
+
+    routed = {}
+
+    for cohort_index, members in enumerate(membership):
+        if all_connections:
+            in_cohort = members[id1_columns] | members[id2_columns]
+        else:
+            in_cohort = members[id1_columns] & members[id2_columns]
+
+        if in_cohort.any():
+            routed[cohort_index] = PairResults.from_arrays(
+                id1[in_cohort], id2[in_cohort], relatedness[in_cohort], pairs.dictionary
+            )
+
+    return routed
+
+
+@log_msg_debug(
+    "Querying the union of the cohorts and routing the pairs to each cohort."
+)
+def get_batch_relatedness(
+    cohorts: list[list[str]],
+    db_obj: dbResults,
+    logger: logging.Logger,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+) -> Generator[dict[int, PairResults], None, None]:
+    """Function that queries the union of the IDs in every cohort once and
+    routes each pair to every cohort that it belongs to. The work done by
+    the database depends on the size of the union rather than the sum of the
+    cohort sizes
+
+    Parameters
+    ----------
+    cohorts : list[list[str]]
+        list of the IDs in each cohort
+
+    db_obj : dbResults
+        object that contains the database path, table name, and backend
+
+    logger : logging.Logger
+        logging object
+
+    all_connections : bool
+        If this is False only the pairs where both individuals are in a cohort
+        are returned for that cohort. Otherwise every pair with at least one
+        individual in the cohort is returned
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query across
+
+    Returns
+    -------
+    Generator[dict[int, PairResults], None, None]
+        returns a generator of dictionaries where the keys are the index of
+        each cohort and the values are the pairs for that cohort
+    """
+    dictionary = IdDictionary()
+
+    membership = build_membership(cohorts, dictionary)
+
+    union_ids = list(dictionary.ids)
+
+    logger.info(
+        f"Querying the union of {len(union_ids)} IDs from {len(cohorts)} cohorts with {sum(len(cohort) for cohort in cohorts)} IDs in total"
+    )
+
+    pending = PairResults(dictionary)
+
+    for batch in get_relatedness(
+        union_ids,
+        db_obj,
+        logger=logger,
+        all_connections=all_connections,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+        dictionary=dictionary,
+    ):
+        # the compiled backend uses the index's dictionary so the pairs are
+        # re-encoded with the dictionary used for the membership matrix
+        pending.extend(batch)
+
+        if len(pending) >= ROUTE_BATCH_SIZE:
+            yield route_pairs(pending, membership, all_connections)
+
+            pending = PairResults(dictionary)
+
+    if len(pending):
+        yield route_pairs(pending, membership, all_connections)
@@ -0,0 +1,566 @@
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Any, Generator
+
+import numpy as np
+from log import log_msg_debug
+
+from .database_methods import (
+    CASE_STATUS,
+    CONTROL_STATUS,
+    PAIR_CLASSES,
+    dbResults,
+    get_connection,
+)
+from .pair_results import MISSING_RELATEDNESS, IdDictionary, PairResults, counts_to_dict
+
+# version of the on-disk format. This is checked when the index is opened so
+# that an index written by an older version is rebuilt instead of misread
+INDEX_FORMAT_VERSION = 1
+
+METADATA_FILE = "metadata.json"
+
+# name of each array file in the index directory. The "out" arrays are keyed
+# by ID1 and hold the ID2 neighbours while the "in" arrays are keyed by ID2
+# and hold the ID1 neighbours. These mirror the two covering indexes that
+# the build-index command creates on the pair table
+ARRAY_FILES = {
+    "ids": "ids.npy",
+    "out_offsets": "out_offsets.npy",
+    "out_neighbors": "out_neighbors.npy",
+    "out_relatedness": "out_relatedness.npy",
+    "in_offsets": "in_offsets.npy",
+    "in_neighbors": "in_neighbors.npy",
+    "in_relatedness": "in_relatedness.npy",
+}
+
+# number of rows to read from the database at a time while compiling
+COMPILE_BATCH_SIZE = 1_000_000
+
+# number of query IDs to gather neighbours for at a time
+QUERY_CHUNK_SIZE = 65_536
+
+
+def _scan_pairs(
+    connection: sqlite3.Connection, table_name: str
+) -> Generator[tuple[list[str], list[str], np.ndarray], None, None]:
+    """Function that will read every pair in the table a batch at a time and
+    return the ID1 and ID2 columns as lists and the relatedness column as a
+    uint8 array with missing values stored as MISSING_RELATEDNESS
+
+    Raises
+    ------
+    ValueError
+        If the table has relatedness values that don't fit in the uint8
+        arrays. MISSING_RELATEDNESS itself is rejected because it would be
+        read back as a missing value
+    """
+    # missing values are read as -1 so that they can be told apart from a
+    # stored value of MISSING_RELATEDNESS
+    cursor = connection.execute(
+        f"SELECT ID1, ID2, COALESCE(estimated_relatedness, -1) FROM {table_name}"
+    )
+
+    while rows := cursor.fetchmany(COMPILE_BATCH_SIZE):
+        id1, id2, relatedness = zip(*rows)
+
+        relatedness = np.array(relatedness, dtype=np.int64)
+        missing = relatedness == -1
+
+        if relatedness.max() >= MISSING_RELATEDNESS or (
+            relatedness[~missing].min(initial=0) < 0
+        ):
+            raise ValueError(
+                f"Found estimated relatedness values outside of the range 0-{MISSING_RELATEDNESS - 1} in the table {table_name}. These values can't be stored in the compiled index"
+            )
+
+        relatedness[missing] = MISSING_RELATEDNESS
+
+        yield list(id1), list(id2), relatedness.astype(np.uint8)
+
+
+def _database_stat(database_path: Path) -> dict[str, int]:
+    """Function that returns the size and modification time of the database
+    file. These are stored with the index so that an index built from an
+    older copy of the database can be detected"""
+    stat = Path(database_path).stat()
+
+    return {"database_size": stat.st_size, "database_mtime_ns": stat.st_mtime_ns}
+
+
+def _encode_ids(ids: np.ndarray, values: list[str]) -> np.ndarray:
+    """Function that will convert a list of IDs into their position in the
+    sorted ID dictionary. Every value has to be in the dictionary"""
+    return np.searchsorted(ids, np.array(values, dtype=ids.dtype)).astype(np.int32)
+
+
+def _fill_adjacency(
+    keys: np.ndarray,
+    neighbors: np.ndarray,
+    relatedness: np.ndarray,
+    cursor: np.ndarray,
+    neighbor_array: np.ndarray,
+    relatedness_array: np.ndarray,
+) -> None:
+    """Function that will write a batch of edges into the CSR arrays. Each
+    edge is written to the next free position for its key which is tracked
+    in the cursor array so the rows don't have to be sorted by key"""
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    unique_keys, first_positions, key_counts = np.unique(
+        sorted_keys, return_index=True, return_counts=True
+    )
+
+    # rank of each edge among the edges in this batch with the same key
+    rank = np.arange(sorted_keys.size) - np.repeat(first_positions, key_counts)
+
+    positions = cursor[sorted_keys] + rank
+
+    neighbor_array[positions] = neighbors[order]
+    relatedness_array[positions] = relatedness[order]
+
+    cursor[unique_keys] += key_counts
+
+
+@log_msg_debug("Compiling the pair table into a memory mapped index")
+def compile_database(
+    db_obj: dbResults, output_dir: Path, logger: logging.Logger
+) -> dict[str, Any]:
+    """Function that will export the pair table into a directory of numpy
+    arrays. IDs are dictionary encoded as integers and the pairs are stored
+    as compressed sparse row (CSR) adjacency arrays keyed on both ID1 and
+    ID2 so that the neighbours of an ID are a slice of an array
+
+    Parameters
+    ----------
+    db_obj : dbResults
+        object that contains the database path and the table name
+
+    output_dir : Path
+        directory to write the index files to. The directory is created if
+        it does not exist
+
+    logger : logging.Logger
+        logging object
+
+    Returns
+    -------
+    dict[str, Any]
+        returns the metadata that was written with the index
+
+    Raises
+    ------
+    ValueError
+        If the table has relatedness values that don't fit in the uint8
+        arrays
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # the database is checked before it is read so that a change made while
+    # the index is compiled also shows up as a mismatch
+    database_stat = _database_stat(db_obj.database_path)
+
+    connection = get_connection(
+        db_obj.database_path, logger=logger, read_only=True, profile=db_obj.profile
+    )
+
+    logger.info(f"Building the ID dictionary for the table {db_obj.table_name}")
+
+    id_rows = connection.execute(
+        f"SELECT ID1 FROM {db_obj.table_name} UNION SELECT ID2 FROM {db_obj.table_name}"
+    ).fetchall()
+
+    ids = np.array(sorted(row[0] for row in id_rows), dtype=str)
+
+    del id_rows
+
+    id_count = ids.size
+
+    logger.info(f"Found {id_count} unique IDs. Counting the pairs for each ID")
+
+    out_degree = np.zeros(id_count, dtype=np.int64)
+    in_degree = np.zeros(id_count, dtype=np.int64)
+
+    for id1, id2, _ in _scan_pairs(connection, db_obj.table_name):
+        out_degree += np.bincount(_encode_ids(ids, id1), minlength=id_count)
+        in_degree += np.bincount(_encode_ids(ids, id2), minlength=id_count)
+
+    pair_count = int(out_degree.sum())
+
+    logger.info(f"Writing {pair_count} pairs to the index at {output_dir}")
+
+    np.save(output_dir / ARRAY_FILES["ids"], ids)
+
+    arrays = {}
+    cursors = {}
+
+    for direction, degree in [("out", out_degree), ("in", in_degree)]:
+        offsets = np.zeros(id_count + 1, dtype=np.int64)
+        np.cumsum(degree, out=offsets[1:])
+
+        np.save(output_dir / ARRAY_FILES[f"{direction}_offsets"], offsets)
+
+        arrays[f"{direction}_neighbors"] = np.lib.format.open_memmap(
+            output_dir / ARRAY_FILES[f"{direction}_neighbors"],
+            mode="w+",
+            dtype=np.int32,
+            shape=(pair_count,),
+        )
+        arrays[f"{direction}_relatedness"] = np.lib.format.open_memmap(
+            output_dir / ARRAY_FILES[f"{direction}_relatedness"],
+            mode="w+",
+            dtype=np.uint8,
+            shape=(pair_count,),
+        )
+
+        cursors[direction] = offsets[:-1].copy()
+
+    for id1, id2, relatedness in _scan_pairs(connection, db_obj.table_name):
+        encoded_id1 = _encode_ids(ids, id1)
+        encoded_id2 = _encode_ids(ids, id2)
+
+        _fill_adjacency(
+            encoded_id1,
+            encoded_id2,
+            relatedness,
+            cursors["out"],
+            arrays["out_neighbors"],
+            arrays["out_relatedness"],
+        )
+        _fill_adjacency(
+            encoded_id2,
+            encoded_id1,
+            relatedness,
+            cursors["in"],
+            arrays["in_neighbors"],
+            arrays["in_relatedness"],
+        )
+
+    connection.close()
+
+    for array in arrays.values():
+        array.flush()
+
+    metadata = {
+        "format_version": INDEX_FORMAT_VERSION,
+        "database_path": str(Path(db_obj.database_path).resolve()),
+        "table_name": db_obj.table_name,
+        "id_count": int(id_count),
+        "pair_count": pair_count,
+        **database_stat,
+    }
+
+    with open(output_dir / METADATA_FILE, "w", encoding="utf-8") as metadata_file:
+        json.dump(metadata, metadata_file, indent=4)
+
+    logger.info(f"Finished compiling the index: {metadata}")
+
+    return metadata
+
+
+class CompiledIndex:
+    """Class that memory maps a compiled index directory and answers the same
+    queries as the sqlite backend using array slices"""
+
+    def __init__(
+        self, index_dir: Path, table_name: str | None = None, logger=None
+    ) -> None:
+        """
+        Parameters
+        ----------
+        index_dir : Path
+            directory that was written by compile_database
+
+        table_name : str | None
+            name of the table the user expects the index to be built from. A
+            warning is logged if the index was built from a different table
+
+        logger : logging.Logger
+            logging object
+
+        Raises
+        ------
+        ValueError
+            If the index was written with a different format version
+        """
+        self.index_dir = Path(index_dir)
+        self.logger = logger or logging.getLogger("__main__")
+
+        with open(self.index_dir / METADATA_FILE, "r", encoding="utf-8") as meta:
+            self.metadata = json.load(meta)
+
+        if self.metadata.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"The index at {self.index_dir} was written with format version {self.metadata.get('format_version')} but this version of the program reads version {INDEX_FORMAT_VERSION}. Rerun the compile command to rebuild the index"
+            )
+
+        if table_name is not None and table_name != self.metadata["table_name"]:
+            self.logger.warning(
+                f"The index at {self.index_dir} was compiled from the table {self.metadata['table_name']} not the table {table_name}"
+            )
+
+        self._check_database()
+
+        for name, filename in ARRAY_FILES.items():
+            setattr(self, name, np.load(self.index_dir / filename, mmap_mode="r"))
+
+        # the results from the index are encoded with the index's own ID
+        # dictionary so the IDs are only converted to strings when written
+        self.dictionary = IdDictionary.from_array(self.ids)
+
+    def _check_database(self) -> None:
+        """Method that logs a warning if the database that the index was
+        compiled from has changed since. Nothing is checked if the database
+        is no longer at the same path"""
+        database_path = Path(self.metadata["database_path"])
+
+        if not database_path.exists():
+            return
+
+        recorded = {
+            key: self.metadata.get(key)
+            for key in ["database_size", "database_mtime_ns"]
+        }
+
+        if recorded != _database_stat(database_path):
+            self.logger.warning(
+                f"The database {database_path} has changed since the index at {self.index_dir} was compiled so the index may be out of date. Rerun the compile command to rebuild the index"
+            )
+
+    @property
+    def id_count(self) -> int:
+        return self.ids.shape[0]
+
+    def encode(self, ind_list: list[str]) -> np.ndarray:
+        """Method that will return the sorted unique index of each ID in the
+        list. IDs that are not in the index have no pairs so they are dropped
+
+        Parameters
+        ----------
+        ind_list : list[str]
+            list of IDs
+
+        Returns
+        -------
+        np.ndarray
+            returns an int32 array of the index of each ID in the dictionary
+        """
+        if not ind_list or self.id_count == 0:
+            return np.zeros(0, dtype=np.int32)
+
+        # The query IDs keep their own string width so that an ID longer than
+        # any ID in the index is not truncated into a false match
+        values = np.unique(np.array(ind_list, dtype=str))
+
+        positions = np.searchsorted(self.ids, values)
+        positions[positions == self.id_count] = 0
+
+        found = self.ids[positions] == values
+
+        return positions[found].astype(np.int32)
+
+    def _gather(
+        self, direction: str, keys: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Method that will gather the edges for each key from either the
+        "out" (ID1) or the "in" (ID2) adjacency arrays
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray, np.ndarray]
+            returns arrays of the key, the neighbour and the relatedness for
+            every edge
+        """
+        offsets = getattr(self, f"{direction}_offsets")
+
+        starts = offsets[keys]
+        lengths = offsets[keys + 1] - starts
+
+        total = int(lengths.sum())
+
+        # building the position of every edge without a python loop. Each
+        # key contributes a run of positions starting at its offset
+        run_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = run_starts + np.arange(total)
+
+        return (
+            np.repeat(keys, lengths),
+            getattr(self, f"{direction}_neighbors")[positions],
+            getattr(self, f"{direction}_relatedness")[positions],
+        )
+
+    def _threshold_mask(
+        self, relatedness: np.ndarray, relatedness_threshold: int
+    ) -> np.ndarray:
+        """Method that returns a mask of the pairs that pass the threshold"""
+        if relatedness_threshold > 0:
+            return relatedness <= relatedness_threshold
+
+        return np.ones(relatedness.shape, dtype=bool)
+
+    def encoded_pairs(
+        self,
+        ind_list: list[str],
+        all_connections: bool = False,
+        relatedness_threshold: int = 0,
+    ) -> Generator[tuple[np.ndarray, np.ndarray, np.ndarray], None, None]:
+        """Method that will find the pairs for a list of IDs and return them
+        as integer arrays a chunk of IDs at a time. The pairs are the same as
+        the ones returned by database.get_relatedness
+
+        Parameters
+        ----------
+        ind_list : list[str]
+            list of individuals to find in the index
+
+        all_connections : bool
+            boolean indicating if the user wishes to identify all connections or just those in the grid file.
+
+        relatedness_threshold : int
+            Pairs with an estimated relatedness higher than this value are
+            removed. A value of 0 keeps every pair
+
+        Returns
+        -------
+        Generator[tuple[np.ndarray, np.ndarray, np.ndarray], None, None]
+            returns a generator of tuples with the encoded ID1, encoded ID2
+            and relatedness arrays
+        """
+        query_ids = self.encode(ind_list)
+
+        members = np.zeros(self.id_count, dtype=bool)
+        members[query_ids] = True
+
+        for start in range(0, query_ids.size, QUERY_CHUNK_SIZE):
+            chunk = query_ids[start : start + QUERY_CHUNK_SIZE]
+
+            id1, id2, relatedness = self._gather("out", chunk)
+
+            keep = self._threshold_mask(relatedness, relatedness_threshold)
+
+            if not all_connections:
+                keep &= members[id2]
+
+            if keep.any():
+                yield id1[keep], id2[keep], relatedness[keep]
+
+            if all_connections:
+                # pairs where only ID2 is in the list. Pairs where ID1 is also
+                # in the list were already returned from the out edges
+                id2, id1, relatedness = self._gather("in", chunk)
+
+                keep = self._threshold_mask(relatedness, relatedness_threshold)
+                keep &= ~members[id1]
+
+                if keep.any():
+                    yield id1[keep], id2[keep], relatedness[keep]
+
+    def get_relatedness(
+        self,
+        ind_list: list[str],
+        all_connections: bool = False,
+        relatedness_threshold: int = 0,
+    ) -> Generator[PairResults, None, None]:
+        """Method that returns the pairs in the same format as
+        database.get_relatedness. The arguments are the same as
+        encoded_pairs"""
+        for id1, id2, relatedness in self.encoded_pairs(
+            ind_list, all_connections, relatedness_threshold
+        ):
+            yield PairResults.from_arrays(id1, id2, relatedness, self.dictionary)
+
+    def get_relatedness_counts(
+        self,
+        ind_list: list[str],
+        all_connections: bool = False,
+        relatedness_threshold: int = 0,
+    ) -> dict[int, int]:
+        """Method that counts the pairs at each relatedness value in the same
+        format as database.get_relatedness_counts. The arguments are the same
+        as encoded_pairs"""
+        counts = np.zeros(MISSING_RELATEDNESS + 1, dtype=np.int64)
+
+        for _, _, relatedness in self.encoded_pairs(
+            ind_list, all_connections, relatedness_threshold
+        ):
+            counts += np.bincount(relatedness, minlength=counts.size)
+
+        return counts_to_dict(counts)
+
+    def encoded_classified_pairs(
+        self,
+        cases: list[str],
+        controls: list[str],
+        relatedness_threshold: int = 0,
+    ) -> Generator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], None, None]:
+        """Method that will find the pairs among the union of the cases and
+        controls and label each pair with its pair class (see PAIR_CLASSES).
+        An ID that is both a case and a control is treated as a case
+
+        Returns
+        -------
+        Generator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], None, None]
+            returns a generator of tuples with the encoded ID1, encoded ID2,
+            relatedness, and pair class arrays
+        """
+        statuses = np.full(self.id_count, -1, dtype=np.int8)
+        statuses[self.encode(controls)] = CONTROL_STATUS
+        statuses[self.encode(cases)] = CASE_STATUS
+
+        query_ids = np.flatnonzero(statuses >= 0).astype(np.int32)
+
+        for start in range(0, query_ids.size, QUERY_CHUNK_SIZE):
+            id1, id2, relatedness = self._gather(
+                "out", query_ids[start : start + QUERY_CHUNK_SIZE]
+            )
+
+            keep = self._threshold_mask(relatedness, relatedness_threshold)
+            keep &= statuses[id2] >= 0
+
+            if keep.any():
+                id1, id2, relatedness = id1[keep], id2[keep], relatedness[keep]
+
+                yield id1, id2, relatedness, statuses[id1] + statuses[id2]
+
+    def get_classified_relatedness(
+        self,
+        cases: list[str],
+        controls: list[str],
+        relatedness_threshold: int = 0,
+    ) -> Generator[PairResults, None, None]:
+        """Method that returns the classified pairs in the same format as
+        database.get_classified_relatedness"""
+        for id1, id2, relatedness, pair_class in self.encoded_classified_pairs(
+            cases, controls, relatedness_threshold
+        ):
+            yield PairResults.from_arrays(
+                id1, id2, relatedness, self.dictionary, pair_class
+            )
+
+    def get_classified_relatedness_counts(
+        self,
+        cases: list[str],
+        controls: list[str],
+        relatedness_threshold: int = 0,
+    ) -> dict[str, dict[int, int]]:
+        """Method that counts the classified pairs in the same format as
+        database.get_classified_relatedness_counts"""
+        bins = MISSING_RELATEDNESS + 1
+
+        counts = np.zeros((len(PAIR_CLASSES), bins), dtype=np.int64)
+
+        for _, _, relatedness, pair_class in self.encoded_classified_pairs(
+            cases, controls, relatedness_threshold
+        ):
+            counts += np.bincount(
+                pair_class.astype(np.int64) * bins + relatedness,
+                minlength=counts.size,
+            ).reshape(counts.shape)
+
+        return {
+            class_name: counts_to_dict(counts[pair_class])
+            for pair_class, class_name in PAIR_CLASSES.items()
+        }
@@ -1,24 +1,276 @@
-import asyncio
 import logging
+import math
+import multiprocessing
+import queue
 import sqlite3
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Generator
+from typing import Any, Generator, Iterator
 
-from log import log_msg_debug
+import numpy as np
+from log import get_logger, log_msg_debug
+
+from .options import Backend, ConnectionProfile
+from .pair_results import MISSING_RELATEDNESS, IdDictionary, PairResults, counts_to_dict
+
+# name of the temporary table that the query IDs are loaded into
+QUERY_ID_TABLE = "query_ids"
+
+# name of the temporary table that holds the IDs for one shard when the
+# query is split across worker processes
+SHARD_ID_TABLE = "shard_ids"
+
+# number of shards to create per worker process. Having more shards than
+# workers keeps all of the workers busy if some shards have more pairs
+SHARDS_PER_WORKER = 4
+
+# status of each individual when cases and controls are queried together.
+# The pair class returned by the query is the sum of the two statuses
+CASE_STATUS = 1
+CONTROL_STATUS = 0
+
+PAIR_CLASSES: dict[int, str] = {
+    2 * CASE_STATUS: "case_case",
+    CASE_STATUS + CONTROL_STATUS: "case_control",
+    2 * CONTROL_STATUS: "control_control",
+}
+
+# connection and settings of each worker process in the pool. The pool
+# initializer opens the connection and loads the full ID list once per
+# process so each shard only has to load its own IDs
+_worker_connection: sqlite3.Connection | None = None
+_worker_statuses: dict[str, int] | None = None
+_worker_profile: ConnectionProfile = ConnectionProfile.DEFAULT
+_worker_queue: Any = None
+
+# number of batches of rows that each worker process can put on the queue
+# before it waits for the results to be read. This keeps the memory used for
+# rows that haven't been read yet bounded no matter how large a shard is
+SHARD_QUEUE_BATCHES = 2
+
+# number of seconds to wait for a batch from the workers before checking if
+# a worker has failed
+_SHARD_POLL_TIMEOUT = 0.1
+
+# start method of the worker processes. This has to be a method that doesn't
+# fork the current process because the query can be run from a thread
+WORKER_START_METHOD = "forkserver"
+
+# alias used for the pair table in the queries. The query plan check looks
+# for this alias to determine if the pair table is being scanned
+PAIR_TABLE_ALIAS = "pairs"
+
+# columns for the covering indexes built by the build-index command. Each
+# index starts with the ID column that the query joins on so that lookups
+# never have to go back to the table itself
+INDEX_COLUMNS: tuple[tuple[str, ...], ...] = (
+    ("ID1", "ID2", "estimated_relatedness"),
+    ("ID2", "ID1", "estimated_relatedness"),
+)
+
+# bounds for the number of rows fetched from the cursor at a time. The fetch
+# size starts small so the first rows are returned quickly and then grows
+# with the observed throughput until a fetch takes about TARGET_FETCH_SECONDS
+# or the batch would use more memory than the profile's fetch budget
+INITIAL_FETCH_SIZE = 1_024
+MIN_FETCH_SIZE = 256
+MAX_FETCH_SIZE = 262_144
+TARGET_FETCH_SECONDS = 0.1
+
+# the fetch size can at most grow by this factor between two fetches so that
+# one unusually fast fetch doesn't create a huge batch
+MAX_FETCH_GROWTH = 4
+
+DEFAULT_FETCH_MEMORY_BUDGET = 16 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class ProfileSettings:
+    """Settings used to open a connection for a connection profile
+
+    Attributes
+    ----------
+    read_only : bool
+        whether to open the database with mode=ro
+
+    immutable : bool
+        whether to open the database with immutable=1. sqlite then skips all
+        locking and change detection so this is only safe if nothing writes
+        to the database while it is open
+
+    pragmas : dict[str, int]
+        pragmas to set on the connection after it is opened
+
+    fetch_memory_budget : int
+        approximate number of bytes that one batch of fetched rows can use
+    """
+
+    read_only: bool = False
+    immutable: bool = False
+    pragmas: dict[str, int] = field(default_factory=dict)
+    fetch_memory_budget: int = DEFAULT_FETCH_MEMORY_BUDGET
+
+
+# The default profile is a plain sqlite connection. The read profiles memory
+# map the database so pages are read straight from the os page cache, give
+# sqlite a larger page cache, keep the temporary ID tables in memory, and
+# set query_only so the connection can't change the database. A negative
+# cache_size is in kibibytes and a temp_store of 2 is MEMORY
+PROFILE_SETTINGS: dict[ConnectionProfile, ProfileSettings] = {
+    ConnectionProfile.DEFAULT: ProfileSettings(),
+    ConnectionProfile.READ: ProfileSettings(
+        read_only=True,
+        pragmas={
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": 2,
+            "query_only": 1,
+        },
+        fetch_memory_budget=64 * 1024 * 1024,
+    ),
+    ConnectionProfile.IMMUTABLE: ProfileSettings(
+        read_only=True,
+        immutable=True,
+        pragmas={
+            "mmap_size": 1024 * 1024 * 1024,
+            "cache_size": -256 * 1024,
+            "temp_store": 2,
+            "query_only": 1,
+        },
+        fetch_memory_budget=256 * 1024 * 1024,
+    ),
+}
 
 
 @dataclass
 class dbResults:
     database_path: Path
     table_name: str
-    case_results: list[Any] = field(default_factory=list)
-    control_results: list[Any] = field(default_factory=list)
+    case_results: PairResults = field(default_factory=PairResults)
+    control_results: PairResults = field(default_factory=PairResults)
+    backend: Backend = Backend.SQLITE
+    # open connection to run the queries on instead of opening a new one for
+    # each query. The serve command uses this to keep its connections warm
+    connection: sqlite3.Connection | None = None
+    profile: ConnectionProfile = ConnectionProfile.DEFAULT
+
+
+class AdaptiveFetchSize:
+    """Class that fetches the rows from a cursor in batches whose size adapts
+    to the observed row throughput. Each full batch sets the next fetch size
+    to the number of rows that can be fetched in about TARGET_FETCH_SECONDS,
+    limited by the memory budget and by how fast the size can grow
+
+    Parameters
+    ----------
+    memory_budget : int
+        approximate number of bytes that one batch of rows can use
+
+    target_seconds : float
+        amount of time that each fetch should take
+
+    initial_size : int
+        number of rows to fetch the first time
+    """
+
+    def __init__(
+        self,
+        memory_budget: int = DEFAULT_FETCH_MEMORY_BUDGET,
+        target_seconds: float = TARGET_FETCH_SECONDS,
+        initial_size: int = INITIAL_FETCH_SIZE,
+    ) -> None:
+        self.memory_budget = memory_budget
+        self.target_seconds = target_seconds
+        self.size = initial_size
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def fetch(self, cursor: sqlite3.Cursor) -> list[tuple[Any, ...]]:
+        """Method that fetches the next batch of rows from the cursor and
+        then adjusts the fetch size. An empty list is returned once the
+        cursor has no more rows"""
+        start = time.perf_counter()
+
+        rows = cursor.fetchmany(self.size)
+
+        elapsed = time.perf_counter() - start
+
+        self.seconds += elapsed
+
+        if rows:
+            self.rows += len(rows)
+            self.batches += 1
+
+        # a batch that is smaller than the fetch size is the last batch so
+        # its throughput doesn't say anything about the next fetch
+        if len(rows) == self.size:
+            self.size = self._next_size(rows, elapsed)
+
+        return rows
+
+    def _next_size(self, rows: list[tuple[Any, ...]], elapsed: float) -> int:
+        row_bytes = sys.getsizeof(rows[0]) + sum(
+            sys.getsizeof(value) for value in rows[0]
+        )
+
+        memory_limit = self.memory_budget // row_bytes
+
+        rows_per_second = len(rows) / max(elapsed, 1e-6)
+
+        next_size = min(
+            int(rows_per_second * self.target_seconds),
+            self.size * MAX_FETCH_GROWTH,
+            memory_limit,
+            MAX_FETCH_SIZE,
+        )
+
+        return max(MIN_FETCH_SIZE, next_size)
+
+    def summary(self) -> str:
+        """Method that describes the batches that have been fetched for the
+        log"""
+        rows_per_second = self.rows / self.seconds if self.seconds else 0.0
+
+        return f"Fetched {self.rows} rows in {self.batches} batches ({rows_per_second:.0f} rows/sec while fetching). The final fetch size was {self.size} rows"
+
+
+def open_compiled_index(db_obj: dbResults, logger: logging.Logger):
+    """Function that will open the compiled index for the compiled backend.
+    The database_path of the dbResults object is the index directory
+
+    Parameters
+    ----------
+    db_obj : dbResults
+        object that contains the index directory and the table name
+
+    logger : logging.Logger
+        logging object
+
+    Returns
+    -------
+    CompiledIndex
+        returns the memory mapped index
+    """
+    # imported here because the compiled_index module imports this module
+    from .compiled_index import CompiledIndex
+
+    logger.info(f"Opening the compiled index at {db_obj.database_path}")
+
+    return CompiledIndex(db_obj.database_path, db_obj.table_name, logger)
 
 
 @log_msg_debug("Attempting to connect to the database")
 def get_connection(
-    db: Path, logger: logging.Logger = logging.getLogger("__main__")
+    db: Path,
+    logger: logging.Logger = logging.getLogger("__main__"),
+    read_only: bool = False,
+    check_same_thread: bool = True,
+    profile: ConnectionProfile = ConnectionProfile.DEFAULT,
 ) -> sqlite3.Connection:
     """Function to connect to the database
 
@@ -30,6 +282,21 @@ def get_connection(
     logger : logging.Logger
         logging object
 
+    read_only : bool
+        whether to open the database with mode=ro. Temporary tables can still
+        be created on a read only connection
+
+    check_same_thread : bool
+        whether sqlite should raise an error if the connection is used by a
+        thread other than the one that created it. This can be turned off for
+        connections that are shared between threads one at a time
+
+    profile : ConnectionProfile
+        connection profile from PROFILE_SETTINGS that sets how the database
+        is opened and the pragmas used on the connection. The database is
+        opened read only if either read_only is True or the profile is read
+        only
+
     Returns
     -------
     sqlite3.Connection
@@ -44,62 +311,832 @@ def get_connection(
 
     logger.info(f"Attempting to connect to the database at {db}")
 
-    conn = sqlite3.connect(db)
+    settings = PROFILE_SETTINGS[profile]
+
+    if read_only or settings.read_only:
+        uri = f"{Path(db).resolve().as_uri()}?mode=ro"
+
+        if settings.immutable:
+            uri += "&immutable=1"
+
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db, check_same_thread=check_same_thread)
+
+    for pragma, value in settings.pragmas.items():
+        conn.execute(f"PRAGMA {pragma} = {int(value)}")
 
     logger.info(f"Successfully connected to the database at {db}")
 
+    if settings.pragmas:
+        # the values are read back because sqlite can limit them, such as
+        # the mmap_size which is capped at compile time
+        applied = {
+            pragma: conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in settings.pragmas
+        }
+
+        logger.info(
+            f"Using the {profile.value} connection profile with the pragmas: {applied}"
+        )
+
     return conn
 
 
-def construct_query_str(
-    grid_list: list[str], db_obj: dbResults, all_connections: bool, logger: logging.Logger
-) -> str:
-    """Function that will construct the sql string to use in the query
+@contextmanager
+def _allow_temp_writes(connection: sqlite3.Connection) -> Iterator[None]:
+    """Context manager that turns off query_only while the temporary ID
+    tables are loaded. sqlite treats writes to temporary tables as writes so
+    they are blocked on query_only connections. The main database is still
+    protected by mode=ro on the read only profiles"""
+    query_only = connection.execute("PRAGMA query_only").fetchone()[0]
+
+    if query_only:
+        connection.execute("PRAGMA query_only = 0")
+
+    try:
+        yield
+    finally:
+        if query_only:
+            connection.execute("PRAGMA query_only = 1")
+
+
+def load_query_ids(
+    connection: sqlite3.Connection,
+    grid_list: list[str],
+    logger: logging.Logger,
+    table_name: str = QUERY_ID_TABLE,
+    statuses: dict[str, int] | None = None,
+) -> None:
+    """Function that will bulk load the IDs into an indexed temporary table so
+    that the pair table can be joined against it instead of pasting every ID
+    into the query string
 
     Parameters
     ----------
+    connection : sqlite3.Connection
+        connection to the database. The temporary table only exists for the
+        lifetime of this connection
+
     grid_list : list[str]
         list of IDs that will be used in the query
 
+    logger : logging.Logger
+        logger object to keep track of the state of the program
+
+    table_name : str
+        name of the temporary table to load the IDs into
+
+    statuses : dict[str, int] | None
+        dictionary of the case/control status for each ID. IDs missing from
+        the dictionary (or every ID if no dictionary is given) are loaded as
+        cases
+    """
+    statuses = statuses or {}
+
+    with _allow_temp_writes(connection):
+        connection.execute(f"DROP TABLE IF EXISTS temp.{table_name}")
+        # Using the ID as the primary key of a WITHOUT ROWID table means that
+        # the table itself is the index so the joins are just b-tree lookups
+        connection.execute(
+            f"CREATE TEMP TABLE {table_name} (grid TEXT PRIMARY KEY, status INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        connection.executemany(
+            f"INSERT OR IGNORE INTO temp.{table_name} (grid, status) VALUES (?, ?)",
+            ((grid, statuses.get(grid, CASE_STATUS)) for grid in grid_list),
+        )
+
+    logger.debug(f"Loaded {len(grid_list)} IDs into the temporary table {table_name}")
+
+
+def construct_filter_str(
+    relatedness_threshold: int = 0,
+    min_row_id: int | None = None,
+    max_row_id: int | None = None,
+) -> tuple[str, list[Any]]:
+    """Function that will construct the row filters for the query so that
+    sqlite removes unwanted pairs before they are returned to python
+
+    Parameters
+    ----------
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed. A value of 0 keeps every pair
+
+    min_row_id : int | None
+        only rows with a rowid greater than this value are kept
+
+    max_row_id : int | None
+        only rows with a rowid less than or equal to this value are kept
+
+    Returns
+    -------
+    tuple[str, list[Any]]
+        returns a string of the conditions joined with AND (this string is
+        empty if there are no filters) and the list of parameters for the
+        placeholders in those conditions
+    """
+    conditions = []
+    parameters = []
+
+    if relatedness_threshold > 0:
+        conditions.append(f"{PAIR_TABLE_ALIAS}.estimated_relatedness <= ?")
+        parameters.append(relatedness_threshold)
+
+    if min_row_id is not None:
+        conditions.append(f"{PAIR_TABLE_ALIAS}.rowid > ?")
+        parameters.append(min_row_id)
+
+    if max_row_id is not None:
+        conditions.append(f"{PAIR_TABLE_ALIAS}.rowid <= ?")
+        parameters.append(max_row_id)
+
+    return " AND ".join(conditions), parameters
+
+
+def _where_clause(*conditions: str) -> str:
+    """Function that will join the conditions that aren't empty into a where
+    clause. An empty string is returned if every condition is empty so that
+    the query has no where clause"""
+    conditions = [condition for condition in conditions if condition]
+
+    if not conditions:
+        return ""
+
+    return f" WHERE {' AND '.join(conditions)}"
+
+
+def construct_query_str(
+    db_obj: dbResults,
+    all_connections: bool,
+    logger: logging.Logger,
+    relatedness_threshold: int = 0,
+    driver_table: str = QUERY_ID_TABLE,
+    count_by_relatedness: bool = False,
+    classify_pairs: bool = False,
+    min_row_id: int | None = None,
+    max_row_id: int | None = None,
+) -> tuple[str, list[Any]]:
+    """Function that will construct the sql string to use in the query. The
+    query joins the pair table against the temporary table of IDs created by
+    load_query_ids
+
+    Parameters
+    ----------
     db_obj: dbResults
         object that will have the results for the relatedness for cases and controls
-    
+
     all_connections : bool
         boolean indicating if the user wishes to identify all connections or just those in the grid file. This will differentiate the query between an AND or OR
 
     logger : logging.Logger
         logger object to keep track of the state of the program
 
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    driver_table : str
+        temporary table whose IDs are looked up in the ID1 column (and in the
+        ID2 column for all connections). Each pair is returned by the shard
+        that holds its ID1 value (or its ID2 value if ID1 is not in the list)
+        so shards never return the same pair. Defaults to the full ID list
+
+    count_by_relatedness : bool
+        whether to group the pairs by estimated_relatedness so that the query
+        returns (estimated_relatedness, count) rows instead of the pairs
+
+    classify_pairs : bool
+        whether to add a pair_class column that is the sum of the statuses of
+        the two IDs (see PAIR_CLASSES). If count_by_relatedness is also True
+        then the query returns (pair_class, estimated_relatedness, count)
+        rows. Only pairs where both IDs are in the list can be classified so
+        this can't be used with all_connections
+
+    min_row_id : int | None
+        only pairs with a rowid greater than this value are returned. If
+        this is given then the query walks the rowid range of the pair table
+        and looks each pair up in the ID table, so the time it takes depends
+        on the number of rows past min_row_id rather than on the whole table.
+        This is used to refresh previous results with the rows that have
+        been appended since
+
+    max_row_id : int | None
+        only pairs with a rowid less than or equal to this value are returned
+
     Returns
     -------
-    str
-        returns a string to use in the where clause
+    tuple[str, list[Any]]
+        returns the query string to execute and the parameters for the
+        placeholders in the query
+
+    Raises
+    ------
+    ValueError
+        If classify_pairs and all_connections are both True
     """
-    grid_str = "('"
+    if classify_pairs and all_connections:
+        raise ValueError(
+            "Pairs can only be classified as cases or controls when both IDs are in the ID list. The all_connections option can't be used when classifying pairs"
+        )
+
+    # The CROSS JOIN forces sqlite to loop over the ID table and look up
+    # each ID in the pair table rather than scanning the pair table
+    pairs = PAIR_TABLE_ALIAS
 
-    grid_str += "', '".join(grid_list)
+    # only the columns that are written to the output are selected
+    columns = f"{pairs}.ID1, {pairs}.ID2, {pairs}.estimated_relatedness"
 
-    grid_str += "')"
+    filter_str, filter_params = construct_filter_str(
+        relatedness_threshold, min_row_id, max_row_id
+    )
 
-    # This will be the query string that we execute
-    if all_connections:
+    if min_row_id is not None:
+        # The pair table drives the query here so that only the new rows are
+        # read. The filter starts with the rowid range which sqlite uses to
+        # seek to the first new row
+        if all_connections:
+            id_filter = (
+                f"{pairs}.ID1 IN (SELECT grid FROM {driver_table})"
+                f" OR ({pairs}.ID2 IN (SELECT grid FROM {driver_table})"
+                f" AND {pairs}.ID1 NOT IN (SELECT grid FROM {QUERY_ID_TABLE}))"
+            )
+            sql_str = (
+                f"SELECT {columns} FROM {db_obj.table_name} AS {pairs}"
+                f"{_where_clause(filter_str, f'({id_filter})')};"
+            )
+        else:
+            pair_class = (
+                ", ids.status + other.status AS pair_class" if classify_pairs else ""
+            )
+            sql_str = (
+                f"SELECT {columns}{pair_class} FROM {db_obj.table_name} AS {pairs}"
+                f" CROSS JOIN {driver_table} AS ids ON ids.grid = {pairs}.ID1"
+                f" CROSS JOIN {QUERY_ID_TABLE} AS other ON other.grid = {pairs}.ID2"
+                f"{_where_clause(filter_str)};"
+            )
+        parameters = filter_params
+    elif classify_pairs:
+        # joining the ID table a second time on ID2 both restricts the pairs
+        # to the ID list and gives the status of the second individual
+        sql_str = (
+            f"SELECT {columns}, ids.status + other.status AS pair_class"
+            f" FROM {driver_table} AS ids"
+            f" CROSS JOIN {db_obj.table_name} AS {pairs} ON {pairs}.ID1 = ids.grid"
+            f" CROSS JOIN {QUERY_ID_TABLE} AS other ON other.grid = {pairs}.ID2"
+            f"{_where_clause(filter_str)};"
+        )
+        parameters = filter_params
+    elif all_connections:
+        # The second half of the union only picks up pairs where ID1 is not
+        # in the ID list so that pairs with both IDs in the list are not
+        # returned twice
         sql_str = (
-            "SELECT * FROM "
-            + db_obj.table_name
-            + f" WHERE ID1 in {grid_str}"
-            + f" OR ID2 in {grid_str};"
+            f"SELECT {columns} FROM {driver_table} AS ids"
+            f" CROSS JOIN {db_obj.table_name} AS {pairs} ON {pairs}.ID1 = ids.grid"
+            f"{_where_clause(filter_str)}"
+            " UNION ALL"
+            f" SELECT {columns} FROM {driver_table} AS ids"
+            f" CROSS JOIN {db_obj.table_name} AS {pairs} ON {pairs}.ID2 = ids.grid"
+            f"{_where_clause(f'{pairs}.ID1 NOT IN (SELECT grid FROM {QUERY_ID_TABLE})', filter_str)};"
         )
+        parameters = filter_params * 2
     else:
+        # ID2 is restricted with a join rather than an IN subquery. With the
+        # subquery sqlite can choose the (ID2, ID1) index and loop over every
+        # ID in the list for every driver ID, which grows with the square of
+        # the number of IDs
+        sql_str = (
+            f"SELECT {columns} FROM {driver_table} AS ids"
+            f" CROSS JOIN {db_obj.table_name} AS {pairs} ON {pairs}.ID1 = ids.grid"
+            f" CROSS JOIN {QUERY_ID_TABLE} AS other ON other.grid = {pairs}.ID2"
+            f"{_where_clause(filter_str)};"
+        )
+        parameters = filter_params
+
+    if count_by_relatedness:
+        group_columns = (
+            "pair_class, estimated_relatedness"
+            if classify_pairs
+            else "estimated_relatedness"
+        )
+
         sql_str = (
-            "SELECT * FROM "
-            + db_obj.table_name
-            + f" WHERE ID1 in {grid_str}"
-            + f" AND ID2 in {grid_str};"
+            f"SELECT {group_columns}, COUNT(*) FROM"
+            f" ({sql_str.rstrip(';')}) GROUP BY {group_columns};"
         )
 
     logger.debug(f"String used for SQL Query: \n {sql_str}")
+    logger.debug(f"Parameters used for SQL Query: {parameters}")
+
+    return sql_str, parameters
+
+
+def check_query_plan(
+    connection: sqlite3.Connection,
+    query: str,
+    logger: logging.Logger,
+    parameters: list[Any] | None = None,
+) -> bool:
+    """Function that will run EXPLAIN QUERY PLAN for the query and warn the
+    user if sqlite is going to scan the whole pair table. This happens if
+    the indexes from the build-index command are missing.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        connection to the database. The temporary ID table should already be
+        loaded on this connection
+
+    query : str
+        query string that is going to be executed
+
+    logger : logging.Logger
+        logging object
+
+    parameters : list[Any] | None
+        parameters for the placeholders in the query
+
+    Returns
+    -------
+    bool
+        returns True if every lookup on the pair table uses an index and False
+        if the query will scan the pair table
+    """
+    plan = [
+        row[-1]
+        for row in connection.execute(f"EXPLAIN QUERY PLAN {query}", parameters or [])
+    ]
+
+    logger.debug("Query plan:\n" + "\n".join(plan))
+
+    # A full scan shows up as "SCAN pairs" while a lookup without a usable
+    # index shows up as sqlite building an automatic index which also reads
+    # the whole table
+    full_scans = [
+        detail
+        for detail in plan
+        if detail.startswith(f"SCAN {PAIR_TABLE_ALIAS}")
+        or (PAIR_TABLE_ALIAS in detail.split() and "AUTOMATIC" in detail)
+    ]
+
+    if full_scans:
+        logger.warning(
+            f"WARNING: the query will do a full table scan of the pair table ({'; '.join(full_scans)}). This can take hours on large tables. Run the build-index command on the database to create the indexes the query needs."
+        )
+        return False
+
+    return True
+
+
+@log_msg_debug("Building covering indexes on the pair table")
+def build_indexes(db_obj: dbResults, logger: logging.Logger) -> list[str]:
+    """Function that will create the covering indexes on the pair table that
+    the queries rely on and then run ANALYZE so that sqlite has statistics
+    to plan with.
+
+    Parameters
+    ----------
+    db_obj : dbResults
+        object that contains the database path and the table name
+
+    logger : logging.Logger
+        logging object
 
-    return sql_str
+    Returns
+    -------
+    list[str]
+        returns a list of the index names that exist on the table after the
+        indexes are built
+
+    Raises
+    ------
+    sqlite3.Error
+        If the index could not be created or one of the indexes is missing
+        after it was built
+    """
+    connection = get_connection(db_obj.database_path, logger=logger)
+
+    index_names = []
+
+    with connection:
+        for columns in INDEX_COLUMNS:
+            index_name = "_".join([db_obj.table_name, *columns, "idx"])
+
+            logger.info(
+                f"Creating the index {index_name} on the columns {', '.join(columns)}"
+            )
+
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON {db_obj.table_name} ({', '.join(columns)})"
+            )
+
+            index_names.append(index_name)
+
+        logger.info(f"Running ANALYZE on the table {db_obj.table_name}")
+
+        connection.execute(f"ANALYZE {db_obj.table_name}")
+
+        # checking that each index exists and has the right column order
+        for index_name, columns in zip(index_names, INDEX_COLUMNS):
+            index_columns = tuple(
+                row[2] for row in connection.execute(f"PRAGMA index_info({index_name})")
+            )
+
+            if index_columns != columns:
+                raise sqlite3.Error(
+                    f"Expected the index {index_name} to have the columns {columns} but found {index_columns}"
+                )
+
+    connection.close()
+
+    logger.info(f"Indexes on the table {db_obj.table_name}: {', '.join(index_names)}")
+
+    return index_names
+
+
+def split_into_shards(ind_list: list[str], shard_count: int) -> list[list[str]]:
+    """Function that will split the IDs into roughly equal shards. The IDs
+    are sorted first so that each shard reads a contiguous part of the index
+
+    Parameters
+    ----------
+    ind_list : list[str]
+        list of individuals to split
+
+    shard_count : int
+        number of shards to create. Fewer shards are returned if there are
+        fewer IDs than shards
+
+    Returns
+    -------
+    list[list[str]]
+        returns a list of shards where each shard is a list of IDs
+    """
+    sorted_ids = sorted(set(ind_list))
+
+    shard_size = max(1, math.ceil(len(sorted_ids) / max(1, shard_count)))
+
+    return [
+        sorted_ids[start : start + shard_size]
+        for start in range(0, len(sorted_ids), shard_size)
+    ]
+
+
+def split_row_range(
+    min_row_id: int, max_row_id: int, shard_count: int
+) -> list[tuple[int, int]]:
+    """Function that will split the rowids after min_row_id up to and
+    including max_row_id into roughly equal ranges. Each range reads a
+    contiguous part of the pair table
+
+    Parameters
+    ----------
+    min_row_id : int
+        rowid of the last row that was already read
+
+    max_row_id : int
+        rowid of the last row to read
+
+    shard_count : int
+        number of ranges to create. Fewer ranges are returned if there are
+        fewer rows than ranges
+
+    Returns
+    -------
+    list[tuple[int, int]]
+        returns a list of (min_row_id, max_row_id) tuples with the same
+        meaning as the arguments
+    """
+    range_size = max(1, math.ceil((max_row_id - min_row_id) / max(1, shard_count)))
+
+    return [
+        (start, min(start + range_size, max_row_id))
+        for start in range(min_row_id, max_row_id, range_size)
+    ]
+
+
+def _init_worker(
+    database_path: Path,
+    profile: ConnectionProfile,
+    ind_list: list[str],
+    statuses: dict[str, int] | None,
+    row_queue: Any,
+) -> None:
+    """Initializer for the worker processes that opens a read only
+    connection to the database and loads the full ID list into the
+    temporary ID table. The connection is reused for every shard that the
+    process queries and is closed when the process exits"""
+    global _worker_connection, _worker_statuses, _worker_profile, _worker_queue
+
+    logger = get_logger(__name__)
+
+    _worker_connection = get_connection(
+        database_path, logger=logger, read_only=True, profile=profile
+    )
+
+    load_query_ids(_worker_connection, ind_list, logger, statuses=statuses)
+
+    _worker_statuses = statuses
+    _worker_profile = profile
+    _worker_queue = row_queue
+
+
+def _query_shard(
+    shard_index: int,
+    query: str,
+    parameters: list[Any],
+    shard: list[str] | None,
+) -> int:
+    """Function that runs in a worker process and puts the rows owned by one
+    shard on the row queue a batch at a time as (shard index, rows).
+    (shard index, None) is always put on the queue once the shard is done,
+    even if the query fails
+
+    Parameters
+    ----------
+    shard_index : int
+        index of the shard that is returned with each batch
+
+    query : str
+        query string from construct_query_str that uses the shard table as
+        the driver table
+
+    parameters : list[Any]
+        parameters for the placeholders in the query
+
+    shard : list[str] | None
+        list of IDs in this shard. This is None if the shard is a range of
+        rowids, in which case the range is in the parameters and the query
+        uses every ID from the query ID table
+
+    Returns
+    -------
+    int
+        returns the number of rows returned by the query for this shard
+    """
+    logger = get_logger(__name__)
+
+    row_count = 0
+
+    try:
+        if shard is not None:
+            load_query_ids(
+                _worker_connection,
+                shard,
+                logger,
+                table_name=SHARD_ID_TABLE,
+                statuses=_worker_statuses,
+            )
+
+        cursor = _worker_connection.execute(query, parameters)
+
+        fetch_size = AdaptiveFetchSize(
+            PROFILE_SETTINGS[_worker_profile].fetch_memory_budget
+        )
+
+        while rows := fetch_size.fetch(cursor):
+            _worker_queue.put((shard_index, rows))
+
+            row_count += len(rows)
+    finally:
+        _worker_queue.put((shard_index, None))
+
+    return row_count
+
+
+def _run_query_parallel(
+    ind_list: list[str],
+    db_obj: dbResults,
+    logger: logging.Logger,
+    all_connections: bool,
+    relatedness_threshold: int,
+    workers: int,
+    count_by_relatedness: bool,
+    statuses: dict[str, int] | None,
+    classify_pairs: bool,
+    min_row_id: int | None = None,
+    max_row_id: int | None = None,
+) -> Generator[list[tuple[Any, ...]], None, None]:
+    """Function that splits the query into shards and queries the shards
+    across a pool of processes. The shards are sets of IDs, or ranges of
+    rowids when both min_row_id and max_row_id are given. Each pair is owned
+    by exactly one shard so the batches from each shard can be returned as
+    they arrive without duplicates. The workers send the rows back a batch
+    at a time over a bounded queue so a worker never holds more than a few
+    batches no matter how many pairs a shard has. Parameters are the same as
+    _run_query"""
+    id_shards = split_into_shards(ind_list, workers * SHARDS_PER_WORKER)
+
+    if not id_shards:
+        return
+
+    split_rows = min_row_id is not None and max_row_id is not None
+
+    query, parameters = construct_query_str(
+        db_obj,
+        all_connections,
+        logger,
+        relatedness_threshold,
+        driver_table=QUERY_ID_TABLE if split_rows else SHARD_ID_TABLE,
+        count_by_relatedness=count_by_relatedness,
+        classify_pairs=classify_pairs,
+        min_row_id=min_row_id,
+        max_row_id=max_row_id,
+    )
+
+    # each shard is the parameters of its query and its IDs
+    if split_rows:
+        # The pair table drives the query when there is a rowid range so a
+        # shard of IDs would still read every new row. The new rows are
+        # split instead and every shard uses all of the IDs. The rowid range
+        # is the only filter with parameters in this query besides the
+        # relatedness threshold so the parameters are the filter's
+        shards = [
+            (construct_filter_str(relatedness_threshold, low, high)[1], None)
+            for low, high in split_row_range(
+                min_row_id, max_row_id, workers * SHARDS_PER_WORKER
+            )
+        ]
+    else:
+        shards = [(parameters, shard) for shard in id_shards]
+
+    if not shards:
+        return
+
+    # The query plan only has to be checked once so it is done here on a
+    # small set of IDs rather than in every worker
+    connection = get_connection(
+        db_obj.database_path, logger=logger, read_only=True, profile=db_obj.profile
+    )
+
+    with connection:
+        load_query_ids(connection, id_shards[0], logger, statuses=statuses)
+        load_query_ids(
+            connection,
+            id_shards[0],
+            logger,
+            table_name=SHARD_ID_TABLE,
+            statuses=statuses,
+        )
+        check_query_plan(connection, query, logger, parameters)
+
+    connection.close()
+
+    logger.info(
+        f"Querying {len(shards)} shards of {'rows' if split_rows else 'IDs'} across {workers} worker processes"
+    )
+
+    # the workers are started by a forkserver instead of being forked from
+    # this process because this process can have other threads running
+    # (such as the readers of the other databases or the --pipeline reader)
+    # and forking while another thread holds a lock can deadlock the child
+    context = multiprocessing.get_context(WORKER_START_METHOD)
+    row_queue = context.Queue(workers * SHARD_QUEUE_BATCHES)
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(db_obj.database_path, db_obj.profile, ind_list, statuses, row_queue),
+    ) as executor:
+        remaining_shards = enumerate(shards)
+        in_flight: dict[int, Future] = {}
+
+        def submit_next() -> None:
+            shard_index, (shard_parameters, shard) = next(
+                remaining_shards, (None, (None, None))
+            )
+
+            if shard_index is not None:
+                in_flight[shard_index] = executor.submit(
+                    _query_shard, shard_index, query, shard_parameters, shard
+                )
+
+        # Only a couple of shards per worker are submitted at a time so that
+        # the workers move on to the next shard as soon as one is finished
+        for _ in range(workers * 2):
+            submit_next()
+
+        try:
+            while in_flight:
+                try:
+                    shard_index, rows = row_queue.get(timeout=_SHARD_POLL_TIMEOUT)
+                except queue.Empty:
+                    # a worker that fails before it starts a shard (such as
+                    # when the database can't be opened) never sends the
+                    # end of the shard so the futures are checked for errors
+                    for future in in_flight.values():
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    continue
+
+                if rows is None:
+                    row_count = in_flight.pop(shard_index).result()
+
+                    logger.debug(f"Shard returned {row_count} rows")
+
+                    submit_next()
+                else:
+                    yield rows
+        finally:
+            # if the results stop being read early (or a shard fails) the
+            # shards that haven't started are cancelled and the queue is
+            # drained until the running shards finish so that no worker is
+            # left waiting on a full queue when the pool shuts down
+            for future in in_flight.values():
+                future.cancel()
+
+            running = {
+                shard_index
+                for shard_index, future in in_flight.items()
+                if not future.cancelled()
+            }
+
+            while running:
+                try:
+                    shard_index, rows = row_queue.get(timeout=_SHARD_POLL_TIMEOUT)
+                except queue.Empty:
+                    if all(in_flight[shard_index].done() for shard_index in running):
+                        break
+                    continue
+
+                if rows is None:
+                    running.discard(shard_index)
+
+
+def _run_query(
+    ind_list: list[str],
+    db_obj: dbResults,
+    logger: logging.Logger,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    count_by_relatedness: bool = False,
+    statuses: dict[str, int] | None = None,
+    classify_pairs: bool = False,
+    min_row_id: int | None = None,
+    max_row_id: int | None = None,
+) -> Generator[list[tuple[Any, ...]], None, None]:
+    """Function that will load the IDs, check the query plan and then execute
+    the query either on a single connection or across a pool of processes.
+    The arguments are described in get_relatedness, load_query_ids, and
+    construct_query_str
+
+    Returns
+    -------
+    Generator[list[tuple[Any, ...]], None, None]
+        returns a generator of lists of rows returned by the query
+    """
+    if workers > 1:
+        yield from _run_query_parallel(
+            ind_list,
+            db_obj,
+            logger,
+            all_connections,
+            relatedness_threshold,
+            workers,
+            count_by_relatedness,
+            statuses,
+            classify_pairs,
+            min_row_id,
+            max_row_id,
+        )
+        return
+
+    # we need to get the database connection
+    connection = db_obj.connection or get_connection(
+        db_obj.database_path, logger=logger, profile=db_obj.profile
+    )
+
+    # we need to then create the query string
+    query, parameters = construct_query_str(
+        db_obj,
+        all_connections,
+        logger,
+        relatedness_threshold,
+        count_by_relatedness=count_by_relatedness,
+        classify_pairs=classify_pairs,
+        min_row_id=min_row_id,
+        max_row_id=max_row_id,
+    )
+
+    with connection:
+        load_query_ids(connection, ind_list, logger, statuses=statuses)
+
+        check_query_plan(connection, query, logger, parameters)
+
+        cursor = connection.cursor()
+
+        fetch_size = AdaptiveFetchSize(
+            PROFILE_SETTINGS[db_obj.profile].fetch_memory_budget
+        )
+
+        cursor.execute(query, parameters)
+        while rows := fetch_size.fetch(cursor):
+            yield rows
+
+        logger.info(fetch_size.summary())
 
 
 @log_msg_debug("Executing query to get the relatedness for a list of individuals.")
@@ -107,8 +1144,13 @@ def get_relatedness(
     ind_list: list[str],
     db_obj: dbResults,
     logger: logging.Logger,
-    all_connections: bool = False
-) -> Generator[list[tuple[int, str, str, int]], None, None]:
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    dictionary: IdDictionary | None = None,
+    min_row_id: int | None = None,
+    max_row_id: int | None = None,
+) -> Generator[PairResults, None, None]:
     """Function that will execute the query and return a generator
     object that has so many rows at a time
 
@@ -127,20 +1169,295 @@ def get_relatedness(
     logger : logging.Logger
         logging object
 
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query across. If this value is 1
+        then the query is run on a single connection
+
+    dictionary : IdDictionary | None
+        dictionary to encode the IDs with. Every batch from the query shares
+        this dictionary. A new dictionary is created if one isn't given. This
+        is ignored by the compiled backend which uses the index's dictionary
+
+    min_row_id : int | None
+        only pairs with a rowid greater than this value are returned. This
+        is used to read the rows appended since a previous run (see
+        get_incremental_relatedness)
+
+    max_row_id : int | None
+        only pairs with a rowid less than or equal to this value are returned
+
     Returns
     -------
-    Generator[list[tuple[int, str, str, int]], None, None]
-        returns a generator of list where the list contains all the information in the database row such as id, id1, id2, and the estimated_relatedness
+    Generator[PairResults, None, None]
+        returns a generator of PairResults where each batch has the id1, id2, and the estimated_relatedness for the pairs
     """
-    # we need to get the database connection
-    connection = get_connection(db_obj.database_path, logger=logger)
+    if db_obj.backend == Backend.COMPILED:
+        if min_row_id is not None or max_row_id is not None:
+            raise ValueError(
+                "The compiled backend doesn't store the rowids of the pairs so it can't be queried for a range of rows"
+            )
 
-    # we need to then create the query string
-    query = construct_query_str(ind_list, db_obj, all_connections, logger)
+        yield from open_compiled_index(db_obj, logger).get_relatedness(
+            ind_list, all_connections, relatedness_threshold
+        )
+        return
 
-    with connection:
-        cursor = connection.cursor()
+    dictionary = dictionary if dictionary is not None else IdDictionary()
 
-        cursor.execute(query)
-        while rows := cursor.fetchmany(size=40):
-            yield rows
+    for rows in _run_query(
+        ind_list,
+        db_obj,
+        logger,
+        all_connections=all_connections,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+        min_row_id=min_row_id,
+        max_row_id=max_row_id,
+    ):
+        yield PairResults.from_rows(rows, dictionary)
+
+
+@log_msg_debug("Counting the number of pairs at each estimated relatedness value.")
+def get_relatedness_counts(
+    ind_list: list[str],
+    db_obj: dbResults,
+    logger: logging.Logger,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+) -> dict[int, int]:
+    """Function that will count the pairs at each estimated relatedness value
+    inside of sqlite so that the individual pairs never have to be returned
+    to python
+
+    Parameters
+    ----------
+
+    ind_list : list[str]
+        list of individuals to find in the database
+
+    db_obj : dbResults
+        object that contains the database path and the table name
+
+    logger : logging.Logger
+        logging object
+
+    all_connections : bool
+        boolean indicating if the user wishes to identify all connections or just those in the grid file. This will differentiate the query between an AND or OR
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query across. Each shard returns its
+        own counts which are added together
+
+    Returns
+    -------
+    dict[int, int]
+        returns a dictionary where the keys are the estimated relatedness
+        values and the values are the number of pairs with that value
+    """
+    if db_obj.backend == Backend.COMPILED:
+        return open_compiled_index(db_obj, logger).get_relatedness_counts(
+            ind_list, all_connections, relatedness_threshold
+        )
+
+    counts: dict[int, int] = {}
+
+    for rows in _run_query(
+        ind_list,
+        db_obj,
+        logger,
+        all_connections=all_connections,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+        count_by_relatedness=True,
+    ):
+        for relatedness, count in rows:
+            counts[relatedness] = counts.get(relatedness, 0) + count
+
+    return dict(sorted(counts.items(), key=lambda item: (item[0] is None, item[0])))
+
+
+def _case_control_statuses(cases: list[str], controls: list[str]) -> dict[str, int]:
+    """Function that will create the dictionary of statuses for the union of
+    the cases and controls. An ID that is listed as both a case and a control
+    is treated as a case"""
+    statuses = dict.fromkeys(controls, CONTROL_STATUS)
+    statuses.update(dict.fromkeys(cases, CASE_STATUS))
+
+    return statuses
+
+
+@log_msg_debug(
+    "Executing query to get the classified relatedness for cases and controls."
+)
+def get_classified_relatedness(
+    cases: list[str],
+    controls: list[str],
+    db_obj: dbResults,
+    logger: logging.Logger,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    dictionary: IdDictionary | None = None,
+) -> Generator[PairResults, None, None]:
+    """Function that will query the pairs among the union of the cases and
+    controls in a single pass and label each pair as case-case,
+    case-control, or control-control
+
+    Parameters
+    ----------
+    cases : list[str]
+        list of case IDs
+
+    controls : list[str]
+        list of control IDs
+
+    db_obj : dbResults
+        object that contains the database path and the table name
+
+    logger : logging.Logger
+        logging object
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query across
+
+    dictionary : IdDictionary | None
+        dictionary to encode the IDs with (see get_relatedness). This is
+        ignored by the compiled backend
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of classified PairResults where each batch has
+        the id1, id2, the estimated_relatedness, and the pair class for the
+        pairs. The pair class is a key of PAIR_CLASSES
+    """
+    if db_obj.backend == Backend.COMPILED:
+        yield from open_compiled_index(db_obj, logger).get_classified_relatedness(
+            cases, controls, relatedness_threshold
+        )
+        return
+
+    statuses = _case_control_statuses(cases, controls)
+
+    dictionary = dictionary if dictionary is not None else IdDictionary()
+
+    for rows in _run_query(
+        list(statuses),
+        db_obj,
+        logger,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+        statuses=statuses,
+        classify_pairs=True,
+    ):
+        yield PairResults.from_rows(rows, dictionary, classified=True)
+
+
+@log_msg_debug("Counting the pairs at each relatedness value for cases and controls.")
+def get_classified_relatedness_counts(
+    cases: list[str],
+    controls: list[str],
+    db_obj: dbResults,
+    logger: logging.Logger,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+) -> dict[str, dict[int, int]]:
+    """Function that will count the pairs at each estimated relatedness value
+    for each pair class (case-case, case-control, and control-control) in a
+    single pass over the union of the cases and controls. The arguments are
+    the same as get_classified_relatedness
+
+    Returns
+    -------
+    dict[str, dict[int, int]]
+        returns a dictionary where the keys are the pair class names from
+        PAIR_CLASSES and the values are dictionaries of the number of pairs
+        at each estimated relatedness value
+    """
+    if db_obj.backend == Backend.COMPILED:
+        return open_compiled_index(db_obj, logger).get_classified_relatedness_counts(
+            cases, controls, relatedness_threshold
+        )
+
+    statuses = _case_control_statuses(cases, controls)
+
+    counts: dict[str, dict[int, int]] = {name: {} for name in PAIR_CLASSES.values()}
+
+    for rows in _run_query(
+        list(statuses),
+        db_obj,
+        logger,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+        count_by_relatedness=True,
+        statuses=statuses,
+        classify_pairs=True,
+    ):
+        for pair_class, relatedness, count in rows:
+            class_counts = counts[PAIR_CLASSES[pair_class]]
+            class_counts[relatedness] = class_counts.get(relatedness, 0) + count
+
+    return {
+        name: dict(
+            sorted(class_counts.items(), key=lambda item: (item[0] is None, item[0]))
+        )
+        for name, class_counts in counts.items()
+    }
+
+
+class PairClassCounter:
+    """Class that adds up the classified pairs at each relatedness value for
+    each pair class as the batches are read. This lets the counts come from
+    the same pass over the pairs as something else that needs the pairs,
+    such as the permutation test, instead of running a second query"""
+
+    def __init__(self) -> None:
+        self.counts = {
+            pair_class: np.zeros(MISSING_RELATEDNESS + 1, dtype=np.int64)
+            for pair_class in PAIR_CLASSES
+        }
+
+    def add(self, batch: PairResults) -> None:
+        """Method that adds the pairs in a classified batch to the counts"""
+        pair_class = batch.class_array()
+        relatedness = batch.arrays()[2]
+
+        for class_value, class_counts in self.counts.items():
+            class_counts += np.bincount(
+                relatedness[pair_class == class_value],
+                minlength=MISSING_RELATEDNESS + 1,
+            )
+
+    def count(
+        self, relatedness_results: Generator[PairResults, None, None]
+    ) -> Generator[PairResults, None, None]:
+        """Method that returns the same batches as the generator while adding
+        each one to the counts. The counts are only complete once every
+        batch has been read"""
+        try:
+            for batch in relatedness_results:
+                self.add(batch)
+
+                yield batch
+        finally:
+            relatedness_results.close()
+
+    def to_dict(self) -> dict[str, dict[int, int]]:
+        """Method that returns the counts in the same format as
+        get_classified_relatedness_counts"""
+        return {
+            PAIR_CLASSES[pair_class]: counts_to_dict(class_counts)
+            for pair_class, class_counts in self.counts.items()
+        }
@@ -0,0 +1,592 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Generator
+
+import numpy as np
+from log import log_msg_debug
+
+from .database_methods import (
+    PAIR_CLASSES,
+    PairClassCounter,
+    dbResults,
+    get_classified_relatedness,
+    get_classified_relatedness_counts,
+    get_relatedness,
+)
+from .options import Backend, ConflictResolution, ConnectionProfile
+from .pair_results import MISSING_RELATEDNESS, IdDictionary, PairResults
+from .result_cache import ResultCache, get_cached_relatedness
+
+# number of pairs returned in each batch when the pairs are resolved after
+# every database has been read
+MERGE_BATCH_SIZE = 65_536
+
+# number of batches that each database's thread can get ahead of the merge
+# before it waits for the merge to catch up
+SOURCE_QUEUE_SIZE = 4
+
+# number of seconds a database's thread waits on a full queue before checking
+# if the merge has stopped
+_PUT_TIMEOUT = 0.1
+
+
+class _SourceFinished:
+    """Marker put on the queue by a source's thread once it is done. If the
+    query failed then the exception is passed to the merge"""
+
+    def __init__(self, source_index: int, error: BaseException | None = None) -> None:
+        self.source_index = source_index
+        self.error = error
+
+
+def build_sources(
+    database_paths: list[Path],
+    table_names: list[str],
+    backend: Backend = Backend.SQLITE,
+    profile: ConnectionProfile = ConnectionProfile.DEFAULT,
+) -> list[dbResults]:
+    """Function that pairs each database with its table. A single table
+    name is used for every database
+
+    Parameters
+    ----------
+    database_paths : list[Path]
+        paths to the databases in order of priority
+
+    table_names : list[str]
+        either one table name for every database or a table name for each
+        database
+
+    backend : Backend
+        backend used to query the databases
+
+    profile : ConnectionProfile
+        connection profile used to open the databases
+
+    Returns
+    -------
+    list[dbResults]
+        returns a dbResults object for each database
+
+    Raises
+    ------
+    ValueError
+        if there is more than one table name but not one for each database
+    """
+    if len(table_names) == 1:
+        table_names = table_names * len(database_paths)
+
+    if len(table_names) != len(database_paths):
+        raise ValueError(
+            f"Expected either one table name or a table name for each of the {len(database_paths)} databases but {len(table_names)} table names were given"
+        )
+
+    return [
+        dbResults(database_path, table_name, backend=backend, profile=profile)
+        for database_path, table_name in zip(database_paths, table_names)
+    ]
+
+
+def pair_keys(pairs: PairResults) -> np.ndarray:
+    """Function that returns an int64 key for each pair that is the same no
+    matter which order the two IDs are in. The key is the smaller ID in the
+    upper 32 bits and the larger ID in the lower 32 bits"""
+    id1, id2, _ = pairs.arrays()
+
+    return (np.minimum(id1, id2).astype(np.int64) << 32) | np.maximum(id1, id2)
+
+
+def _select(pairs: PairResults, keep: np.ndarray) -> PairResults:
+    """Function that returns the pairs where keep is True"""
+    id1, id2, relatedness = pairs.arrays()
+    pair_class = pairs.class_array()
+
+    return PairResults.from_arrays(
+        id1[keep],
+        id2[keep],
+        relatedness[keep],
+        pairs.dictionary,
+        pair_class[keep] if pair_class is not None else None,
+    )
+
+
+def _in_sorted(keys: np.ndarray, sorted_keys: np.ndarray) -> np.ndarray:
+    """Function that returns whether each key is in the sorted array of
+    keys"""
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+
+    return sorted_keys[positions] == keys
+
+
+def _read_source(
+    source_index: int,
+    source_results: Generator[PairResults, None, None],
+    result_queue: queue.Queue,
+    stop: threading.Event,
+) -> None:
+    """Function run by the thread for each database. The results generator
+    is created and closed on this thread so the sqlite connection that it
+    opens is only used by this thread"""
+
+    def put(item) -> bool:
+        # waiting in short steps means the thread notices if the merge stops
+        # while the queue is full instead of blocking forever
+        while not stop.is_set():
+            try:
+                result_queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    error = None
+
+    try:
+        for batch in source_results:
+            if not put((source_index, batch)):
+                return
+    except BaseException as e:
+        error = e
+    finally:
+        source_results.close()
+
+    put(_SourceFinished(source_index, error))
+
+
+def _query_sources(
+    source_results: list[Generator[PairResults, None, None]],
+    in_order: bool = False,
+) -> Generator[tuple[int, PairResults | None], None, None]:
+    """Function that reads every database on its own thread. sqlite
+    releases the GIL while it runs a query so the databases are read at the
+    same time. The batches are returned as (source index, batch) and
+    (source index, None) is returned once a database is finished
+
+    Parameters
+    ----------
+    source_results : list[Generator[PairResults, None, None]]
+        generator of the results from each database
+
+    in_order : bool
+        if this is False then the batches are returned in the order that
+        they arrive from any database. If this is True then every batch from
+        a database is returned before the batches of the next database. Each
+        database has its own queue in this case so a later database only
+        reads ahead by SOURCE_QUEUE_SIZE batches and then waits until the
+        databases before it have finished
+
+    Raises
+    ------
+    Exception
+        any exception raised while reading a database is raised again in the
+        thread that is consuming this generator
+    """
+    # the queues are bounded so that the databases can't read ahead of a
+    # slow consumer (such as the writer) without limit
+    if in_order:
+        source_queues = [queue.Queue(SOURCE_QUEUE_SIZE) for _ in source_results]
+    else:
+        source_queues = [queue.Queue(SOURCE_QUEUE_SIZE * len(source_results))] * len(
+            source_results
+        )
+
+    stop = threading.Event()
+
+    readers = [
+        threading.Thread(
+            target=_read_source,
+            args=(source_index, results, source_queues[source_index], stop),
+            name=f"relatedness-source-{source_index}",
+            daemon=True,
+        )
+        for source_index, results in enumerate(source_results)
+    ]
+
+    for reader in readers:
+        reader.start()
+
+    try:
+        remaining = len(readers)
+
+        # with a shared queue the first queue is the only one that is read
+        current = 0
+
+        while remaining:
+            item = source_queues[current].get()
+
+            if isinstance(item, _SourceFinished):
+                if item.error is not None:
+                    raise item.error
+
+                remaining -= 1
+
+                if in_order:
+                    current += 1
+
+                yield item.source_index, None
+            else:
+                yield item
+    finally:
+        # if the consumer stops early (or a database fails) the other
+        # readers are told to stop so that they close their queries
+        stop.set()
+
+        for reader in readers:
+            reader.join()
+
+
+def _merge_first(
+    source_results: list[Generator[PairResults, None, None]],
+    logger: logging.Logger,
+    dictionary: IdDictionary,
+) -> Generator[PairResults, None, None]:
+    """Function that keeps a pair from the first database that has it. The
+    databases are returned one after the other and the pairs that an
+    earlier database had are removed from each batch. A later database only
+    reads a few batches ahead while it waits for the databases before it so
+    the batches aren't held in memory. Only the keys of the pairs that have
+    been returned (8 bytes for each pair) are kept to check the later
+    databases against"""
+    # sorted keys of every pair from the databases before the current one
+    seen_keys = np.empty(0, dtype=np.int64)
+    current_keys: list[np.ndarray] = []
+    duplicates = 0
+
+    for _, batch in _query_sources(source_results, in_order=True):
+        if batch is None:
+            if current_keys:
+                seen_keys = np.union1d(seen_keys, np.concatenate(current_keys))
+                current_keys = []
+
+            continue
+
+        batch = batch.remap(dictionary)
+        keys = pair_keys(batch)
+
+        current_keys.append(keys)
+
+        in_earlier = _in_sorted(keys, seen_keys)
+
+        if in_earlier.any():
+            duplicates += int(in_earlier.sum())
+
+            batch = _select(batch, ~in_earlier)
+
+        if len(batch):
+            yield batch
+
+    logger.info(
+        f"Removed {duplicates} pairs that were already returned from an earlier database"
+    )
+
+
+def _merge_closest(
+    source_results: list[Generator[PairResults, None, None]],
+    logger: logging.Logger,
+    dictionary: IdDictionary,
+) -> Generator[PairResults, None, None]:
+    """Function that keeps a pair from the database that has the closest
+    estimated relatedness for it (the earlier database if they are the
+    same). Missing relatedness values are treated as the most distant. Any
+    database could have the closest value so every pair from every database
+    is held in memory until all of the databases have finished. The memory
+    used grows with the total number of pairs (9 bytes for each pair plus
+    around 40 bytes for the keys and scores while they are resolved) and
+    nothing is returned until the last database is done"""
+    source_count = len(source_results)
+
+    batches: list[PairResults] = []
+    sources: list[np.ndarray] = []
+
+    for source_index, batch in _query_sources(source_results):
+        if batch is not None and len(batch):
+            batches.append(batch.remap(dictionary))
+            sources.append(np.full(len(batch), source_index, dtype=np.int64))
+
+    if not batches:
+        return
+
+    merged = batches[0]
+
+    for batch in batches[1:]:
+        merged.extend(batch)
+
+    batches = []
+
+    source = np.concatenate(sources)
+    keys = pair_keys(merged)
+
+    # each pair is scored by its relatedness and then its database so that
+    # the smallest score for each key picks the database to keep
+    scores = merged.arrays()[2].astype(np.int64) * source_count + source
+
+    _, key_index = np.unique(keys, return_inverse=True)
+
+    best = np.full(key_index.max() + 1, (MISSING_RELATEDNESS + 1) * source_count)
+    np.minimum.at(best, key_index, scores)
+
+    keep = source == best[key_index] % source_count
+
+    logger.info(
+        f"Removed {int((~keep).sum())} pairs that had a closer estimate in another database"
+    )
+
+    kept = _select(merged, keep)
+
+    for start in range(0, len(kept), MERGE_BATCH_SIZE):
+        yield _select(kept, slice(start, start + MERGE_BATCH_SIZE))
+
+
+def merge_sources(
+    source_results: list[Generator[PairResults, None, None]],
+    logger: logging.Logger,
+    resolution: ConflictResolution = ConflictResolution.FIRST,
+    dictionary: IdDictionary | None = None,
+) -> Generator[PairResults, None, None]:
+    """Function that reads the results from several databases at the same
+    time and merges them into one stream of batches. Pairs are matched no
+    matter which order the two IDs are in. A pair that is listed more than
+    once in the same database is kept as it is
+
+    Parameters
+    ----------
+    source_results : list[Generator[PairResults, None, None]]
+        generator of the results from each database in order of priority.
+        The generators should not have been started yet
+
+    logger : logging.Logger
+        logging object
+
+    resolution : ConflictResolution
+        how to resolve a pair that is in more than one database. 'all' keeps
+        every copy and returns the batches as they arrive. 'first' keeps the
+        copy from the first database that has the pair and returns the
+        databases in order, so a later database only reads a few batches
+        ahead. 'closest' keeps the copy with the closest estimated
+        relatedness. 'closest' holds every pair in memory until all of the
+        databases have been read
+
+    dictionary : IdDictionary | None
+        dictionary that every merged batch is encoded with. The databases
+        are read on their own threads so their batches are converted to
+        this dictionary as they are merged. A new dictionary is created if
+        one isn't given. With 'all' the batches are returned with their own
+        dictionaries if this isn't given
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of the merged PairResults batches
+    """
+    match resolution:
+        case ConflictResolution.ALL:
+            for _, batch in _query_sources(source_results):
+                if batch is not None:
+                    yield batch.remap(dictionary) if dictionary is not None else batch
+        case ConflictResolution.FIRST:
+            yield from _merge_first(
+                source_results,
+                logger,
+                dictionary if dictionary is not None else IdDictionary(),
+            )
+        case ConflictResolution.CLOSEST:
+            yield from _merge_closest(
+                source_results,
+                logger,
+                dictionary if dictionary is not None else IdDictionary(),
+            )
+
+
+@log_msg_debug("Querying several databases for the relatedness of the individuals.")
+def get_federated_relatedness(
+    ind_list: list[str],
+    sources: list[dbResults],
+    logger: logging.Logger,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    resolution: ConflictResolution = ConflictResolution.FIRST,
+    cache: ResultCache | None = None,
+    dictionary: IdDictionary | None = None,
+) -> Generator[PairResults, None, None]:
+    """Function that runs the get_relatedness query against several
+    databases at the same time and merges the results
+
+    Parameters
+    ----------
+    ind_list : list[str]
+        list of individuals to find in the databases
+
+    sources : list[dbResults]
+        databases to query in order of priority (see build_sources)
+
+    logger : logging.Logger
+        logging object
+
+    all_connections : bool
+        whether to return all connections or only the pairs where both
+        individuals are in the list
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query for each database across
+
+    resolution : ConflictResolution
+        how to resolve a pair that is in more than one database (see
+        merge_sources)
+
+    cache : ResultCache | None
+        result cache to read each database's results from or write them to.
+        The results are not cached if this isn't given
+
+    dictionary : IdDictionary | None
+        dictionary that the merged batches are encoded with (see
+        merge_sources)
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of the merged PairResults batches
+    """
+    if cache is not None:
+        source_results = [
+            get_cached_relatedness(
+                ind_list,
+                db_obj,
+                cache,
+                logger=logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+            )
+            for db_obj in sources
+        ]
+    else:
+        source_results = [
+            get_relatedness(
+                ind_list,
+                db_obj,
+                logger=logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+            )
+            for db_obj in sources
+        ]
+
+    yield from merge_sources(source_results, logger, resolution, dictionary)
+
+
+@log_msg_debug("Querying several databases for the classified relatedness.")
+def get_federated_classified_relatedness(
+    cases: list[str],
+    controls: list[str],
+    sources: list[dbResults],
+    logger: logging.Logger,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    resolution: ConflictResolution = ConflictResolution.FIRST,
+    dictionary: IdDictionary | None = None,
+) -> Generator[PairResults, None, None]:
+    """Function that runs the get_classified_relatedness query against
+    several databases at the same time and merges the results. The other
+    arguments are the same as get_federated_relatedness
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of the merged classified PairResults batches
+    """
+    yield from merge_sources(
+        [
+            get_classified_relatedness(
+                cases,
+                controls,
+                db_obj,
+                logger=logger,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+            )
+            for db_obj in sources
+        ],
+        logger,
+        resolution,
+        dictionary,
+    )
+
+
+@log_msg_debug("Counting the classified relatedness across several databases.")
+def get_federated_classified_relatedness_counts(
+    cases: list[str],
+    controls: list[str],
+    sources: list[dbResults],
+    logger: logging.Logger,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    resolution: ConflictResolution = ConflictResolution.FIRST,
+) -> dict[str, dict[int, int]]:
+    """Function that counts the pairs at each estimated relatedness value
+    for each pair class across several databases. If every copy of a pair
+    is kept then each database counts its pairs in sql at the same time and
+    the counts are added together. Otherwise the pairs have to be compared
+    across the databases so they are read and counted after they are
+    merged. The arguments are the same as get_federated_relatedness
+
+    Returns
+    -------
+    dict[str, dict[int, int]]
+        returns a dictionary where the keys are the pair class names from
+        PAIR_CLASSES and the values are dictionaries of the number of pairs
+        at each estimated relatedness value
+    """
+    if resolution != ConflictResolution.ALL:
+        counter = PairClassCounter()
+
+        for batch in get_federated_classified_relatedness(
+            cases,
+            controls,
+            sources,
+            logger=logger,
+            relatedness_threshold=relatedness_threshold,
+            workers=workers,
+            resolution=resolution,
+        ):
+            counter.add(batch)
+
+        return counter.to_dict()
+
+    counts: dict[str, dict[int, int]] = {name: {} for name in PAIR_CLASSES.values()}
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        source_counts = executor.map(
+            lambda db_obj: get_classified_relatedness_counts(
+                cases,
+                controls,
+                db_obj,
+                logger=logger,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+            ),
+            sources,
+        )
+
+        for class_counts in source_counts:
+            for name, relatedness_counts in class_counts.items():
+                for relatedness, count in relatedness_counts.items():
+                    counts[name][relatedness] = counts[name].get(relatedness, 0) + count
+
+    return {
+        name: dict(
+            sorted(class_counts.items(), key=lambda item: (item[0] is None, item[0]))
+        )
+        for name, class_counts in counts.items()
+    }
@@ -0,0 +1,335 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Generator
+
+from log import log_msg_debug
+
+from .database_methods import Backend, dbResults, get_connection, get_relatedness
+from .pair_results import IdDictionary, PairResults
+from .result_cache import _hash_ids
+
+# version of the watermark file format. Watermarks with a different version
+# are ignored so the next run rebuilds the results from scratch
+WATERMARK_FORMAT_VERSION = 1
+
+WATERMARK_SUFFIX = ".watermark.json"
+
+
+@dataclass
+class Watermark:
+    """Class that records how far into the pair table a previous run read so
+    that the next run only has to query the rows appended since.
+
+    Parameters
+    ----------
+    database : str
+        resolved path to the database
+
+    table : str
+        name of the pair table
+
+    query : str
+        hash of the IDs and query options that the results were made with
+
+    max_row_id : int
+        largest rowid in the pair table when the results were made
+
+    row_hash : str | None
+        hash of the pair stored at max_row_id. If the table is rebuilt
+        instead of appended to then this pair is very unlikely to match
+        so the watermark is not trusted
+
+    output_size : int
+        size of the output file in bytes after the results were written. The
+        output is cut back to this size before new pairs are appended so an
+        interrupted refresh doesn't leave duplicate pairs in the file
+    """
+
+    database: str
+    table: str
+    query: str
+    max_row_id: int
+    row_hash: str | None
+    output_size: int = 0
+    format_version: int = WATERMARK_FORMAT_VERSION
+
+
+def get_watermark_path(output_path: Path) -> Path:
+    """Function that returns the path of the watermark that is saved next to
+    an output file"""
+    output_path = Path(output_path)
+
+    return output_path.with_name(f"{output_path.name}{WATERMARK_SUFFIX}")
+
+
+def read_watermark(output_path: Path) -> Watermark | None:
+    """Function that reads the watermark saved next to an output file. None
+    is returned if there isn't a watermark or it can't be read"""
+    try:
+        with open(get_watermark_path(output_path), encoding="utf-8") as json_file:
+            return Watermark(**json.load(json_file))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def write_watermark(watermark: Watermark, output_path: Path) -> Path:
+    """Function that records the size of the finished output file in the
+    watermark and saves the watermark next to the output. The watermark is
+    written to a temporary file and then moved into place so that a partly
+    written watermark is never read
+
+    Parameters
+    ----------
+    watermark : Watermark
+        watermark returned by get_incremental_relatedness
+
+    output_path : Path
+        output file that the results were written to
+
+    Returns
+    -------
+    Path
+        returns the path to the watermark
+    """
+    watermark.output_size = Path(output_path).stat().st_size
+
+    watermark_path = get_watermark_path(output_path)
+    partial = watermark_path.with_name(f"{watermark_path.name}.{os.getpid()}")
+
+    with open(partial, "w", encoding="utf-8") as json_file:
+        json.dump(asdict(watermark), json_file, indent=4)
+
+    os.replace(partial, watermark_path)
+
+    return watermark_path
+
+
+def _hash_query(
+    ind_list: list[str],
+    all_connections: bool,
+    relatedness_threshold: int,
+    output_format: str,
+) -> str:
+    """Function that hashes the IDs and options that change which pairs are
+    in the output or how they are written"""
+    query_fields = {
+        "ids": _hash_ids(ind_list),
+        "all_connections": all_connections,
+        "relatedness_threshold": relatedness_threshold,
+        "output_format": output_format,
+    }
+
+    return hashlib.sha256(
+        json.dumps(query_fields, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _read_table_watermark(
+    connection: sqlite3.Connection, table_name: str
+) -> tuple[int, str | None]:
+    """Function that returns the largest rowid in the pair table and the hash
+    of the pair stored at that rowid. sqlite reads the largest rowid from
+    the end of the table's b-tree so this doesn't scan the table"""
+    max_row_id = connection.execute(f"SELECT MAX(rowid) FROM {table_name}").fetchone()[
+        0
+    ]
+
+    return max_row_id or 0, _hash_row(connection, table_name, max_row_id or 0)
+
+
+def _hash_row(
+    connection: sqlite3.Connection, table_name: str, row_id: int
+) -> str | None:
+    """Function that hashes the pair stored at a rowid. None is returned if
+    there isn't a row with that rowid"""
+    row = connection.execute(
+        f"SELECT ID1, ID2, estimated_relatedness FROM {table_name} WHERE rowid = ?",
+        [row_id],
+    ).fetchone()
+
+    if row is None:
+        return None
+
+    return hashlib.sha256(json.dumps(row).encode("utf-8")).hexdigest()
+
+
+def _check_watermark(
+    previous: Watermark | None,
+    current: Watermark,
+    connection: sqlite3.Connection,
+    output_path: Path,
+    logger: logging.Logger,
+) -> bool:
+    """Function that checks whether the new rows can be appended to the
+    previous results. The reason is logged if they can't"""
+    if previous is None:
+        logger.info(
+            f"There is no watermark for {output_path} so all of the results will be written"
+        )
+        return False
+
+    problems = []
+
+    if previous.format_version != WATERMARK_FORMAT_VERSION:
+        problems.append("the watermark was written by a different version")
+    if (previous.database, previous.table) != (current.database, current.table):
+        problems.append("the database or table is different")
+    if previous.query != current.query:
+        problems.append("the IDs or query options are different")
+    if previous.max_row_id > current.max_row_id:
+        problems.append("the pair table has fewer rows than before")
+    elif _hash_row(connection, current.table, previous.max_row_id) != (
+        previous.row_hash
+    ):
+        problems.append("the pair at the watermark has changed")
+    if not output_path.exists() or output_path.stat().st_size < previous.output_size:
+        problems.append("the previous output is missing or smaller than before")
+
+    if problems:
+        logger.warning(
+            f"The previous results in {output_path} can't be refreshed because {', and '.join(problems)}. All of the results will be written again"
+        )
+        return False
+
+    return True
+
+
+@log_msg_debug("Checking the watermark of the previous results.")
+def get_incremental_relatedness(
+    ind_list: list[str],
+    db_obj: dbResults,
+    output_path: Path,
+    logger: logging.Logger,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    output_format: str = "tsv",
+) -> tuple[Generator[PairResults, None, None], Watermark, bool]:
+    """Function that refreshes the results of a previous run with the rows
+    that have been appended to the pair table since. The pair table is
+    append only so every pair added since the previous run has a rowid above
+    the watermark saved next to the output. Only those rows are queried and
+    they are appended to the output. If there is no valid watermark then
+    every pair is returned so that the output can be written from scratch.
+    The watermark should be saved with write_watermark once the output has
+    been written
+
+    Parameters
+    ----------
+    ind_list : list[str]
+        list of individuals to find in the database
+
+    db_obj : dbResults
+        object that contains the database path, table name, and backend
+
+    output_path : Path
+        output file of the previous run
+
+    logger : logging.Logger
+        logging object
+
+    all_connections : bool
+        whether to return all connections or only the pairs where both
+        individuals are in the list
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query across
+
+    output_format : str
+        format of the output file. The watermark is only used if the output
+        was written in the same format
+
+    Returns
+    -------
+    tuple[Generator[PairResults, None, None], Watermark, bool]
+        returns a generator of the PairResults batches, the new watermark,
+        and whether the batches should be appended to the output rather
+        than replace it
+
+    Raises
+    ------
+    ValueError
+        if the compiled backend is used since it doesn't keep the rowids
+    """
+    if db_obj.backend == Backend.COMPILED:
+        raise ValueError(
+            "Incremental refreshes need the rowids of the pair table so they can only be used with the sqlite backend"
+        )
+
+    output_path = Path(output_path)
+
+    connection = db_obj.connection or get_connection(
+        db_obj.database_path, logger=logger, profile=db_obj.profile
+    )
+
+    try:
+        max_row_id, row_hash = _read_table_watermark(connection, db_obj.table_name)
+
+        watermark = Watermark(
+            database=str(Path(db_obj.database_path).resolve()),
+            table=db_obj.table_name,
+            query=_hash_query(
+                ind_list, all_connections, relatedness_threshold, output_format
+            ),
+            max_row_id=max_row_id,
+            row_hash=row_hash,
+        )
+
+        previous = read_watermark(output_path)
+
+        append = _check_watermark(previous, watermark, connection, output_path, logger)
+    finally:
+        if db_obj.connection is None:
+            connection.close()
+
+    min_row_id = None
+
+    if not append:
+        # the old watermark is removed before the output is replaced so that
+        # it is never used with a partly written output
+        get_watermark_path(output_path).unlink(missing_ok=True)
+    else:
+        min_row_id = previous.max_row_id
+
+        # anything after the recorded size was written by a refresh that
+        # didn't finish and would be written again
+        if output_path.stat().st_size > previous.output_size:
+            logger.warning(
+                f"Removing the pairs written to {output_path} by a refresh that didn't finish"
+            )
+            os.truncate(output_path, previous.output_size)
+
+        if min_row_id == max_row_id:
+            logger.info(
+                f"No rows have been added to the pair table since {output_path} was written"
+            )
+        else:
+            logger.info(
+                f"Refreshing {output_path} with the rows from {min_row_id + 1} to {max_row_id}"
+            )
+
+    # the rows are capped at the watermark that is saved so that rows
+    # appended while the query runs are picked up by the next refresh
+    # instead of being missed or written twice
+    results = get_relatedness(
+        ind_list,
+        db_obj,
+        logger=logger,
+        all_connections=all_connections,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+        dictionary=IdDictionary(),
+        min_row_id=min_row_id,
+        max_row_id=max_row_id,
+    )
+
+    return results, watermark, append
@@ -0,0 +1,36 @@
+from enum import Enum
+from pathlib import Path
+
+# The enums and defaults for the cli options are kept in this module so that
+# the cli can build its options without importing numpy or the query code
+
+
+class Backend(str, Enum):
+    """Enum used to define the options for the query backend in the cli"""
+
+    SQLITE = "sqlite"
+    COMPILED = "compiled"
+
+
+class ConnectionProfile(str, Enum):
+    """Enum used to define the options for the sqlite connection profile in
+    the cli"""
+
+    DEFAULT = "default"
+    READ = "read"
+    IMMUTABLE = "immutable"
+
+
+class ConflictResolution(str, Enum):
+    """Enum used to define the options for resolving a pair that is in more
+    than one database in the cli"""
+
+    ALL = "all"
+    FIRST = "first"
+    CLOSEST = "closest"
+
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "relatednessFinder"
+
+# default limit for the total size of the cache in megabytes
+DEFAULT_CACHE_SIZE = 1024
@@ -0,0 +1,414 @@
+import os
+from array import array
+from typing import BinaryIO, Generator, Iterable, Iterator
+
+import numpy as np
+
+# relatedness values are stored as uint8 so a missing (NULL) value is stored
+# as the largest uint8 value. Any relatedness threshold removes these pairs
+# just like the NULL comparison in the sql query does
+MISSING_RELATEDNESS = 255
+
+
+class IdDictionary:
+    """Class that interns ID strings as integers so that each ID string is
+    only stored once no matter how many pairs it is in. The dictionary can
+    also be backed by a sorted numpy array of IDs such as the one in a
+    compiled index"""
+
+    def __init__(self, ids: Iterable[str] = ()) -> None:
+        self.ids: list[str] | np.ndarray = []
+        self.lookup: dict[str, int] = {}
+
+        self.encode(ids)
+
+    @classmethod
+    def from_array(cls, ids: np.ndarray) -> "IdDictionary":
+        """Method that creates a dictionary backed by an array of IDs. The
+        lookup table is only built if new IDs are encoded"""
+        dictionary = cls()
+        dictionary.ids = ids
+
+        return dictionary
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __repr__(self) -> str:
+        return f"IdDictionary({len(self)} ids)"
+
+    def _build_lookup(self) -> None:
+        """Method that converts an array backed dictionary into a list and a
+        lookup table so that new IDs can be added"""
+        if isinstance(self.ids, np.ndarray):
+            self.ids = self.ids.tolist()
+            self.lookup = {grid: index for index, grid in enumerate(self.ids)}
+
+    def encode(self, values: Iterable[str]) -> array:
+        """Method that will return the integer for each ID. IDs that aren't
+        in the dictionary yet are added to it
+
+        Parameters
+        ----------
+        values : Iterable[str]
+            IDs to encode
+
+        Returns
+        -------
+        array
+            returns an int32 array of the integer for each ID
+        """
+        self._build_lookup()
+
+        lookup = self.lookup
+        ids = self.ids
+
+        encoded = array("i")
+
+        for value in values:
+            index = lookup.get(value)
+
+            if index is None:
+                index = len(ids)
+                lookup[value] = index
+                ids.append(value)
+
+            encoded.append(index)
+
+        return encoded
+
+    def decode(self, encoded: Iterable[int]) -> list[str]:
+        """Method that will convert integers back into the ID strings"""
+        if isinstance(self.ids, np.ndarray):
+            return self.ids[np.asarray(encoded, dtype=np.int64)].tolist()
+
+        ids = self.ids
+
+        return [ids[index] for index in encoded]
+
+
+class PairResults:
+    """Class that stores pairs in typed arrays. ID1 and ID2 are int32 values
+    from an IdDictionary and the relatedness is a uint8 value so each pair
+    takes 9 bytes instead of a tuple and two strings. Classified pairs also
+    store the pair class as an int8 value"""
+
+    def __init__(
+        self, dictionary: IdDictionary | None = None, classified: bool = False
+    ) -> None:
+        self.dictionary = dictionary if dictionary is not None else IdDictionary()
+        self.id1 = array("i")
+        self.id2 = array("i")
+        self.relatedness = array("B")
+        self.pair_class = array("b") if classified else None
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: list[tuple],
+        dictionary: IdDictionary | None = None,
+        classified: bool = False,
+    ) -> "PairResults":
+        """Method that creates the container from database rows of
+        (ID1, ID2, estimated_relatedness) or, for classified pairs,
+        (ID1, ID2, estimated_relatedness, pair_class)"""
+        results = cls(dictionary, classified)
+        results.extend_rows(rows)
+
+        return results
+
+    @classmethod
+    def from_arrays(
+        cls,
+        id1: np.ndarray,
+        id2: np.ndarray,
+        relatedness: np.ndarray,
+        dictionary: IdDictionary,
+        pair_class: np.ndarray | None = None,
+    ) -> "PairResults":
+        """Method that creates the container from arrays that are already
+        encoded with the dictionary"""
+        results = cls(dictionary, pair_class is not None)
+
+        results.id1.frombytes(np.asarray(id1, dtype=np.int32).tobytes())
+        results.id2.frombytes(np.asarray(id2, dtype=np.int32).tobytes())
+        results.relatedness.frombytes(np.asarray(relatedness, dtype=np.uint8).tobytes())
+
+        if pair_class is not None:
+            results.pair_class.frombytes(
+                np.asarray(pair_class, dtype=np.int8).tobytes()
+            )
+
+        return results
+
+    def __len__(self) -> int:
+        return len(self.relatedness)
+
+    def __repr__(self) -> str:
+        return (
+            f"PairResults({len(self)} pairs, {len(self.dictionary)} ids,"
+            f" {self.nbytes} bytes)"
+        )
+
+    def __iter__(self) -> Iterator[tuple]:
+        """Iterating over the container returns the decoded pairs as tuples"""
+        return zip(*self.columns())
+
+    @property
+    def nbytes(self) -> int:
+        """number of bytes used by the pair arrays"""
+        arrays = [self.id1, self.id2, self.relatedness]
+
+        if self.pair_class is not None:
+            arrays.append(self.pair_class)
+
+        return sum(len(values) * values.itemsize for values in arrays)
+
+    def extend_rows(self, rows: list[tuple]) -> None:
+        """Method that encodes database rows and adds them to the container"""
+        if not rows:
+            return
+
+        columns = list(zip(*rows))
+
+        self.id1.extend(self.dictionary.encode(columns[0]))
+        self.id2.extend(self.dictionary.encode(columns[1]))
+        self.relatedness.extend(
+            MISSING_RELATEDNESS if value is None else value for value in columns[2]
+        )
+
+        if self.pair_class is not None:
+            self.pair_class.extend(columns[3])
+
+    def extend(self, other: "PairResults") -> None:
+        """Method that adds the pairs from another container. The other
+        container is re-encoded if it uses a different dictionary"""
+        if other.dictionary is not self.dictionary:
+            other = other.remap(self.dictionary)
+
+        self.id1.extend(other.id1)
+        self.id2.extend(other.id2)
+        self.relatedness.extend(other.relatedness)
+
+        if self.pair_class is not None:
+            self.pair_class.extend(other.pair_class)
+
+    def remap(self, dictionary: IdDictionary) -> "PairResults":
+        """Method that returns a copy of the container that is encoded with a
+        different dictionary. Only the IDs used by this container are looked
+        up in the new dictionary"""
+        id1, id2, relatedness = self.arrays()
+
+        used_ids = np.unique(np.concatenate([id1, id2]))
+
+        mapping = np.zeros(len(self.dictionary), dtype=np.int32)
+        mapping[used_ids] = np.frombuffer(
+            dictionary.encode(self.dictionary.decode(used_ids)), dtype=np.int32
+        )
+
+        return PairResults.from_arrays(
+            mapping[id1],
+            mapping[id2],
+            relatedness,
+            dictionary,
+            self.class_array(),
+        )
+
+    def arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Method that returns numpy views of the ID1, ID2, and relatedness
+        arrays without copying them"""
+        return (
+            np.frombuffer(self.id1, dtype=np.int32),
+            np.frombuffer(self.id2, dtype=np.int32),
+            np.frombuffer(self.relatedness, dtype=np.uint8),
+        )
+
+    def class_array(self) -> np.ndarray | None:
+        """Method that returns a numpy view of the pair classes or None if
+        the pairs are not classified"""
+        if self.pair_class is None:
+            return None
+
+        return np.frombuffer(self.pair_class, dtype=np.int8)
+
+    def relatedness_values(self) -> list[int | None]:
+        """Method that returns the relatedness values where missing values
+        are None"""
+        return [
+            None if value == MISSING_RELATEDNESS else value
+            for value in self.relatedness
+        ]
+
+    def columns(self) -> list[list]:
+        """Method that decodes the pairs into lists of the ID1 strings, the
+        ID2 strings, the relatedness values, and the pair classes if the
+        pairs are classified"""
+        columns = [
+            self.dictionary.decode(self.id1),
+            self.dictionary.decode(self.id2),
+            self.relatedness_values(),
+        ]
+
+        if self.pair_class is not None:
+            columns.append(self.pair_class.tolist())
+
+        return columns
+
+    def relatedness_counts(self) -> dict[int, int]:
+        """Method that counts the number of pairs at each relatedness value"""
+        counts = np.bincount(self.arrays()[2], minlength=MISSING_RELATEDNESS + 1)
+
+        return counts_to_dict(counts)
+
+
+def counts_to_dict(counts: np.ndarray) -> dict[int, int]:
+    """Function that converts an array of the counts at each relatedness
+    value into a dictionary of the non-zero counts where the missing
+    relatedness value is None"""
+    return {
+        (None if value == MISSING_RELATEDNESS else value): int(counts[value])
+        for value in np.flatnonzero(counts).tolist()
+    }
+
+
+class PairChunkWriter:
+    """Class that writes batches of pairs to a binary file as a sequence of
+    chunks. Each chunk is the IDs that were added to the dictionary since
+    the previous chunk followed by the ID1, ID2, and relatedness arrays, all
+    saved in the npy format, so the file can be read back a chunk at a time
+    with numpy.load. This is the format of the result cache entries and of
+    the binary output format
+
+    Parameters
+    ----------
+    output : BinaryIO
+        file opened in binary mode to write the chunks to
+
+    dictionary : IdDictionary | None
+        dictionary that the batches are encoded with. Batches that use a
+        different dictionary are re-encoded before they are written. If this
+        is not given then the dictionary of the first batch is used unless it
+        is backed by an array, such as the dictionary of a compiled index,
+        which would write every ID in the index
+
+    append : bool
+        whether the chunks are appended to a file that already has the IDs
+        in the dictionary (see read_pair_dictionary) so that only IDs added
+        after those are written
+    """
+
+    def __init__(
+        self,
+        output: BinaryIO,
+        dictionary: IdDictionary | None = None,
+        append: bool = False,
+    ) -> None:
+        self.output = output
+        self.dictionary = dictionary
+        self.ids_written = len(dictionary) if append and dictionary is not None else 0
+
+    def write(self, pairs: PairResults) -> None:
+        if self.dictionary is None:
+            self.dictionary = (
+                IdDictionary()
+                if isinstance(pairs.dictionary.ids, np.ndarray)
+                else pairs.dictionary
+            )
+
+        if pairs.dictionary is not self.dictionary:
+            pairs = pairs.remap(self.dictionary)
+
+        # the IDs are stored as utf-8 bytes since numpy stores str arrays
+        # with 4 bytes for every character. numpy returns a float array when
+        # an empty array is encoded so the result is cast back to bytes
+        np.save(
+            self.output,
+            np.char.encode(
+                np.array(self.dictionary.ids[self.ids_written :], dtype=str), "utf-8"
+            ).astype(bytes, copy=False),
+        )
+        self.ids_written = len(self.dictionary)
+
+        for values in pairs.arrays():
+            np.save(self.output, values)
+
+
+def read_pair_chunks(
+    input_file: BinaryIO, dictionary: IdDictionary | None = None
+) -> Generator[PairResults, None, None]:
+    """Function that reads the chunks written by a PairChunkWriter. Every
+    batch shares one dictionary
+
+    Parameters
+    ----------
+    input_file : BinaryIO
+        buffered file opened in binary mode
+
+    dictionary : IdDictionary | None
+        dictionary to encode the pairs with. The IDs in the file are added to
+        it and the integers in the file are converted to the dictionary's
+        integers. A new dictionary is created if one isn't given
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of a PairResults batch for each chunk
+    """
+    if dictionary is None:
+        dictionary = IdDictionary()
+
+    # dictionary integer of each ID in the order the IDs were written
+    mapping = np.empty(0, dtype=np.int32)
+
+    while input_file.peek(1):
+        new_ids = np.char.decode(np.load(input_file), "utf-8").tolist()
+
+        mapping = np.concatenate(
+            [mapping, np.frombuffer(dictionary.encode(new_ids), dtype=np.int32)]
+        )
+
+        id1, id2, relatedness = (np.load(input_file) for _ in range(3))
+
+        yield PairResults.from_arrays(
+            mapping[id1], mapping[id2], relatedness, dictionary
+        )
+
+
+def _skip_array(input_file: BinaryIO) -> None:
+    """Function that moves the file past the next npy array without reading
+    its data"""
+    version = np.lib.format.read_magic(input_file)
+
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(input_file)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(input_file)
+
+    input_file.seek(int(np.prod(shape)) * dtype.itemsize, os.SEEK_CUR)
+
+
+def read_pair_dictionary(input_file: BinaryIO) -> IdDictionary:
+    """Function that reads only the dictionary from the chunks written by a
+    PairChunkWriter. The pair arrays are skipped so this reads a small part
+    of the file. This is used to append more chunks to the file
+
+    Parameters
+    ----------
+    input_file : BinaryIO
+        buffered file opened in binary mode
+
+    Returns
+    -------
+    IdDictionary
+        returns the dictionary with every ID in the file in the order they
+        were written
+    """
+    dictionary = IdDictionary()
+
+    while input_file.peek(1):
+        dictionary.encode(np.char.decode(np.load(input_file), "utf-8").tolist())
+
+        for _ in range(3):
+            _skip_array(input_file)
+
+    return dictionary
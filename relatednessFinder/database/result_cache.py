@@ -0,0 +1,395 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Generator
+
+from log import log_msg_debug
+
+from .database_methods import dbResults, get_relatedness
+from .options import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from .pair_results import (
+    IdDictionary,
+    PairChunkWriter,
+    PairResults,
+    read_pair_chunks,
+)
+
+# version of the cache entry format. This is part of every key so entries
+# written in an older format are never read and are eventually evicted
+CACHE_FORMAT_VERSION = 2
+
+CACHE_SUFFIX = ".pairs"
+
+PARTIAL_SUFFIX = ".partial"
+
+# number of seconds after which an entry that is still being written is
+# treated as abandoned even if a process with its PID is running. PIDs are
+# reused so a process that was killed can look like it is still running
+STALE_PARTIAL_SECONDS = 24 * 60 * 60
+
+
+def _fingerprint_path(database_path: Path) -> dict[str, int | str]:
+    """Function that returns the resolved path, modification time, and size
+    of the database. For a compiled index directory the metadata file is
+    used because it is the last file written when the index is compiled. A
+    database in WAL mode writes new rows to the -wal file and only changes
+    the database file when the WAL is checkpointed, so the modification
+    time and size of the -wal file are included if it exists"""
+    database_path = Path(database_path).resolve()
+
+    stat_path = database_path
+
+    if database_path.is_dir():
+        stat_path = database_path / "metadata.json"
+
+    stats = stat_path.stat()
+
+    fingerprint = {
+        "path": str(database_path),
+        "mtime": stats.st_mtime_ns,
+        "size": stats.st_size,
+    }
+
+    wal_path = database_path.with_name(f"{database_path.name}-wal")
+
+    if wal_path.is_file():
+        wal_stats = wal_path.stat()
+
+        fingerprint["wal_mtime"] = wal_stats.st_mtime_ns
+        fingerprint["wal_size"] = wal_stats.st_size
+
+    return fingerprint
+
+
+def _pid_running(pid: int) -> bool:
+    """Function that checks if a process with the PID is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to another user
+        return True
+
+    return True
+
+
+def _hash_ids(ind_list: list[str]) -> str:
+    """Function that hashes the sorted set of IDs so that the same IDs in a
+    different order or with duplicates give the same key"""
+    id_hash = hashlib.sha256()
+
+    for grid in sorted(set(ind_list)):
+        id_hash.update(grid.encode("utf-8"))
+        id_hash.update(b"\n")
+
+    return id_hash.hexdigest()
+
+
+class ResultCache:
+    """Class that stores query results on disk so that a query that has
+    already been run against an unchanged database is read back instead of
+    being run again. Each entry is a sequence of .npy arrays: for every batch
+    the IDs that are new to the entry's dictionary followed by the ID1, ID2,
+    and relatedness arrays. Entries are evicted least recently used first
+    once the cache is bigger than max_size"""
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        max_size: int = DEFAULT_CACHE_SIZE * 1024 * 1024,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"ResultCache({self.cache_dir}, max_size={self.max_size})"
+
+    def make_key(
+        self,
+        db_obj: dbResults,
+        ind_list: list[str],
+        all_connections: bool = False,
+        relatedness_threshold: int = 0,
+    ) -> str:
+        """Method that creates the key for a query from the database
+        fingerprint, the table, the ID set, and the query mode
+
+        Parameters
+        ----------
+        db_obj : dbResults
+            object that contains the database path, table name, and backend
+
+        ind_list : list[str]
+            list of individuals in the query
+
+        all_connections : bool
+            whether the query returns all connections or only the pairs
+            where both individuals are in the list
+
+        relatedness_threshold : int
+            relatedness threshold of the query
+
+        Returns
+        -------
+        str
+            returns the hex digest used as the entry's file name
+        """
+        key_fields = {
+            "format_version": CACHE_FORMAT_VERSION,
+            "database": _fingerprint_path(db_obj.database_path),
+            "table": db_obj.table_name,
+            "backend": db_obj.backend.value,
+            "ids": _hash_ids(ind_list),
+            "all_connections": all_connections,
+            "relatedness_threshold": relatedness_threshold,
+        }
+
+        return hashlib.sha256(
+            json.dumps(key_fields, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{CACHE_SUFFIX}"
+
+    def entries(self) -> list[Path]:
+        """Method that returns the cache entries from the least to the most
+        recently used"""
+        return sorted(
+            self.cache_dir.glob(f"*{CACHE_SUFFIX}"),
+            key=lambda entry: entry.stat().st_mtime_ns,
+        )
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self.entries())
+
+    def get(
+        self, key: str, dictionary: IdDictionary | None = None
+    ) -> Generator[PairResults, None, None] | None:
+        """Method that returns a generator of the cached batches for a key
+        or None if the key isn't in the cache. The entry is marked as the
+        most recently used. The batches are encoded with the dictionary if
+        one is given (see read_pair_chunks)"""
+        entry = self.entry_path(key)
+
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+
+        self.logger.info(f"Reading the cached results from {entry}")
+
+        return self._read_entry(entry, dictionary)
+
+    @staticmethod
+    def _read_entry(
+        entry: Path, dictionary: IdDictionary | None
+    ) -> Generator[PairResults, None, None]:
+        with open(entry, "rb") as cache_file:
+            yield from read_pair_chunks(cache_file, dictionary)
+
+    def store(
+        self,
+        key: str,
+        results: Generator[PairResults, None, None],
+        dictionary: IdDictionary | None = None,
+    ) -> Generator[PairResults, None, None]:
+        """Method that writes each batch to the cache as it is returned. The
+        entry is only added to the cache once every batch has been written.
+        If the entry gets bigger than the cache it is abandoned and the
+        remaining batches are returned without being cached
+
+        Parameters
+        ----------
+        key : str
+            key returned by make_key
+
+        results : Generator[PairResults, None, None]
+            batches from the query
+
+        dictionary : IdDictionary | None
+            dictionary that the batches are encoded with. Batches that use a
+            different dictionary are re-encoded before they are written
+
+        Returns
+        -------
+        Generator[PairResults, None, None]
+            returns the same batches as the results generator
+        """
+        entry = self.entry_path(key)
+        partial = entry.with_suffix(f"{CACHE_SUFFIX}.{os.getpid()}{PARTIAL_SUFFIX}")
+
+        completed = False
+
+        cache_file = open(partial, "wb")
+        chunk_writer = PairChunkWriter(cache_file, dictionary)
+
+        try:
+            for batch in results:
+                if cache_file is not None:
+                    chunk_writer.write(batch)
+
+                    if cache_file.tell() > self.max_size:
+                        self.logger.warning(
+                            f"The results are bigger than the cache size of {self.max_size} bytes so they will not be cached"
+                        )
+                        cache_file.close()
+                        cache_file = None
+                        partial.unlink()
+
+                yield batch
+
+            completed = True
+        finally:
+            if cache_file is not None:
+                cache_file.close()
+
+                if completed:
+                    os.replace(partial, entry)
+                    self.logger.info(f"Cached the results in {entry}")
+                    self.evict()
+                else:
+                    partial.unlink(missing_ok=True)
+
+    def remove_stale_partials(self) -> list[Path]:
+        """Method that removes the entries that were being written by a
+        process that was killed. The PID of the writing process is part of
+        each partial file name so a file is removed if that process is no
+        longer running or if the file is older than STALE_PARTIAL_SECONDS
+
+        Returns
+        -------
+        list[Path]
+            returns the partial files that were removed
+        """
+        removed = []
+
+        for partial in self.cache_dir.glob(f"*{CACHE_SUFFIX}.*{PARTIAL_SUFFIX}"):
+            pid = partial.name.removesuffix(PARTIAL_SUFFIX).rsplit(".", 1)[-1]
+
+            try:
+                age = time.time() - partial.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            if pid.isdigit() and _pid_running(int(pid)) and age < STALE_PARTIAL_SECONDS:
+                continue
+
+            partial.unlink(missing_ok=True)
+            removed.append(partial)
+
+            self.logger.info(f"Removed the abandoned cache file {partial}")
+
+        return removed
+
+    def evict(self) -> list[Path]:
+        """Method that removes the least recently used entries until the
+        cache is smaller than max_size. Abandoned partial entries are
+        removed first (see remove_stale_partials)
+
+        Returns
+        -------
+        list[Path]
+            returns the entries that were removed
+        """
+        self.remove_stale_partials()
+
+        entries = self.entries()
+        total_size = sum(entry.stat().st_size for entry in entries)
+
+        evicted = []
+
+        for entry in entries:
+            if total_size <= self.max_size:
+                break
+
+            total_size -= entry.stat().st_size
+            entry.unlink()
+            evicted.append(entry)
+
+            self.logger.info(f"Evicted the cache entry {entry}")
+
+        return evicted
+
+
+@log_msg_debug("Checking the result cache before running the query.")
+def get_cached_relatedness(
+    ind_list: list[str],
+    db_obj: dbResults,
+    cache: ResultCache,
+    logger: logging.Logger,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    workers: int = 1,
+    dictionary: IdDictionary | None = None,
+) -> Generator[PairResults, None, None]:
+    """Function that returns the results of get_relatedness from the cache
+    if the same query has been run against the unchanged database. Otherwise
+    the query is run and the results are written to the cache as they are
+    returned
+
+    Parameters
+    ----------
+    ind_list : list[str]
+        list of individuals to find in the database
+
+    db_obj : dbResults
+        object that contains the database path, table name, and backend
+
+    cache : ResultCache
+        cache to read the results from or write them to
+
+    logger : logging.Logger
+        logging object
+
+    all_connections : bool
+        whether to return all connections or only the pairs where both
+        individuals are in the list
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    workers : int
+        number of processes to split the query across
+
+    dictionary : IdDictionary | None
+        dictionary to encode the IDs with whether the results come from the
+        cache or the query. A new dictionary is created if one isn't given
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of PairResults batches
+    """
+    key = cache.make_key(db_obj, ind_list, all_connections, relatedness_threshold)
+
+    dictionary = dictionary if dictionary is not None else IdDictionary()
+
+    cached_results = cache.get(key, dictionary)
+
+    if cached_results is not None:
+        return cached_results
+
+    logger.info("The query was not in the result cache")
+
+    return cache.store(
+        key,
+        get_relatedness(
+            ind_list,
+            db_obj,
+            logger=logger,
+            all_connections=all_connections,
+            relatedness_threshold=relatedness_threshold,
+            workers=workers,
+            dictionary=dictionary,
+        ),
+        dictionary,
+    )
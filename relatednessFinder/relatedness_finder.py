@@ -2,10 +2,12 @@
 
 from datetime import datetime
 from pathlib import Path
+from typing import List
 
 import analysis
 import database
 import log
+import server
 import typer
 import utilities
 
@@ -20,22 +22,39 @@ def determine_relatedness(
         "--grid-file",
         help="Filepath to a tab separated text file that has a list of grids. Program expects for there to be two columns: grid and phenotype. Phenotype should have 1 for cases or 0 for controls. If you do not need to differientiate between cases and controls then just label all individuals as either 0 or 1. The file should not have a header",
     ),
-    database_path: Path = typer.Option(
+    database_paths: List[Path] = typer.Option(
         ...,
         "-d",
         "--database-path",
-        help="path to the database that has the relatedness values for each pair.",
+        help="path to the database that has the relatedness values for each pair. This can be given several times to query several databases at the same time and merge the results. The databases are listed in order of priority.",
     ),
-    table_name: str = typer.Option(
-        ..., "-t", "--table-name", help="name of the table within the database"
+    table_names: List[str] = typer.Option(
+        ...,
+        "-t",
+        "--table-name",
+        help="name of the table within the database. If several databases are given then this can either be given once for every database or once for each database in the same order.",
     ),
     output_path: Path = typer.Option(
         Path("./test.txt"), "-o", "--output", help="Filepath to write the output to."
     ),
+    output_format: utilities.OutputFormat = typer.Option(
+        utilities.OutputFormat.TSV.value,
+        "--output-format",
+        "-f",
+        help="Format to write the pairs in. 'tsv' is a tab separated text file and 'gzip' is the same file gzip compressed. 'binary' writes integer coded ID and relatedness arrays with a dictionary of the IDs in the numpy npy format. 'arrow' and 'parquet' write arrow IPC and parquet files and need the pyarrow package.",
+        case_sensitive=True,
+    ),
+    compression_level: int = typer.Option(
+        utilities.DEFAULT_COMPRESSION_LEVEL,
+        "--compression-level",
+        help="Compression level for the gzip and parquet output formats. Lower levels are faster while higher levels make smaller files.",
+        min=1,
+        max=9,
+    ),
     relatedness_threshold: int = typer.Option(
         0,
         "--rel-threshold",
-        help="Relatedness threshold. Pairs with estimated relatedness values higher than this will be removed. 0 is the default and will keep individuals who are not related. Values should be between 0 and 9.",
+        help="Relatedness threshold. Pairs with estimated relatedness values higher than this will be removed by the database query. 0 is the default and will keep every pair. Values should be between 0 and 9.",
     ),
     loglevel: utilities.LogLevel = typer.Option(
         utilities.LogLevel.WARNING.value,
@@ -61,11 +80,101 @@ def determine_relatedness(
         help="Normal the program only returns estimated relatedness for pairs where both individuals are in the grid file. If this flag is passed then the program will return all potential connections including individuals that are not in the grid file.",
         is_flag=True,
     ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-w",
+        help="Number of processes to split the query across. The IDs are split into shards that are queried in parallel over read only connections to the database. The default of 1 runs the query on a single connection.",
+        min=1,
+    ),
+    backend: database.Backend = typer.Option(
+        database.Backend.SQLITE.value,
+        "--backend",
+        "-b",
+        help="Backend to query. 'sqlite' queries the database directly while 'compiled' reads a memory mapped index created by the compile command. For the compiled backend the database path should be the index directory.",
+        case_sensitive=True,
+    ),
+    profile: database.ConnectionProfile = typer.Option(
+        database.ConnectionProfile.READ.value,
+        "--profile",
+        help="Connection profile used to open the sqlite database. 'read' opens the database read only with memory mapping, a larger page cache, and in memory temporary tables. 'immutable' also tells sqlite that the database can't change so it skips locking. Only use it if nothing writes to the database while the command runs. 'default' uses sqlite's default settings.",
+        case_sensitive=True,
+    ),
+    no_cache: bool = typer.Option(
+        False,
+        "--no-cache",
+        help="Optional flag to skip the result cache. By default the results of each query are cached on disk and a repeated query against the same unchanged database and IDs is read from the cache instead of the database.",
+        is_flag=True,
+    ),
+    cache_dir: Path = typer.Option(
+        database.DEFAULT_CACHE_DIR,
+        "--cache-dir",
+        help="Directory to store the cached query results in.",
+    ),
+    cache_size: int = typer.Option(
+        database.DEFAULT_CACHE_SIZE,
+        "--cache-size",
+        help="Maximum size of the result cache in megabytes. The least recently used results are removed once the cache is bigger than this. Results bigger than the cache are not cached.",
+        min=0,
+    ),
+    pipeline: bool = typer.Option(
+        False,
+        "--pipeline",
+        help="Optional flag to read the results from the database on a separate thread while the output file is written. The reader can get a few large batches ahead of the writer so the database and the disk are busy at the same time. This helps when the output is written to a slow or network filesystem.",
+        is_flag=True,
+    ),
+    server_url: str = typer.Option(
+        None,
+        "--server",
+        help="Address of a server started with the serve command, such as http://127.0.0.1:8765. If this is given then the query is sent to the server instead of opening the database. The database path and table name have to match the ones that the server has open.",
+    ),
+    metrics_file: Path = typer.Option(
+        None,
+        "--metrics",
+        help="Optional json file to write a report of the wall and cpu time, rows, batches, and bytes for each stage of the command and the peak memory usage to.",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        "--incremental",
+        help="Optional flag to refresh the output of a previous run instead of writing it from scratch. A watermark with the largest row ID in the pair table is saved next to the output. The next run with this flag only queries the rows added to the table since and appends them to the output. If the watermark is missing or doesn't match the database, IDs, or options then every pair is written again. Only the tsv, gzip, and binary formats and the sqlite backend can be used.",
+        is_flag=True,
+    ),
+    on_conflict: database.ConflictResolution = typer.Option(
+        database.ConflictResolution.FIRST.value,
+        "--on-conflict",
+        help="How to resolve a pair that is in more than one database when several databases are given. 'first' keeps the pair from the first database that has it. 'closest' keeps the pair from the database with the closest estimated relatedness. 'all' keeps every copy of the pair and is the fastest since the pairs don't have to be compared.",
+        case_sensitive=True,
+    ),
+    sort_output: bool = typer.Option(
+        False,
+        "--sort",
+        help="Optional flag to write each pair once with the IDs sorted. The IDs in each pair are swapped so that ID1 sorts before ID2, pairs that are returned more than once are only written once with the closest relatedness, and the pairs are sorted by ID1 and then ID2. Pairs that don't fit in --sort-memory are sorted in runs on disk and merged.",
+        is_flag=True,
+    ),
+    sort_memory: int = typer.Option(
+        utilities.DEFAULT_SORT_MEMORY,
+        "--sort-memory",
+        help="Approximate amount of memory in megabytes that --sort can use for the pairs before they are written to spill files on disk.",
+        min=1,
+    ),
+    spill_dir: Path = typer.Option(
+        None,
+        "--spill-dir",
+        help="Directory that --sort writes its spill files to. The system's temporary directory is used by default. The files are removed once the output is written.",
+    ),
+    summary: bool = typer.Option(
+        False,
+        "--summary",
+        help="Optional flag to write one row for each individual in the grid file instead of the pairs. Each row has the number of relatives, the closest relatedness and closest relative, and the number of relatives at each relatedness value. The pairs are counted as they are read so they are never all held in memory. Only the tsv and gzip formats can be used.",
+        is_flag=True,
+    ),
 ) -> None:
     """Main function to pull the relatedness from the ersa database"""
     # getting the programs start time
     start_time = datetime.now()
 
+    metrics = utilities.Metrics("determine-relatedness")
+
     # creating the logger and then configuring it
     logger = log.create_logger()
 
@@ -81,35 +190,424 @@ def determine_relatedness(
     log.record_inputs(
         logger,
         grid_file_path=grid_file,
-        database_path=database_path,
-        database_table_path=table_name,
+        database_path=database_paths,
+        database_table_path=table_names,
+        on_conflict=on_conflict,
         output_path=output_path,
+        output_format=output_format,
+        compression_level=compression_level,
+        relatedness_threshold=relatedness_threshold,
+        all_connections=all_connections,
+        workers=workers,
+        backend=backend,
+        profile=profile,
+        no_cache=no_cache,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        pipeline=pipeline,
+        server_url=server_url,
+        metrics_file=metrics_file,
+        incremental=incremental,
+        sort_output=sort_output,
+        sort_memory=sort_memory,
+        spill_dir=spill_dir,
+        summary=summary,
         loglevel=loglevel,
         log_filename=log_filename,
     )
 
     logger.info(f"analysis start time: {start_time}")
 
+    try:
+        sources = database.build_sources(
+            database_paths, table_names, backend=backend, profile=profile
+        )
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+
+    database_obj = sources[0]
+
+    if len(sources) > 1 and (server_url or incremental):
+        raise typer.BadParameter(
+            "Only one database can be given with --server or --incremental"
+        )
+
+    # sorting needs every pair so it can't be done on pairs that are appended
+    # to a previous output or copied straight from the server's response
+    if sort_output and (server_url or incremental):
+        raise typer.BadParameter("--sort can't be used with --server or --incremental")
+
+    if summary:
+        # the summary is counted from the pairs as they are read so it can't
+        # be added to or be copied from the server's response
+        if server_url or incremental:
+            raise typer.BadParameter(
+                "--summary can't be used with --server or --incremental"
+            )
+        if output_format not in (
+            utilities.OutputFormat.TSV,
+            utilities.OutputFormat.GZIP,
+        ):
+            raise typer.BadParameter(
+                f"The {output_format.value} output format can't be used with --summary. Use the tsv or gzip format instead"
+            )
+
+    if incremental:
+        # a refresh appends the new pairs to the previous output so the
+        # output has to come from this program and be in a format that can
+        # be appended to
+        if server_url:
+            raise typer.BadParameter("--incremental can't be used with --server")
+        if backend != database.Backend.SQLITE:
+            raise typer.BadParameter(
+                "--incremental needs the row IDs of the pair table so it can only be used with the sqlite backend"
+            )
+        if output_format not in utilities.APPENDABLE_FORMATS:
+            raise typer.BadParameter(
+                f"The {output_format.value} output format can't be used with --incremental. Use the tsv, gzip, or binary format instead"
+            )
+
     # We need to read in the grids. This function return a list of cases and controls. We
     # only need the cases in this situation so we are ignoring the second return
-    with utilities.FileReader(grid_file) as file_reader:
-        grid_list, _ = file_reader.read_in_grids( logger=logger)
+    with metrics.stage("read_grids") as stage_metrics:
+        with utilities.FileReader(grid_file) as file_reader:
+            grid_list, _ = file_reader.read_in_grids(logger=logger)
 
-    # Constructing the grid string for all of the individuals in the query so
-
-    database_obj = database.dbResults(database_path, table_name)
+        stage_metrics.add(ids=len(grid_list))
 
     # run the loop. If this ncounters an error then the user needs to hit control c to exit
-    relatedness_results = database.get_relatedness(
-        grid_list, database_obj, logger=logger, all_connections=all_connections
+    if server_url:
+        # the server returns the tab separated text so it can only be written
+        # as is or compressed
+        if output_format not in (
+            utilities.OutputFormat.TSV,
+            utilities.OutputFormat.GZIP,
+        ):
+            raise typer.BadParameter(
+                f"The {output_format.value} output format can't be used with --server. Use the tsv or gzip format instead"
+            )
+
+        # the server already has the database open so the pairs are copied
+        # straight from its response into the output file
+        with metrics.stage("server_query") as stage_metrics:
+            try:
+                rows_written = server.query_server(
+                    server_url,
+                    grid_list,
+                    output_path,
+                    logger=logger,
+                    database_path=database_obj.database_path,
+                    table_name=database_obj.table_name,
+                    all_connections=all_connections,
+                    relatedness_threshold=relatedness_threshold,
+                    compression_level=(
+                        compression_level
+                        if output_format == utilities.OutputFormat.GZIP
+                        else None
+                    ),
+                )
+            except ConnectionError as e:
+                # the query failed so there isn't an output file to report on
+                logger.critical(e)
+                typer.echo(str(e), err=True)
+                raise typer.Exit(code=1)
+
+            stage_metrics.add(rows=rows_written, bytes=output_path.stat().st_size)
+    else:
+        append = False
+
+        # every batch is encoded with the same dictionary so the summary can
+        # count the pairs without re-encoding them
+        dictionary = database.IdDictionary()
+
+        if incremental:
+            # the cache isn't used since the watermark already limits the
+            # query to the rows that aren't in the output
+            (
+                relatedness_results,
+                watermark,
+                append,
+            ) = database.get_incremental_relatedness(
+                grid_list,
+                database_obj,
+                output_path,
+                logger=logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+                output_format=output_format.value,
+            )
+        elif len(sources) > 1:
+            # the databases are read at the same time and each database's
+            # results are cached separately
+            relatedness_results = database.get_federated_relatedness(
+                grid_list,
+                sources,
+                logger=logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+                resolution=on_conflict,
+                cache=(
+                    None
+                    if no_cache
+                    else database.ResultCache(
+                        cache_dir, cache_size * 1024 * 1024, logger=logger
+                    )
+                ),
+                dictionary=dictionary,
+            )
+        elif no_cache:
+            relatedness_results = database.get_relatedness(
+                grid_list,
+                database_obj,
+                logger=logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+                dictionary=dictionary,
+            )
+        else:
+            result_cache = database.ResultCache(
+                cache_dir, cache_size * 1024 * 1024, logger=logger
+            )
+
+            relatedness_results = database.get_cached_relatedness(
+                grid_list,
+                database_obj,
+                result_cache,
+                logger=logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+                workers=workers,
+                dictionary=dictionary,
+            )
+
+        relatedness_results = metrics.measure_batches("query", relatedness_results)
+
+        if pipeline:
+            relatedness_results = utilities.pipeline_results(relatedness_results)
+
+        if sort_output:
+            relatedness_results = metrics.measure_batches(
+                "sort",
+                utilities.sort_pairs(
+                    relatedness_results,
+                    logger=logger,
+                    memory_limit=sort_memory * 1024 * 1024,
+                    spill_dir=spill_dir,
+                ),
+            )
+
+        if summary:
+            # the pairs are only added to the counters for each individual so
+            # the memory used depends on the number of individuals
+            with metrics.stage("summarize"):
+                relative_summary = analysis.summarize_relatives(
+                    relatedness_results,
+                    grid_list,
+                    logger=logger,
+                    dictionary=dictionary,
+                )
+
+            with metrics.stage("write") as stage_metrics:
+                rows_written = analysis.write_relative_summary(
+                    relative_summary,
+                    output_path,
+                    compression_level=(
+                        compression_level
+                        if output_format == utilities.OutputFormat.GZIP
+                        else None
+                    ),
+                )
+
+                stage_metrics.add(rows=rows_written, bytes=output_path.stat().st_size)
+        else:
+            # The rows are streamed straight from the database to the output file so
+            # that they never all have to be held in memory
+            with metrics.stage("write") as stage_metrics:
+                rows_written = utilities.write_to_file(
+                    relatedness_results,
+                    output_path,
+                    output_format=output_format,
+                    compression_level=compression_level,
+                    append=append,
+                )
+
+                stage_metrics.add(rows=rows_written, bytes=output_path.stat().st_size)
+
+        if incremental:
+            logger.info(
+                f"Saved the watermark to: {database.write_watermark(watermark, output_path)}"
+            )
+
+    logger.info(
+        f"Wrote {rows_written} {'individuals' if summary else 'pairs'} to the file: {output_path}"
     )
 
-    for val in relatedness_results:
-        database_obj.case_results.extend(val)
+    if metrics_file:
+        logger.info(f"Wrote the metrics report to: {metrics.write(metrics_file)}")
 
-    logger.debug(database_obj)
+    end_time = datetime.now()
+
+    logger.info(f"analysis end time: {end_time}")
 
-    utilities.write_to_file(database_obj, output_path, relatedness_threshold)
+    logger.info(f"Analysis runtime: {end_time - start_time}")
+
+
+@app.command(
+    help="Determine the relatedness for several grid files with a single database query"
+)
+def batch(
+    manifest: Path = typer.Option(
+        ...,
+        "-m",
+        "--manifest",
+        help="Filepath to a tab separated text file with a grid file and an output path on each line. Each grid file has the same format as the grid file for the determine-relatedness command. Blank lines and lines starting with # are skipped and relative paths are relative to the manifest's directory.",
+    ),
+    output_format: utilities.OutputFormat = typer.Option(
+        utilities.OutputFormat.TSV.value,
+        "--output-format",
+        "-f",
+        help="Format to write the pairs in. 'tsv' is a tab separated text file and 'gzip' is the same file gzip compressed. 'binary' writes integer coded ID and relatedness arrays with a dictionary of the IDs in the numpy npy format. 'arrow' and 'parquet' write arrow IPC and parquet files and need the pyarrow package.",
+        case_sensitive=True,
+    ),
+    compression_level: int = typer.Option(
+        utilities.DEFAULT_COMPRESSION_LEVEL,
+        "--compression-level",
+        help="Compression level for the gzip and parquet output formats. Lower levels are faster while higher levels make smaller files.",
+        min=1,
+        max=9,
+    ),
+    database_path: Path = typer.Option(
+        ...,
+        "-d",
+        "--database-path",
+        help="path to the database that has the relatedness values for each pair.",
+    ),
+    table_name: str = typer.Option(
+        ..., "-t", "--table-name", help="name of the table within the database"
+    ),
+    relatedness_threshold: int = typer.Option(
+        0,
+        "--rel-threshold",
+        help="Relatedness threshold. Pairs with estimated relatedness values higher than this will be removed by the database query. 0 is the default and will keep every pair. Values should be between 0 and 9.",
+    ),
+    loglevel: utilities.LogLevel = typer.Option(
+        utilities.LogLevel.WARNING.value,
+        "--loglevel",
+        "-l",
+        help="This argument sets the logging level for the program. Accepts values 'debug', 'warning', and 'verbose'.",
+        case_sensitive=True,
+    ),
+    log_to_console: bool = typer.Option(
+        False,
+        "--log-to-console",
+        help="Optional flag to log to only a file or also the console",
+        is_flag=True,
+    ),
+    log_filename: str = typer.Option(
+        "test_batch.log", "--log-filename", help="Name for the log output file."
+    ),
+    all_connections: bool = typer.Option(
+        False,
+        "--all-connections",
+        help="Normal the program only returns estimated relatedness for pairs where both individuals are in the same grid file. If this flag is passed then each output has every pair with at least one individual in that grid file.",
+        is_flag=True,
+    ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-w",
+        help="Number of processes to split the query across.",
+        min=1,
+    ),
+    backend: database.Backend = typer.Option(
+        database.Backend.SQLITE.value,
+        "--backend",
+        "-b",
+        help="Backend to query. 'sqlite' queries the database directly while 'compiled' reads a memory mapped index created by the compile command.",
+        case_sensitive=True,
+    ),
+    profile: database.ConnectionProfile = typer.Option(
+        database.ConnectionProfile.READ.value,
+        "--profile",
+        help="Connection profile used to open the sqlite database. 'read' opens the database read only with memory mapping, a larger page cache, and in memory temporary tables. 'immutable' also tells sqlite that the database can't change so it skips locking. Only use it if nothing writes to the database while the command runs. 'default' uses sqlite's default settings.",
+        case_sensitive=True,
+    ),
+) -> None:
+    # getting the programs start time
+    start_time = datetime.now()
+
+    # creating the logger and then configuring it
+    logger = log.create_logger()
+
+    log.configure(
+        logger,
+        "./",
+        filename=log_filename,
+        loglevel=loglevel,
+        to_console=log_to_console,
+    )
+
+    # recording all the user inputs
+    log.record_inputs(
+        logger,
+        manifest=manifest,
+        output_format=output_format,
+        compression_level=compression_level,
+        database_path=database_path,
+        database_table_path=table_name,
+        relatedness_threshold=relatedness_threshold,
+        all_connections=all_connections,
+        workers=workers,
+        backend=backend,
+        profile=profile,
+        loglevel=loglevel,
+        log_filename=log_filename,
+    )
+
+    logger.info(f"analysis start time: {start_time}")
+
+    cohort_files = utilities.read_manifest(manifest, logger=logger)
+
+    cohorts = []
+
+    for grid_file, _ in cohort_files:
+        with utilities.FileReader(grid_file) as file_reader:
+            grid_list, _ = file_reader.read_in_grids(logger=logger)
+
+        cohorts.append(grid_list)
+
+    database_obj = database.dbResults(
+        database_path, table_name, backend=backend, profile=profile
+    )
+
+    # The union of the cohorts is queried once and each pair is written to
+    # the output of every cohort that it belongs to
+    routed_results = database.get_batch_relatedness(
+        cohorts,
+        database_obj,
+        logger=logger,
+        all_connections=all_connections,
+        relatedness_threshold=relatedness_threshold,
+        workers=workers,
+    )
+
+    rows_written = utilities.write_batches_to_files(
+        routed_results,
+        {
+            cohort_index: output_path
+            for cohort_index, (_, output_path) in enumerate(cohort_files)
+        },
+        output_format=output_format,
+        compression_level=compression_level,
+    )
+
+    for cohort_index, (grid_file, output_path) in enumerate(cohort_files):
+        logger.info(
+            f"Wrote {rows_written[cohort_index]} pairs for the grid file {grid_file} to the file: {output_path}"
+        )
 
     end_time = datetime.now()
 
@@ -138,6 +636,22 @@ def gather_distributions(
         help="Filepath to the sqlite database that has all the information about pairwise relatedness for individuals",
     ),
     table_name: str = typer.Argument(..., help="name of the table within the database"),
+    extra_databases: List[Path] = typer.Option(
+        [],
+        "--extra-database",
+        help="Path to another database to query at the same time as the first one. This can be given several times. The results from every database are merged and the databases are in order of priority after the first one.",
+    ),
+    extra_tables: List[str] = typer.Option(
+        [],
+        "--extra-table",
+        help="Name of the table in each extra database in the same order as --extra-database. If this isn't given then the table name of the first database is used for every database.",
+    ),
+    on_conflict: database.ConflictResolution = typer.Option(
+        database.ConflictResolution.FIRST.value,
+        "--on-conflict",
+        help="How to resolve a pair that is in more than one database when several databases are given. 'first' keeps the pair from the first database that has it. 'closest' keeps the pair from the database with the closest estimated relatedness. 'all' keeps every copy of the pair and is the fastest since the pairs don't have to be compared.",
+        case_sensitive=True,
+    ),
     loglevel: utilities.LogLevel = typer.Option(
         utilities.LogLevel.WARNING.value,
         "--loglevel",
@@ -154,10 +668,54 @@ def gather_distributions(
     log_filename: str = typer.Option(
         "test_distributions.log", "--log-filename", help="Name for the log output file."
     ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-w",
+        help="Number of processes to split the query across. The IDs are split into shards that are queried in parallel over read only connections to the database. The default of 1 runs the query on a single connection.",
+        min=1,
+    ),
+    pair_output: bool = typer.Option(
+        False,
+        "--pair-output",
+        help="Optional flag to also write the case-case, case-control, and control-control pairs to separate files. The files will end in _case_case_pairs.txt, _case_control_pairs.txt, and _control_control_pairs.txt",
+        is_flag=True,
+    ),
+    backend: database.Backend = typer.Option(
+        database.Backend.SQLITE.value,
+        "--backend",
+        "-b",
+        help="Backend to query. 'sqlite' queries the database directly while 'compiled' reads a memory mapped index created by the compile command. For the compiled backend the database path should be the index directory.",
+        case_sensitive=True,
+    ),
+    profile: database.ConnectionProfile = typer.Option(
+        database.ConnectionProfile.READ.value,
+        "--profile",
+        help="Connection profile used to open the sqlite database. 'read' opens the database read only with memory mapping, a larger page cache, and in memory temporary tables. 'immutable' also tells sqlite that the database can't change so it skips locking. Only use it if nothing writes to the database while the command runs. 'default' uses sqlite's default settings.",
+        case_sensitive=True,
+    ),
+    metrics_file: Path = typer.Option(
+        None,
+        "--metrics",
+        help="Optional json file to write a report of the wall and cpu time, rows, batches, and bytes for each stage of the command and the peak memory usage to.",
+    ),
+    permutations: int = typer.Option(
+        0,
+        "--permutations",
+        help="Number of times to shuffle the case and control labels for a permutation test of whether the cases are more related to each other than expected. The statistics and empirical p-values for each relatedness value are written to a file ending in _enrichment.txt. The default of 0 skips the test. The permutations are split across the --workers processes.",
+        min=0,
+    ),
+    seed: int = typer.Option(
+        0,
+        "--seed",
+        help="Seed for the label shuffles of the permutation test. The results are the same for a seed no matter how many workers are used.",
+    ),
 ) -> None:
     # getting the programs start time
     start_time = datetime.now()
 
+    metrics = utilities.Metrics("gather-distributions")
+
     # creating the logger and then configuring it
     logger = log.create_logger()
 
@@ -174,50 +732,602 @@ def gather_distributions(
         logger,
         case_control_filepath=case_control_file,
         database_path=database_path,
+        table_name=table_name,
+        extra_databases=extra_databases,
+        extra_tables=extra_tables,
+        on_conflict=on_conflict,
         output_path=output,
+        workers=workers,
+        pair_output=pair_output,
+        backend=backend,
+        profile=profile,
+        metrics_file=metrics_file,
+        permutations=permutations,
+        seed=seed,
         loglevel=loglevel,
         log_filename=log_filename,
     )
 
     logger.info(f"analysis start time: {start_time}")
 
-    with utilities.FileReader(case_control_file) as file_reader:
-        cases, controls = file_reader.read_in_grids(
-            logger=logger, case_and_control=True
+    with metrics.stage("read_grids") as stage_metrics:
+        with utilities.FileReader(case_control_file) as file_reader:
+            cases, controls = file_reader.read_in_grids(
+                logger=logger, cases_and_control=True
+            )
+
+        stage_metrics.add(ids=len(cases) + len(controls))
+
+    try:
+        sources = database.build_sources(
+            [database_path, *extra_databases],
+            [table_name, *extra_tables] if extra_tables else [table_name],
+            backend=backend,
+            profile=profile,
         )
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
 
-    database_obj = database.dbResults(database_path, table_name)
+    # The cases and controls are queried together in a single pass and each
+    # pair is labeled as case-case, case-control, or control-control. The
+    # permutation test needs the pairs themselves so with --permutations the
+    # counts come from the same pairs instead of a second query
+    dictionary = database.IdDictionary()
+    enrichment = None
+
+    if pair_output or permutations:
+        logger.info("Identifying relatedness for cases and controls")
+
+        classified_results = metrics.measure_batches(
+            "query",
+            database.get_federated_classified_relatedness(
+                cases,
+                controls,
+                sources,
+                logger=logger,
+                workers=workers,
+                resolution=on_conflict,
+                dictionary=dictionary,
+            )
+            if len(sources) > 1
+            else database.get_classified_relatedness(
+                cases,
+                controls,
+                sources[0],
+                logger=logger,
+                workers=workers,
+                dictionary=dictionary,
+            ),
+        )
+
+        if pair_output:
+            pair_files = {
+                pair_class: output.parent / f"{output.name}_{class_name}_pairs.txt"
+                for pair_class, class_name in database.PAIR_CLASSES.items()
+            }
+
+            # the pairs are kept after they are written if the permutation
+            # test is going to use them
+            if permutations:
+                classified_results = list(classified_results)
+
+            with metrics.stage("write") as stage_metrics:
+                class_counts = utilities.write_classified_to_files(
+                    iter(classified_results), pair_files
+                )
+
+                stage_metrics.add(
+                    rows=sum(sum(counts.values()) for counts in class_counts.values()),
+                    bytes=sum(
+                        pair_file.stat().st_size for pair_file in pair_files.values()
+                    ),
+                )
+
+            pair_counts = {
+                database.PAIR_CLASSES[pair_class]: dict(
+                    sorted(counts.items(), key=lambda item: (item[0] is None, item[0]))
+                )
+                for pair_class, counts in class_counts.items()
+            }
+
+            for pair_class, pair_file in pair_files.items():
+                logger.info(
+                    f"Wrote the {database.PAIR_CLASSES[pair_class]} pairs to: {pair_file}"
+                )
+        else:
+            # the pairs are counted as the permutation test reads them
+            counter = database.PairClassCounter()
+            classified_results = counter.count(classified_results)
+
+        if permutations:
+            logger.info(
+                f"Running a permutation test with {permutations} permutations of the case and control labels"
+            )
+
+            with metrics.stage("permutation_test"):
+                enrichment = analysis.permutation_test(
+                    classified_results,
+                    cases,
+                    controls,
+                    logger=logger,
+                    permutations=permutations,
+                    workers=workers,
+                    seed=seed,
+                    dictionary=dictionary,
+                )
+
+            if not pair_output:
+                pair_counts = counter.to_dict()
+    else:
+        # The pairs are counted at each relatedness value inside of the
+        # database so only a small table of counts is returned for each class
+        logger.info("Identifying relatedness for cases and controls")
+
+        with metrics.stage("query") as stage_metrics:
+            if len(sources) > 1:
+                pair_counts = database.get_federated_classified_relatedness_counts(
+                    cases,
+                    controls,
+                    sources,
+                    logger=logger,
+                    workers=workers,
+                    resolution=on_conflict,
+                )
+            else:
+                pair_counts = database.get_classified_relatedness_counts(
+                    cases, controls, sources[0], logger=logger, workers=workers
+                )
+
+            stage_metrics.add(
+                rows=sum(sum(counts.values()) for counts in pair_counts.values())
+            )
+
+    with metrics.stage("summarize"):
+        for class_name, counts in pair_counts.items():
+            summary = analysis.summarize_distribution(counts)
+
+            logger.info(
+                f"Identified {summary['pairs']} {class_name} relatedness values from the database"
+            )
+            logger.info(f"Summary of the {class_name} relatedness values: {summary}")
+
+        counts_file = analysis.write_distribution_table(pair_counts, output)
+
+        if enrichment is not None:
+            enrichment_file = analysis.write_enrichment_table(enrichment, output)
+
+    logger.info(f"Wrote the counts at each relatedness value to: {counts_file}")
+
+    if enrichment is not None:
+        logger.info(f"Wrote the permutation test results to: {enrichment_file}")
+
+    logger.info(
+        "Plotting distributions of relatedness values for cases, controls, and case-control pairs"
+    )
+
+    with metrics.stage("plot"):
+        analysis.plot_distribution(
+            pair_counts["case_case"], output, "cases.png", logger=logger
+        )
+
+        analysis.plot_distribution(
+            pair_counts["control_control"], output, "contols.png", logger=logger
+        )
+
+        analysis.plot_distribution(
+            pair_counts["case_control"], output, "case_control.png", logger=logger
+        )
+
+    if metrics_file:
+        logger.info(f"Wrote the metrics report to: {metrics.write(metrics_file)}")
+
+    end_time = datetime.now()
+
+    logger.info(f"analysis end time: {end_time}")
+
+    logger.info(f"Analysis runtime: {end_time - start_time}")
+
+
+@app.command(
+    help="Find the individuals to remove so that no two of the remaining individuals are related"
+)
+def prune_related(
+    grid_file: Path = typer.Option(
+        ...,
+        "-g",
+        "--grid-file",
+        help="Filepath to a tab separated text file that has a list of grids. Program expects for there to be two columns: grid and phenotype. Phenotype should have 1 for cases or 0 for controls.",
+    ),
+    database_path: Path = typer.Option(
+        ...,
+        "-d",
+        "--database-path",
+        help="path to the database that has the relatedness values for each pair.",
+    ),
+    table_name: str = typer.Option(
+        ..., "-t", "--table-name", help="name of the table within the database"
+    ),
+    output: Path = typer.Option(
+        ...,
+        "-o",
+        "--output",
+        help="Output for all output files. This should be a directory and then the file name without an extension. The files will end in _removed.txt, _kept.txt, and _clusters.txt",
+    ),
+    relatedness_threshold: int = typer.Option(
+        3,
+        "--rel-threshold",
+        help="Relatedness threshold. Pairs with an estimated relatedness less than or equal to this value are related. The default of 3 treats third degree relatives and closer as related. A value of 0 treats every pair in the table as related.",
+        min=0,
+    ),
+    keep_cases: bool = typer.Option(
+        False,
+        "--keep-cases",
+        help="Optional flag to remove the control when a case and a control have the same number of relatives so that more cases are kept.",
+        is_flag=True,
+    ),
+    loglevel: utilities.LogLevel = typer.Option(
+        utilities.LogLevel.WARNING.value,
+        "--loglevel",
+        "-l",
+        help="This argument sets the logging level for the program. Accepts values 'debug', 'warning', and 'verbose'.",
+        case_sensitive=True,
+    ),
+    log_to_console: bool = typer.Option(
+        False,
+        "--log-to-console",
+        help="Optional flag to log to only a file or also the console",
+        is_flag=True,
+    ),
+    log_filename: str = typer.Option(
+        "test_prune_related.log", "--log-filename", help="Name for the log output file."
+    ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-w",
+        help="Number of processes to split the query across.",
+        min=1,
+    ),
+    backend: database.Backend = typer.Option(
+        database.Backend.SQLITE.value,
+        "--backend",
+        "-b",
+        help="Backend to query. 'sqlite' queries the database directly while 'compiled' reads a memory mapped index created by the compile command. For the compiled backend the database path should be the index directory.",
+        case_sensitive=True,
+    ),
+    profile: database.ConnectionProfile = typer.Option(
+        database.ConnectionProfile.READ.value,
+        "--profile",
+        help="Connection profile used to open the sqlite database. See determine-relatedness --help for the profiles.",
+        case_sensitive=True,
+    ),
+) -> None:
+    # getting the programs start time
+    start_time = datetime.now()
 
-    logger.info("Identifying relatedness for cases")
-    case_rel_results = database.get_relatedness(cases, database_obj, logger=logger)
+    # creating the logger and then configuring it
+    logger = log.create_logger()
 
-    database_obj.case_results = analysis.generate_results_list(case_rel_results, logger)
+    log.configure(
+        logger,
+        "./",
+        filename=log_filename,
+        loglevel=loglevel,
+        to_console=log_to_console,
+    )
 
-    logger.info("Identifying relatedness for controls")
-    control_rel_results = database.get_relatedness(
-        controls, database_obj, logger=logger
+    # recording all the user inputs
+    log.record_inputs(
+        logger,
+        grid_file_path=grid_file,
+        database_path=database_path,
+        database_table_path=table_name,
+        output_path=output,
+        relatedness_threshold=relatedness_threshold,
+        keep_cases=keep_cases,
+        workers=workers,
+        backend=backend,
+        profile=profile,
+        loglevel=loglevel,
+        log_filename=log_filename,
     )
 
-    database_obj.control_results = analysis.generate_results_list(
-        control_rel_results, logger
+    logger.info(f"analysis start time: {start_time}")
+
+    with utilities.FileReader(grid_file) as file_reader:
+        cases, controls = file_reader.read_in_grids(
+            logger=logger, cases_and_control=True
+        )
+
+    database_obj = database.dbResults(
+        database_path, table_name, backend=backend, profile=profile
     )
 
-    logger.info(
-        f"Identified {len(database_obj.case_results)} case relatedness values and {len(database_obj.control_results)} control relatedness values from the database"
+    # the pairs share the dictionary used for the graph so they are read
+    # straight into the graph's integer arrays
+    dictionary = database.IdDictionary()
+
+    removed_ids, kept_ids, clusters = analysis.prune_related(
+        database.get_relatedness(
+            cases + controls,
+            database_obj,
+            logger=logger,
+            relatedness_threshold=relatedness_threshold,
+            workers=workers,
+            dictionary=dictionary,
+        ),
+        cases,
+        controls,
+        logger=logger,
+        keep_cases=keep_cases,
+        dictionary=dictionary,
+    )
+
+    removed_file, kept_file, clusters_file = analysis.write_pruning_results(
+        removed_ids, kept_ids, clusters, output
     )
 
     logger.info(
-        "Plotting distributions of relatedness values for cases and then for controls"
+        f"Wrote the {len(removed_ids)} individuals to remove to: {removed_file}"
     )
+    logger.info(f"Wrote the {len(kept_ids)} individuals to keep to: {kept_file}")
+    logger.info(f"Wrote the cluster of each related individual to: {clusters_file}")
+
+    end_time = datetime.now()
+
+    logger.info(f"analysis end time: {end_time}")
+
+    logger.info(f"Analysis runtime: {end_time - start_time}")
+
 
-    analysis.plot_distribution(
-        database_obj.case_results, output, "cases.png", logger=logger
+@app.command(
+    help="Build the covering indexes on the pair table that the other commands rely on"
+)
+def build_index(
+    database_path: Path = typer.Option(
+        ...,
+        "-d",
+        "--database-path",
+        help="path to the database that has the relatedness values for each pair.",
+    ),
+    table_name: str = typer.Option(
+        ..., "-t", "--table-name", help="name of the table within the database"
+    ),
+    loglevel: utilities.LogLevel = typer.Option(
+        utilities.LogLevel.WARNING.value,
+        "--loglevel",
+        "-l",
+        help="This argument sets the logging level for the program. Accepts values 'debug', 'warning', and 'verbose'.",
+        case_sensitive=True,
+    ),
+    log_to_console: bool = typer.Option(
+        False,
+        "--log-to-console",
+        help="Optional flag to log to only a file or also the console",
+        is_flag=True,
+    ),
+    log_filename: str = typer.Option(
+        "test_build_index.log", "--log-filename", help="Name for the log output file."
+    ),
+) -> None:
+    # getting the programs start time
+    start_time = datetime.now()
+
+    # creating the logger and then configuring it
+    logger = log.create_logger()
+
+    log.configure(
+        logger,
+        "./",
+        filename=log_filename,
+        loglevel=loglevel,
+        to_console=log_to_console,
     )
 
-    analysis.plot_distribution(
-        database_obj.control_results, output, "contols.png", logger=logger
+    # recording all the user inputs
+    log.record_inputs(
+        logger,
+        database_path=database_path,
+        database_table_path=table_name,
+        loglevel=loglevel,
+        log_filename=log_filename,
     )
 
+    logger.info(f"analysis start time: {start_time}")
+
+    database_obj = database.dbResults(database_path, table_name)
+
+    database.build_indexes(database_obj, logger=logger)
+
+    end_time = datetime.now()
+
+    logger.info(f"analysis end time: {end_time}")
+
+    logger.info(f"Analysis runtime: {end_time - start_time}")
+
+
+@app.command(
+    "compile",
+    help="Compile the pair table into a memory mapped index that can be queried with the compiled backend",
+)
+def compile_index(
+    database_path: Path = typer.Option(
+        ...,
+        "-d",
+        "--database-path",
+        help="path to the database that has the relatedness values for each pair.",
+    ),
+    table_name: str = typer.Option(
+        ..., "-t", "--table-name", help="name of the table within the database"
+    ),
+    output: Path = typer.Option(
+        ...,
+        "-o",
+        "--output",
+        help="Directory to write the compiled index to. This directory is passed as the database path when using the compiled backend.",
+    ),
+    profile: database.ConnectionProfile = typer.Option(
+        database.ConnectionProfile.READ.value,
+        "--profile",
+        help="Connection profile used to open the sqlite database. 'read' opens the database read only with memory mapping, a larger page cache, and in memory temporary tables. 'immutable' also tells sqlite that the database can't change so it skips locking. Only use it if nothing writes to the database while the command runs. 'default' uses sqlite's default settings.",
+        case_sensitive=True,
+    ),
+    loglevel: utilities.LogLevel = typer.Option(
+        utilities.LogLevel.WARNING.value,
+        "--loglevel",
+        "-l",
+        help="This argument sets the logging level for the program. Accepts values 'debug', 'warning', and 'verbose'.",
+        case_sensitive=True,
+    ),
+    log_to_console: bool = typer.Option(
+        False,
+        "--log-to-console",
+        help="Optional flag to log to only a file or also the console",
+        is_flag=True,
+    ),
+    log_filename: str = typer.Option(
+        "test_compile.log", "--log-filename", help="Name for the log output file."
+    ),
+) -> None:
+    # getting the programs start time
+    start_time = datetime.now()
+
+    # creating the logger and then configuring it
+    logger = log.create_logger()
+
+    log.configure(
+        logger,
+        "./",
+        filename=log_filename,
+        loglevel=loglevel,
+        to_console=log_to_console,
+    )
+
+    # recording all the user inputs
+    log.record_inputs(
+        logger,
+        database_path=database_path,
+        database_table_path=table_name,
+        output_path=output,
+        profile=profile,
+        loglevel=loglevel,
+        log_filename=log_filename,
+    )
+
+    logger.info(f"analysis start time: {start_time}")
+
+    database_obj = database.dbResults(database_path, table_name, profile=profile)
+
+    database.compile_database(database_obj, output, logger=logger)
+
+    end_time = datetime.now()
+
+    logger.info(f"analysis end time: {end_time}")
+
+    logger.info(f"Analysis runtime: {end_time - start_time}")
+
+
+@app.command(
+    help="Keep the database open and answer relatedness queries from determine-relatedness --server over localhost HTTP"
+)
+def serve(
+    database_path: Path = typer.Option(
+        ...,
+        "-d",
+        "--database-path",
+        help="path to the database that has the relatedness values for each pair.",
+    ),
+    table_name: str = typer.Option(
+        ..., "-t", "--table-name", help="name of the table within the database"
+    ),
+    host: str = typer.Option(
+        server.DEFAULT_HOST,
+        "--host",
+        help="Address to listen on. The default only accepts connections from the same machine.",
+    ),
+    port: int = typer.Option(
+        server.DEFAULT_PORT, "--port", "-p", help="Port to listen on."
+    ),
+    connections: int = typer.Option(
+        server.DEFAULT_CONNECTIONS,
+        "--connections",
+        help="Number of read only database connections to keep open. This is the number of queries that can run at the same time with the sqlite backend.",
+        min=1,
+    ),
+    backend: database.Backend = typer.Option(
+        database.Backend.SQLITE.value,
+        "--backend",
+        "-b",
+        help="Backend to serve. 'sqlite' queries the database directly while 'compiled' reads a memory mapped index created by the compile command.",
+        case_sensitive=True,
+    ),
+    profile: database.ConnectionProfile = typer.Option(
+        database.ConnectionProfile.READ.value,
+        "--profile",
+        help="Connection profile used to open the sqlite database. 'read' opens the database read only with memory mapping, a larger page cache, and in memory temporary tables. 'immutable' also tells sqlite that the database can't change so it skips locking. Only use it if nothing writes to the database while the command runs. 'default' uses sqlite's default settings.",
+        case_sensitive=True,
+    ),
+    loglevel: utilities.LogLevel = typer.Option(
+        utilities.LogLevel.WARNING.value,
+        "--loglevel",
+        "-l",
+        help="This argument sets the logging level for the program. Accepts values 'debug', 'warning', and 'verbose'.",
+        case_sensitive=True,
+    ),
+    log_to_console: bool = typer.Option(
+        False,
+        "--log-to-console",
+        help="Optional flag to log to only a file or also the console",
+        is_flag=True,
+    ),
+    log_filename: str = typer.Option(
+        "test_serve.log", "--log-filename", help="Name for the log output file."
+    ),
+) -> None:
+    # getting the programs start time
+    start_time = datetime.now()
+
+    # creating the logger and then configuring it
+    logger = log.create_logger()
+
+    log.configure(
+        logger,
+        "./",
+        filename=log_filename,
+        loglevel=loglevel,
+        to_console=log_to_console,
+    )
+
+    # recording all the user inputs
+    log.record_inputs(
+        logger,
+        database_path=database_path,
+        database_table_path=table_name,
+        host=host,
+        port=port,
+        connections=connections,
+        backend=backend,
+        profile=profile,
+        loglevel=loglevel,
+        log_filename=log_filename,
+    )
+
+    logger.info(f"analysis start time: {start_time}")
+
+    database_obj = database.dbResults(
+        database_path, table_name, backend=backend, profile=profile
+    )
+
+    with server.QueryServer(
+        (host, port), database_obj, logger, connections=connections
+    ) as query_server:
+        logger.warning(f"Serving relatedness queries at http://{host}:{port}")
+
+        try:
+            query_server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Shutting down the server")
+
     end_time = datetime.now()
 
     logger.info(f"analysis end time: {end_time}")
@@ -0,0 +1,16 @@
+from _lazy import lazy_exports
+
+# module that each exported name is defined in. The modules are only imported
+# once one of their names is used so that a command doesn't import the http
+# server and client unless it needs them
+_EXPORTS = {
+    "query_server": ".client",
+    "DEFAULT_CONNECTIONS": ".options",
+    "DEFAULT_HOST": ".options",
+    "DEFAULT_PORT": ".options",
+    "QueryServer": ".http_server",
+}
+
+__all__ = list(_EXPORTS)
+
+__getattr__, __dir__ = lazy_exports(globals(), _EXPORTS)
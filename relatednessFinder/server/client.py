@@ -0,0 +1,139 @@
+import gzip
+import http.client
+import json
+import logging
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from .http_server import RELATEDNESS_PATH
+
+# number of bytes to copy from the response to the output file at a time
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def query_server(
+    server_url: str,
+    ind_list: list[str],
+    output_filename: Path,
+    logger: logging.Logger,
+    database_path: Path | None = None,
+    table_name: str | None = None,
+    all_connections: bool = False,
+    relatedness_threshold: int = 0,
+    timeout: float | None = None,
+    compression_level: int | None = None,
+) -> int:
+    """Function that sends a relatedness query to a server started with the
+    serve command and streams the pairs that it returns to a file. If the
+    response ends before every pair was sent then the partly written file
+    is removed so that it isn't mistaken for a complete result
+
+    Parameters
+    ----------
+    server_url : str
+        address of the server such as http://127.0.0.1:8765
+
+    ind_list : list[str]
+        list of individuals to find in the database
+
+    output_filename : Path
+        Path to the output file
+
+    logger : logging.Logger
+        logging object
+
+    database_path : Path | None
+        database that the query is for. The server refuses the query if it
+        is serving a different database
+
+    table_name : str | None
+        table that the query is for. The server refuses the query if it is
+        serving a different table
+
+    all_connections : bool
+        whether to return all connections or only the pairs where both
+        individuals are in the list
+
+    relatedness_threshold : int
+        Pairs with an estimated relatedness higher than this value are
+        removed by the query. A value of 0 keeps every pair
+
+    timeout : float | None
+        number of seconds to wait for the server
+
+    compression_level : int | None
+        if this is given then the output file is gzip compressed with this
+        compression level
+
+    Returns
+    -------
+    int
+        returns the number of rows that were written to the file
+
+    Raises
+    ------
+    ConnectionError
+        if the server can't be reached, returns an error, or the response
+        ends early
+    """
+    # errors are raised to the caller rather than being logged and swallowed
+    # so that a failed query doesn't look like an empty result
+    logger.debug("Sending the query to the relatedness server.")
+
+    body = json.dumps(
+        {
+            "ids": ind_list,
+            "database_path": str(database_path) if database_path else None,
+            "table_name": table_name,
+            "all_connections": all_connections,
+            "relatedness_threshold": relatedness_threshold,
+        }
+    ).encode("utf-8")
+
+    request = urllib.request.Request(
+        server_url.rstrip("/") + RELATEDNESS_PATH,
+        data=body,
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+
+    logger.info(
+        f"Sending a query for {len(ind_list)} IDs to the server at {server_url}"
+    )
+
+    lines_written = 0
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            try:
+                with (
+                    open(output_filename, "wb")
+                    if compression_level is None
+                    else gzip.open(
+                        output_filename, "wb", compresslevel=compression_level
+                    )
+                ) as output:
+                    while block := response.read(COPY_BLOCK_SIZE):
+                        output.write(block)
+                        lines_written += block.count(b"\n")
+            except BaseException:
+                Path(output_filename).unlink(missing_ok=True)
+                raise
+    except urllib.error.HTTPError as e:
+        raise ConnectionError(
+            f"The server at {server_url} returned an error: {e.read().decode('utf-8', 'replace')}"
+        ) from e
+    except urllib.error.URLError as e:
+        raise ConnectionError(
+            f"Could not connect to the server at {server_url}: {e.reason}"
+        ) from e
+    except (http.client.HTTPException, ConnectionError) as e:
+        # the server closes the connection without the final chunk if the
+        # query fails after the response has started
+        raise ConnectionError(
+            f"The response from the server at {server_url} ended before every pair was sent. The partial output {output_filename} was removed: {e!r}"
+        ) from e
+
+    # the first line is the header
+    return max(lines_written - 1, 0)
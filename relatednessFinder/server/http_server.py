@@ -0,0 +1,238 @@
+import json
+import logging
+import queue
+from contextlib import contextmanager
+from dataclasses import replace
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Generator
+
+import database
+import utilities
+
+from .options import DEFAULT_CONNECTIONS, DEFAULT_HOST, DEFAULT_PORT
+
+RELATEDNESS_PATH = "/relatedness"
+HEALTH_PATH = "/health"
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server that keeps the database connections (or the compiled
+    index) open between requests so that each query only pays for the query
+    itself. Each request is handled on its own thread and borrows one of the
+    open connections"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        db_obj: database.dbResults,
+        logger: logging.Logger,
+        connections: int = DEFAULT_CONNECTIONS,
+    ) -> None:
+        self.db_obj = db_obj
+        self.logger = logger
+        self.index = None
+        self.connections: queue.Queue = queue.Queue()
+
+        if db_obj.backend == database.Backend.COMPILED:
+            self.index = database.CompiledIndex(
+                db_obj.database_path, db_obj.table_name, logger
+            )
+        else:
+            for _ in range(connections):
+                self.connections.put(
+                    database.get_connection(
+                        db_obj.database_path,
+                        logger=logger,
+                        read_only=True,
+                        check_same_thread=False,
+                        profile=db_obj.profile,
+                    )
+                )
+
+        super().__init__(address, QueryRequestHandler)
+
+    def server_close(self) -> None:
+        super().server_close()
+
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+
+    @contextmanager
+    def borrow_connection(self) -> Generator[database.dbResults, None, None]:
+        """Method that waits for an open connection and returns a copy of the
+        database object that uses it. The connection is returned to the pool
+        once the query is done"""
+        connection = self.connections.get()
+
+        try:
+            yield replace(self.db_obj, connection=connection)
+        finally:
+            self.connections.put(connection)
+
+    def check_database(self, database_path: str | None, table_name: str | None) -> None:
+        """Method that makes sure that a request is for the database and table
+        that the server has open
+
+        Raises
+        ------
+        ValueError
+            if the request names a different database or table
+        """
+        if (
+            database_path is not None
+            and Path(database_path).resolve()
+            != Path(self.db_obj.database_path).resolve()
+        ):
+            raise ValueError(
+                f"The server is serving the database {self.db_obj.database_path} not {database_path}"
+            )
+
+        if table_name is not None and table_name != self.db_obj.table_name:
+            raise ValueError(
+                f"The server is serving the table {self.db_obj.table_name} not {table_name}"
+            )
+
+    def query(
+        self,
+        ind_list: list[str],
+        all_connections: bool = False,
+        relatedness_threshold: int = 0,
+    ) -> Generator[database.PairResults, None, None]:
+        """Method that runs a relatedness query on the open index or on one of
+        the open connections. The arguments are the same as
+        database.get_relatedness"""
+        if self.index is not None:
+            yield from self.index.get_relatedness(
+                ind_list, all_connections, relatedness_threshold
+            )
+            return
+
+        with self.borrow_connection() as db_obj:
+            yield from database.get_relatedness(
+                ind_list,
+                db_obj,
+                logger=self.logger,
+                all_connections=all_connections,
+                relatedness_threshold=relatedness_threshold,
+            )
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """Request handler for the query server. POST requests to /relatedness
+    take a JSON object with the list of IDs and the query options and return
+    the pairs as the same tab separated text that determine-relatedness
+    writes. The response is sent in chunks as the query returns pairs so the
+    results never have to be held in memory"""
+
+    # HTTP/1.1 is needed for chunked responses and lets clients reuse the
+    # connection for several queries
+    protocol_version = "HTTP/1.1"
+
+    server: QueryServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        self.server.logger.info(f"{self.address_string()} - {format % args}")
+
+    def send_json(self, status: HTTPStatus, body: dict[str, Any]) -> None:
+        content = json.dumps(body).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def write_chunk(self, content: str) -> None:
+        data = content.encode("utf-8")
+
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def do_GET(self) -> None:
+        if self.path != HEALTH_PATH:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path {self.path}"})
+            return
+
+        self.send_json(
+            HTTPStatus.OK,
+            {
+                "database_path": str(self.server.db_obj.database_path),
+                "table_name": self.server.db_obj.table_name,
+                "backend": self.server.db_obj.backend.value,
+            },
+        )
+
+    def do_POST(self) -> None:
+        if self.path != RELATEDNESS_PATH:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path {self.path}"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+            ind_list = request["ids"]
+
+            if not isinstance(ind_list, list) or not all(
+                isinstance(grid, str) for grid in ind_list
+            ):
+                raise ValueError("ids should be a list of strings")
+
+            self.server.check_database(
+                request.get("database_path"), request.get("table_name")
+            )
+
+            results = self.server.query(
+                ind_list,
+                all_connections=bool(request.get("all_connections", False)),
+                relatedness_threshold=int(request.get("relatedness_threshold", 0)),
+            )
+
+            # the first batch is read before the response is started so that
+            # errors from setting up the query are returned as an error
+            first_batch = next(results, None)
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            return
+        except Exception as e:
+            self.server.logger.critical(e)
+            self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)})
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/tab-separated-values; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        rows_written = 0
+
+        try:
+            self.write_chunk(utilities.OUTPUT_HEADER)
+
+            if first_batch is not None:
+                self.write_chunk(utilities.format_pairs(first_batch))
+                rows_written += len(first_batch)
+
+            for batch in results:
+                self.write_chunk(utilities.format_pairs(batch))
+                rows_written += len(batch)
+        except Exception as e:
+            # the status has already been sent so the connection is closed
+            # without the final chunk which tells the client that the
+            # response is incomplete
+            self.server.logger.critical(e)
+            self.close_connection = True
+            return
+        finally:
+            # closing the generator returns the connection to the pool even
+            # if the client disconnected before every pair was sent
+            results.close()
+
+        self.wfile.write(b"0\r\n\r\n")
+
+        self.server.logger.info(
+            f"Returned {rows_written} pairs for a query of {len(ind_list)} IDs"
+        )
@@ -0,0 +1,9 @@
+# defaults for the serve command's options. They are kept out of the server
+# module so that the cli can build its options without importing the server
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# number of read only connections kept open by the server for the sqlite
+# backend. This is the number of queries that can run at the same time
+DEFAULT_CONNECTIONS = 4
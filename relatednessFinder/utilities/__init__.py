@@ -1,4 +1,30 @@
-from .exceptions import IncorrectGridFileFormat
-from .grid_files import FileReader
-from .log_levels import LogLevel
-from .writer import write_to_file
+from _lazy import lazy_exports
+
+# module that each exported name is defined in. The modules are only imported
+# once one of their names is used so that a command doesn't import numpy unless
+# it needs them
+_EXPORTS = {
+    "IncorrectGridFileFormat": ".exceptions",
+    "IncorrectManifestFormat": ".exceptions",
+    "FileReader": ".grid_files",
+    "LogLevel": ".log_levels",
+    "read_manifest": ".manifest",
+    "Metrics": ".metrics",
+    "DEFAULT_COMPRESSION_LEVEL": ".output_formats",
+    "DEFAULT_SORT_MEMORY": ".output_formats",
+    "OutputFormat": ".output_formats",
+    "sort_pairs": ".pair_sort",
+    "pipeline_results": ".pipeline",
+    "APPENDABLE_FORMATS": ".writer",
+    "OUTPUT_HEADER": ".writer",
+    "PairWriter": ".writer",
+    "format_pairs": ".writer",
+    "open_pair_writer": ".writer",
+    "write_batches_to_files": ".writer",
+    "write_classified_to_files": ".writer",
+    "write_to_file": ".writer",
+}
+
+__all__ = list(_EXPORTS)
+
+__getattr__, __dir__ = lazy_exports(globals(), _EXPORTS)
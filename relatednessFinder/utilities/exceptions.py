@@ -5,3 +5,12 @@ class IncorrectGridFileFormat(Exception):
         super().__init__(
             f"There was an error reading in the file: {grid_file} at line {line_num}. Program expected each line to be a separate ID."
         )
+
+
+class IncorrectManifestFormat(Exception):
+    """Exception that will be thrown if the batch manifest is not in the right format"""
+
+    def __init__(self, line_num: int, manifest_file: str) -> None:
+        super().__init__(
+            f"There was an error reading in the manifest: {manifest_file} at line {line_num}. Program expected each line to have a grid file and an output path separated by a tab."
+        )
@@ -1,45 +1,199 @@
+import bz2
+import gzip
 import logging
+import lzma
+from itertools import compress
 from pathlib import Path
-import gzip
+from typing import IO, Iterator
 
 import log
 import utilities
 
+# number of bytes read from the file at a time. Each chunk is split and
+# filtered with a few calls that loop in C instead of a python loop per line
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# openers for compressed files keyed by the magic bytes at the start of the
+# file so that compressed files are detected even without the usual suffix
+COMPRESSED_FORMATS = {
+    b"\x1f\x8b": gzip.open,
+    b"BZh": bz2.open,
+    b"\xfd7zXZ\x00": lzma.open,
+}
+
+# delimiters that are checked, in order, on the first line when no delimiter
+# is given. None splits on any run of whitespace
+DELIMITERS = ("\t", ",", ";", "|", None)
+
+# words that mark the first line as a header
+HEADER_WORDS = ("grids", "grid", "iid", "iids")
+
+CASE_STATUS = "1"
+CONTROL_STATUS = "0"
+
+# number of invalid lines that are written to the log as examples
+INVALID_LINE_EXAMPLES = 5
+
+
+def _one_delimiter_per_line(text: str, delimiter: str) -> bool:
+    """Function that checks that every line in the chunk has exactly one
+    delimiter. Every byte except the delimiter and the new line is deleted
+    so the chunk is valid if what is left is the delimiter and a new line
+    repeated once for each line. Comparing the total counts isn't enough
+    since a line without a delimiter and a line with two would cancel out"""
+    kept = {ord(delimiter), ord("\n")}
+
+    separators = text.encode("utf-8").translate(
+        None, bytes(byte for byte in range(256) if byte not in kept)
+    )
+
+    return separators == f"{delimiter}\n".encode("utf-8") * text.count("\n")
+
+
+def _open_file(filepath: Path) -> IO[bytes]:
+    """Function that opens the file in binary mode and decompresses it if the
+    file starts with the magic bytes of one of the COMPRESSED_FORMATS"""
+    with open(filepath, "rb") as check_file:
+        magic = check_file.read(6)
+
+    for magic_bytes, opener in COMPRESSED_FORMATS.items():
+        if magic.startswith(magic_bytes):
+            return opener(filepath, "rb")
+
+    return open(filepath, "rb")
+
+
+def _remove_duplicates(ids: list[str]) -> list[str]:
+    """Function that removes the duplicate IDs while keeping the IDs in the
+    same order as the file. Building a set is faster than building a
+    dictionary so the ordered dictionary is only built if the set shows that
+    there are duplicates"""
+    if len(set(ids)) == len(ids):
+        return ids
+
+    return list(dict.fromkeys(ids))
+
 
 class FileReader:
-    def __init__(self, filepath: Path) -> None:
+    def __init__(self, filepath: Path, delimiter: str | None = None) -> None:
+        """Class that reads the IDs and phenotype statuses from a grid file.
+
+        Parameters
+        ----------
+        filepath : Path
+            path to the grid file. The file can be gzip, bzip2, or xz
+            compressed
+
+        delimiter : str | None
+            string that separates the ID from the phenotype status. If this
+            is not given then it is detected from the first line of the file
+        """
         self.filepath = filepath
+        self.delimiter = delimiter
         self.excluded_inds = 0
+        self.duplicate_inds = 0
+        # line number and text of each line that didn't have an ID and a
+        # status
+        self.invalid_lines: list[tuple[int, str]] = []
 
-    def __enter__(self) -> None:
+    def __enter__(self) -> "FileReader":
         """Method that will be called by the with context manager.
 
         Raises
         ------
         OSError
             raises OSError if the file can't be opened"""
-        match self.filepath.suffix:
-            case ".txt":
-                try:
-                    self.open_file = open(self.filepath, "r", encoding="utf-8")
-                except OSError as e:
-                    print(
-                        f"encountered an error while trying to open the file: {self.filepath}"
-                    )
-                    print(e)
-            case ".gz":
-                try:
-                    self.open_file = gzip.open(self.filepath, "rt")
-                except OSError as e:
-                    print(
-                        f"encountered an error while trying to open the file: {self.filepath}"
-                    )
-                    print(e)
+        try:
+            self.open_file = _open_file(self.filepath)
+        except OSError as e:
+            print(
+                f"encountered an error while trying to open the file: {self.filepath}"
+            )
+            print(e)
+            raise
+
         return self
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self.open_file.close()
 
+    def _read_chunks(self) -> Iterator[str]:
+        """Method that reads the file a chunk at a time. Each chunk ends at
+        the end of a line and has no carriage returns"""
+        remainder = b""
+
+        while chunk := self.open_file.read(CHUNK_SIZE):
+            chunk = remainder + chunk
+
+            line_end = chunk.rfind(b"\n") + 1
+
+            remainder = chunk[line_end:]
+
+            if line_end:
+                yield chunk[:line_end].decode("utf-8").replace("\r", "")
+
+        if remainder:
+            yield remainder.decode("utf-8").replace("\r", "") + "\n"
+
+    def _detect_delimiter(self, line: str) -> str | None:
+        line = line.strip()
+
+        for delimiter in DELIMITERS:
+            if len(line.split(delimiter)) == 2:
+                return delimiter
+
+        return self.delimiter
+
+    def _parse_lines(
+        self, text: str, first_line_num: int
+    ) -> tuple[list[str], list[str]]:
+        """Method that parses a chunk one line at a time. This is used for
+        chunks that have blank or invalid lines, or whitespace around the
+        fields. Whitespace around each line and field is removed and the
+        invalid lines are recorded with their line number in the file and
+        skipped"""
+        ids = []
+        statuses = []
+
+        for line_num, line in enumerate(text.split("\n")[:-1], first_line_num + 1):
+            split_line = [field.strip() for field in line.strip().split(self.delimiter)]
+
+            if len(split_line) == 2 and split_line[0]:
+                ids.append(split_line[0])
+                statuses.append(split_line[1])
+            elif line.strip():
+                self.invalid_lines.append((line_num, line))
+
+        return ids, statuses
+
+    def _parse_chunk(
+        self, text: str, first_line_num: int
+    ) -> tuple[list[str], list[str]]:
+        """Method that parses a chunk of lines into a list of IDs and a list
+        of statuses. If every line has exactly one delimiter then splitting
+        the whole chunk gives the IDs and statuses alternating. Chunks where
+        a line has another number of delimiters are parsed a line at a time
+        so that the invalid lines are reported. Files separated by any
+        whitespace are always parsed a line at a time since the number of
+        fields on each line can't be counted for the whole chunk"""
+        if self.delimiter is None or not _one_delimiter_per_line(text, self.delimiter):
+            return self._parse_lines(text, first_line_num)
+
+        fields = text.replace("\n", self.delimiter).split(self.delimiter)
+
+        # splitting on the delimiter leaves an empty field after the last new
+        # line
+        fields.pop()
+
+        # the fields are stripped so that spaces around a field don't change
+        # the ID or status, the same as when the lines are parsed one by one
+        ids = list(map(str.strip, fields[0::2]))
+
+        if "" in ids:
+            return self._parse_lines(text, first_line_num)
+
+        return ids, list(map(str.strip, fields[1::2]))
+
     @log.log_msg_debug("Reading in IDs")
     def read_in_grids(
         self,
@@ -47,14 +201,11 @@ class FileReader:
         cases_and_control: bool = False,
     ) -> tuple[list[str], list[str] | None]:
         """Function that will read in all of the IDs from the provided file.
+        Lines that don't have an ID and a status are skipped and written to
+        the log. IDs that are listed more than once are only returned once
 
         Parameters
         ----------
-        grid_filepath : Path
-            path to a tab separated text file that list all the grids that the user
-            wishes to find values for. Expects two column: The IDs and phenotype (In
-            that order). Program expects no header
-
         logger : logging.Logger
             logging object
 
@@ -63,42 +214,104 @@ class FileReader:
 
         Returns
         -------
-        list[str]
-            returns a list of IDs
+        tuple[list[str], list[str] | None]
+            returns a list of the case IDs and a list of the control IDs. The
+            list of controls is empty if cases_and_control is False
 
         Raises
         ------
         IncorrectGridFileFormat
-            if the file is not formated where there is only a grid per line and the
-            phenotype status then this exception is raised
+            if none of the lines in the file have an ID and a phenotype
+            status
         """
 
-        logger.debug("identifying grids within the provided file: {self.filepath}")
-
-        cases = []
-        controls = []
-
-        for line_num, line in enumerate(self.open_file):
-            if any([word in line.lower() for word in ["grids", "grid", "iid", "iids"]]):
-                next(self.open_file)
-            else:
-                split_line = line.strip().split("\t")
-                grid_id = split_line[0]
-                if len(split_line) != 2:
-                    raise utilities.IncorrectGridFileFormat(line_num, self.filepath)
-                if split_line[1] == "1":
-                    cases.append(grid_id)
-                elif split_line[0] == "0":
-                    controls.append(grid_id)
+        logger.debug(f"identifying grids within the provided file: {self.filepath}")
+
+        cases: list[str] = []
+        controls: list[str] = []
+
+        lines_read = 0
+        rows = 0
+
+        for text in self._read_chunks():
+            first_line_num = lines_read
+
+            if lines_read == 0:
+                first_line, text = text.split("\n", 1)
+
+                if self.delimiter is None:
+                    self.delimiter = self._detect_delimiter(first_line)
+
+                split_line = [
+                    field.strip() for field in first_line.strip().split(self.delimiter)
+                ]
+
+                # the first line is only a header if it doesn't have a status
+                # so that an ID such as GRID1 isn't mistaken for a header
+                is_header = (
+                    len(split_line) != 2
+                    or split_line[1] not in (CASE_STATUS, CONTROL_STATUS)
+                ) and any(word in first_line.lower() for word in HEADER_WORDS)
+
+                if is_header:
+                    logger.debug(f"Skipping the header line: {first_line}")
                 else:
-                    self.excluded_inds += 1
+                    text = f"{first_line}\n{text}"
+
+                first_line_num = int(is_header)
+
+            lines_read = first_line_num + text.count("\n")
+
+            ids, statuses = self._parse_chunk(text, first_line_num)
+
+            rows += len(ids)
+
+            case_count = statuses.count(CASE_STATUS)
+            control_count = statuses.count(CONTROL_STATUS)
+
+            # grid files for determine-relatedness usually label every ID as
+            # a case so the IDs can be used without filtering them
+            if case_count == len(ids):
+                cases.extend(ids)
+            elif case_count:
+                cases.extend(compress(ids, map(CASE_STATUS.__eq__, statuses)))
+
+            if control_count == len(ids):
+                controls.extend(ids)
+            elif control_count:
+                controls.extend(compress(ids, map(CONTROL_STATUS.__eq__, statuses)))
+
+            self.excluded_inds += len(statuses) - case_count - control_count
+
+        if self.invalid_lines:
+            examples = "; ".join(
+                f"line {line_num}: {line!r}"
+                for line_num, line in self.invalid_lines[:INVALID_LINE_EXAMPLES]
+            )
+
+            logger.warning(
+                f"Skipped {len(self.invalid_lines)} lines in the grid file {self.filepath} that did not have an ID and a phenotype status separated by {self.delimiter or 'whitespace'!r}. Examples: {examples}"
+            )
+
+            if rows == 0:
+                raise utilities.IncorrectGridFileFormat(
+                    self.invalid_lines[0][0], self.filepath
+                )
+
+        unique_cases = _remove_duplicates(cases)
+        unique_controls = _remove_duplicates(controls)
+
+        self.duplicate_inds = (
+            len(cases) + len(controls) - len(unique_cases) - len(unique_controls)
+        )
 
         logger.info(
-            f"Identified {len(cases)} case ids and {len(controls)} control ids in the grid file: {self.filepath}"
+            f"Identified {len(unique_cases)} case ids and {len(unique_controls)} control ids in the grid file: {self.filepath}"
         )
         logger.info(f"Excluded {self.excluded_inds} individuals from the file")
+        logger.info(f"Removed {self.duplicate_inds} duplicate IDs from the file")
 
         if cases_and_control:
-            return cases, controls
+            return unique_cases, unique_controls
         else:
-            return cases, []
+            return unique_cases, []
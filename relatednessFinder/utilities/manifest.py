@@ -0,0 +1,76 @@
+import logging
+from pathlib import Path
+
+import log
+import utilities
+
+
+@log.log_msg_debug("Reading in the batch manifest")
+def read_manifest(
+    manifest_path: Path, logger: logging.Logger
+) -> list[tuple[Path, Path]]:
+    """Function that will read in the grid files and output paths for the
+    batch command
+
+    Parameters
+    ----------
+    manifest_path : Path
+        path to a tab separated text file with a grid file and the output
+        path for that grid file on each line. Blank lines and lines that start
+        with # are skipped. Relative paths are relative to the directory that
+        the manifest is in
+
+    logger : logging.Logger
+        logging object
+
+    Returns
+    -------
+    list[tuple[Path, Path]]
+        returns a list of the grid file and output path for each cohort
+
+    Raises
+    ------
+    IncorrectManifestFormat
+        if a line doesn't have exactly two columns
+
+    ValueError
+        if two lines have the same output path. The paths are resolved before
+        they are compared so out/a.txt and ./out/a.txt are the same output
+    """
+    manifest_dir = manifest_path.parent
+
+    cohorts = []
+
+    # line number of the first line that wrote to each resolved output path
+    output_lines: dict[Path, int] = {}
+
+    with open(manifest_path, "r", encoding="utf-8") as manifest:
+        for line_num, line in enumerate(manifest):
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            split_line = line.split("\t")
+
+            if len(split_line) != 2:
+                raise utilities.IncorrectManifestFormat(line_num, manifest_path)
+
+            grid_file, output_path = (
+                manifest_dir / Path(value).expanduser() for value in split_line
+            )
+
+            resolved_output = output_path.resolve()
+
+            if resolved_output in output_lines:
+                raise ValueError(
+                    f"The output path {resolved_output} is used on both line {output_lines[resolved_output]} and line {line_num + 1} of the manifest: {manifest_path}. Each cohort needs its own output path"
+                )
+
+            output_lines[resolved_output] = line_num + 1
+
+            cohorts.append((grid_file, output_path))
+
+    logger.info(f"Identified {len(cohorts)} cohorts in the manifest: {manifest_path}")
+
+    return cohorts
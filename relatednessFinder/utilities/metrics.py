@@ -0,0 +1,159 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Generator, Iterator, Sized, TypeVar
+
+Batch = TypeVar("Batch", bound=Sized)
+
+
+def _rusage_bytes(who: int) -> int:
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak_rss = resource.getrusage(who).ru_maxrss
+
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+@dataclass
+class StageMetrics:
+    """Measurements for one stage of a command. A stage can be entered more
+    than once, such as the query stage which is timed every time a batch is
+    fetched, and the measurements are added together"""
+
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    calls: int = 0
+    seconds_to_first_batch: float | None = None
+    counters: dict[str, int] = field(default_factory=dict)
+
+    def add(self, **counters: int) -> None:
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class Metrics:
+    """Class that records the wall time, cpu time, and counters for each stage
+    of a command and writes them to a json report. The times for a stage do
+    not include the stages nested inside of it on the same thread, so the
+    write stage doesn't include the time spent fetching the rows it writes.
+    The cpu time is for the whole process (including the worker processes
+    once they have finished) so it is only exact for stages that don't
+    overlap with another thread"""
+
+    def __init__(self, command: str) -> None:
+        self.command = command
+        self.stages: dict[str, StageMetrics] = {}
+        self.started = datetime.now()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time() + _children_cpu_seconds()
+        # stack of the [wall, cpu] time used by the nested stages of each
+        # active stage on the current thread
+        self._active = threading.local()
+
+    def __repr__(self) -> str:
+        return f"Metrics({self.command}, stages={list(self.stages)})"
+
+    def get_stage(self, name: str) -> StageMetrics:
+        return self.stages.setdefault(name, StageMetrics())
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """Method that times the code in the with block as the stage"""
+        stage_metrics = self.get_stage(name)
+
+        if not hasattr(self._active, "stack"):
+            self._active.stack = []
+
+        nested_time = [0.0, 0.0]
+        self._active.stack.append(nested_time)
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time() + _children_cpu_seconds()
+
+        try:
+            yield stage_metrics
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() + _children_cpu_seconds() - start_cpu
+
+            self._active.stack.pop()
+
+            stage_metrics.wall_seconds += wall - nested_time[0]
+            stage_metrics.cpu_seconds += cpu - nested_time[1]
+            stage_metrics.calls += 1
+
+            if self._active.stack:
+                self._active.stack[-1][0] += wall
+                self._active.stack[-1][1] += cpu
+
+    def measure_batches(
+        self, name: str, batches: Generator[Batch, None, None]
+    ) -> Generator[Batch, None, None]:
+        """Method that returns the same batches as the generator while timing
+        how long it takes to produce each batch. The time spent by the
+        consumer of the batches is not included. The number of rows and
+        batches and the time until the first batch are also recorded. The
+        time until the first batch includes loading the IDs and planning
+        the query so it shows when the database is cold or an index is
+        missing"""
+        stage_metrics = self.get_stage(name)
+        stage_start = time.perf_counter()
+
+        try:
+            while True:
+                with self.stage(name):
+                    batch = next(batches, None)
+
+                if batch is None:
+                    return
+
+                if stage_metrics.seconds_to_first_batch is None:
+                    stage_metrics.seconds_to_first_batch = (
+                        time.perf_counter() - stage_start
+                    )
+
+                stage_metrics.add(rows=len(batch), batches=1)
+
+                yield batch
+        finally:
+            batches.close()
+
+    def report(self) -> dict[str, Any]:
+        stages = {}
+
+        for name, stage_metrics in self.stages.items():
+            stages[name] = asdict(stage_metrics)
+
+            rows = stage_metrics.counters.get("rows")
+
+            if rows is not None and stage_metrics.wall_seconds > 0:
+                stages[name]["rows_per_second"] = rows / stage_metrics.wall_seconds
+
+        return {
+            "command": self.command,
+            "started": self.started.isoformat(),
+            "wall_seconds": time.perf_counter() - self._start_wall,
+            "cpu_seconds": time.process_time()
+            + _children_cpu_seconds()
+            - self._start_cpu,
+            "peak_rss_bytes": _rusage_bytes(resource.RUSAGE_SELF),
+            "peak_worker_rss_bytes": _rusage_bytes(resource.RUSAGE_CHILDREN),
+            "stages": stages,
+        }
+
+    def write(self, output_path: Path) -> Path:
+        """Method that writes the report to a json file"""
+        output_path.write_text(json.dumps(self.report(), indent=4))
+
+        return output_path
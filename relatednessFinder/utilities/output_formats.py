@@ -0,0 +1,19 @@
+from enum import Enum
+
+# compression level used for the gzip and parquet output formats. Level 6 is
+# the gzip default and is a good trade off between speed and size
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# default amount of memory in megabytes that sorting the output pairs can use
+# before the pairs are spilled to disk
+DEFAULT_SORT_MEMORY = 1024
+
+
+class OutputFormat(str, Enum):
+    """Enum used to define the options for the output format in the cli"""
+
+    TSV = "tsv"
+    GZIP = "gzip"
+    BINARY = "binary"
+    ARROW = "arrow"
+    PARQUET = "parquet"
@@ -0,0 +1,321 @@
+import logging
+import tempfile
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Generator
+
+import numpy as np
+from database import IdDictionary, PairResults
+
+# estimate of the bytes of memory used for each pair while a run is sorted.
+# Each 9 byte record is copied while it is canonicalised and the sort keys
+# and sort order take another 8 bytes each
+SORT_BYTES_PER_PAIR = 48
+
+# largest number of runs that are merged at the same time. If there are more
+# runs than this then they are merged in several passes so that only a few
+# files are open at once
+MERGE_FAN_IN = 64
+
+# smallest number of pairs that are read from a run at a time while merging
+MIN_MERGE_BLOCK = 4096
+
+# number of pairs in each batch that is passed on to the writer
+SORTED_BATCH_SIZE = 65_536
+
+# layout of the pairs in the spill files. The unsorted spills store the
+# integers from the IdDictionary while the sorted runs store the position of
+# each ID in the sorted list of IDs
+PAIR_RECORD = np.dtype([("id1", "<i4"), ("id2", "<i4"), ("relatedness", "u1")])
+
+
+def _to_records(pairs: PairResults) -> np.ndarray:
+    """Function that copies the pair arrays into a single record array"""
+    records = np.empty(len(pairs), dtype=PAIR_RECORD)
+
+    records["id1"], records["id2"], records["relatedness"] = pairs.arrays()
+
+    return records
+
+
+def _pair_keys(id1: np.ndarray, id2: np.ndarray) -> np.ndarray:
+    """Function that combines the two ID ranks into one int64 key so that
+    the pairs can be sorted and compared with a single array"""
+    return (id1.astype(np.int64) << 32) | id2
+
+
+def _rank_ids(dictionary: IdDictionary) -> tuple[np.ndarray, np.ndarray]:
+    """Function that sorts the IDs in the dictionary. This returns the rank
+    of each ID in the sorted list and the ID for each rank. The strings are
+    compared by code point so the order is the same as LC_ALL=C sort"""
+    order = np.argsort(np.asarray(dictionary.ids, dtype=object), kind="stable")
+
+    ranks = np.empty(len(order), dtype=np.int32)
+    ranks[order] = np.arange(len(order), dtype=np.int32)
+
+    return ranks, order.astype(np.int32)
+
+
+def _dedupe(records: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Function that sorts the records by their key and keeps one record
+    for each pair. If a pair has several relatedness values then the closest
+    relatedness is kept. Missing values are stored as MISSING_RELATEDNESS so
+    they are only kept if the pair has no other value"""
+    order = np.lexsort((records["relatedness"], keys))
+
+    sorted_keys = keys[order]
+
+    first = np.empty(len(sorted_keys), dtype=bool)
+    first[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=first[1:])
+
+    return records[order[first]]
+
+
+def _sort_run(records: np.ndarray, ranks: np.ndarray) -> np.ndarray:
+    """Function that replaces the dictionary integers with the ID ranks,
+    swaps the IDs so that ID1 sorts before ID2, and then sorts and dedupes
+    the pairs"""
+    id1 = ranks[records["id1"]]
+    id2 = ranks[records["id2"]]
+
+    run = np.empty(len(records), dtype=PAIR_RECORD)
+    run["id1"] = np.minimum(id1, id2)
+    run["id2"] = np.maximum(id1, id2)
+    run["relatedness"] = records["relatedness"]
+
+    return _dedupe(run, _pair_keys(run["id1"], run["id2"]))
+
+
+def _merge_runs(
+    run_paths: list[Path], block_size: int
+) -> Generator[np.ndarray, None, None]:
+    """Function that merges sorted runs into one sorted sequence of pairs.
+    A block of each run is read at a time. Every pair up to the smallest
+    last key of the blocks is in one of the blocks so those pairs are sorted
+    and deduped together and the rest of the blocks wait for the next round
+
+    Parameters
+    ----------
+    run_paths : list[Path]
+        files of sorted and deduped runs
+
+    block_size : int
+        number of pairs to read from a run at a time
+
+    Returns
+    -------
+    Generator[np.ndarray, None, None]
+        returns a generator of sorted record arrays with no duplicate pairs
+    """
+    with ExitStack() as stack:
+        run_files = [stack.enter_context(open(path, "rb")) for path in run_paths]
+
+        def read_block(run_file) -> tuple[np.ndarray, np.ndarray]:
+            records = np.fromfile(run_file, dtype=PAIR_RECORD, count=block_size)
+
+            return records, _pair_keys(records["id1"], records["id2"])
+
+        blocks = [read_block(run_file) for run_file in run_files]
+
+        while any(len(keys) for _, keys in blocks):
+            threshold = min(keys[-1] for _, keys in blocks if len(keys))
+
+            record_parts = []
+            key_parts = []
+
+            for index, (records, keys) in enumerate(blocks):
+                end = int(np.searchsorted(keys, threshold, side="right"))
+
+                record_parts.append(records[:end])
+                key_parts.append(keys[:end])
+
+                # a block is only used up once its last pair is written so
+                # each run that still has pairs always has a block loaded
+                if end == len(keys):
+                    blocks[index] = read_block(run_files[index])
+                else:
+                    blocks[index] = (records[end:], keys[end:])
+
+            yield _dedupe(np.concatenate(record_parts), np.concatenate(key_parts))
+
+
+def _to_batches(
+    records: np.ndarray, order: np.ndarray, dictionary: IdDictionary
+) -> Generator[PairResults, None, None]:
+    """Function that converts the ranks back into the dictionary integers
+    and splits the sorted records into batches for the writer"""
+    for start in range(0, len(records), SORTED_BATCH_SIZE):
+        block = records[start : start + SORTED_BATCH_SIZE]
+
+        yield PairResults.from_arrays(
+            order[block["id1"]],
+            order[block["id2"]],
+            block["relatedness"],
+            dictionary,
+        )
+
+
+def sort_pairs(
+    relatedness_results: Generator[PairResults, None, None],
+    logger: logging.Logger,
+    memory_limit: int,
+    spill_dir: Path | None = None,
+) -> Generator[PairResults, None, None]:
+    """Function that canonicalises, dedupes, and sorts the pairs before they
+    are written. The IDs of each pair are swapped so that ID1 sorts before
+    ID2 which means that (A, B) and (B, A) are the same pair. Each pair is
+    only kept once and if the copies have different relatedness values then
+    the closest relatedness is kept. The pairs are sorted by ID1 and then
+    ID2.
+
+    The pairs are held in memory until they reach the memory limit and are
+    then written to a spill file. Once all of the pairs are read the IDs are
+    sorted, each spill file is sorted into a run, and the runs are merged so
+    that results that are much larger than the memory limit can be sorted.
+    The IDs themselves are kept in memory in the IdDictionary
+
+    Parameters
+    ----------
+    relatedness_results : Generator[PairResults, None, None]
+        generator that returns the pairs a batch at a time
+
+    logger : logging.Logger
+        logging object
+
+    memory_limit : int
+        approximate number of bytes of memory to use for the pairs
+
+    spill_dir : Path | None
+        directory to write the spill files to. If this is not given then
+        the system's temporary directory is used. The files are removed
+        once the sorted pairs have been read
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns a generator of the sorted pairs a batch at a time
+    """
+    run_size = max(memory_limit // SORT_BYTES_PER_PAIR, MIN_MERGE_BLOCK)
+
+    dictionary = None
+    buffered: list[np.ndarray] = []
+    buffered_pairs = 0
+    pairs_read = 0
+    pairs_written = 0
+
+    with tempfile.TemporaryDirectory(
+        prefix="relatednessFinder_sort_", dir=spill_dir
+    ) as temp_dir:
+        spill_paths: list[Path] = []
+
+        def spill(records: np.ndarray) -> Path:
+            spill_path = Path(temp_dir) / f"run_{len(spill_paths)}.bin"
+
+            with open(spill_path, "wb") as spill_file:
+                records.tofile(spill_file)
+
+            spill_paths.append(spill_path)
+
+            return spill_path
+
+        try:
+            for batch in relatedness_results:
+                # every pair is encoded with the dictionary of the first
+                # batch so the integers can be compared across batches
+                if dictionary is None:
+                    dictionary = batch.dictionary
+                elif batch.dictionary is not dictionary:
+                    batch = batch.remap(dictionary)
+
+                buffered.append(_to_records(batch))
+                buffered_pairs += len(batch)
+
+                if buffered_pairs >= run_size:
+                    spill(np.concatenate(buffered))
+
+                    buffered = []
+                    buffered_pairs = 0
+
+                pairs_read += len(batch)
+        finally:
+            relatedness_results.close()
+
+        if dictionary is None:
+            return
+
+        # the order of the IDs is only known once every pair has been read
+        # since --all-connections can return IDs that aren't in the grid file
+        ranks, order = _rank_ids(dictionary)
+
+        if not spill_paths:
+            records = _sort_run(
+                np.concatenate(buffered) if buffered else np.empty(0, PAIR_RECORD),
+                ranks,
+            )
+
+            pairs_written = len(records)
+
+            yield from _to_batches(records, order, dictionary)
+        else:
+            if buffered:
+                spill(np.concatenate(buffered))
+
+            buffered = []
+
+            logger.info(
+                f"Sorting {pairs_read} pairs in {len(spill_paths)} runs in the directory: {temp_dir}"
+            )
+
+            run_paths = []
+
+            for spill_path in spill_paths:
+                run_path = spill_path.with_suffix(".sorted")
+
+                with open(run_path, "wb") as run_file:
+                    _sort_run(np.fromfile(spill_path, dtype=PAIR_RECORD), ranks).tofile(
+                        run_file
+                    )
+
+                spill_path.unlink()
+                run_paths.append(run_path)
+
+            # runs are merged in groups until few enough are left to merge
+            # in one pass
+            merge_pass = 0
+
+            while len(run_paths) > MERGE_FAN_IN:
+                merged_paths = []
+
+                for group_start in range(0, len(run_paths), MERGE_FAN_IN):
+                    group = run_paths[group_start : group_start + MERGE_FAN_IN]
+
+                    merged_path = (
+                        Path(temp_dir)
+                        / f"merge_{merge_pass}_{len(merged_paths)}.sorted"
+                    )
+
+                    with open(merged_path, "wb") as merged_file:
+                        for records in _merge_runs(
+                            group, max(run_size // (len(group) + 1), MIN_MERGE_BLOCK)
+                        ):
+                            records.tofile(merged_file)
+
+                    for run_path in group:
+                        run_path.unlink()
+
+                    merged_paths.append(merged_path)
+
+                run_paths = merged_paths
+                merge_pass += 1
+
+            for records in _merge_runs(
+                run_paths, max(run_size // (len(run_paths) + 1), MIN_MERGE_BLOCK)
+            ):
+                pairs_written += len(records)
+
+                yield from _to_batches(records, order, dictionary)
+
+    logger.info(
+        f"Removed {pairs_read - pairs_written} duplicate pairs while sorting {pairs_read} pairs"
+    )
@@ -0,0 +1,135 @@
+import queue
+import threading
+from typing import Generator
+
+from database import PairResults
+
+# number of batches that the reader thread can get ahead of the writer before
+# it waits for the writer to catch up
+PIPELINE_QUEUE_SIZE = 8
+
+# minimum number of pairs in each batch that is passed to the writer. Small
+# batches from the database are combined so the writer makes large writes
+PIPELINE_BATCH_SIZE = 65_536
+
+# number of seconds the reader thread waits on a full queue before checking
+# if the writer has stopped
+_PUT_TIMEOUT = 0.1
+
+
+class _ReaderFinished:
+    """Marker put on the queue by the reader thread once it is done. If the
+    reader failed then the exception is passed to the writer"""
+
+    def __init__(self, error: BaseException | None = None) -> None:
+        self.error = error
+
+
+def _read_batches(
+    relatedness_results: Generator[PairResults, None, None],
+    batch_queue: queue.Queue,
+    stop: threading.Event,
+    batch_size: int,
+) -> None:
+    """Function run by the reader thread. It drains the results generator,
+    combines the batches, and puts them on the queue. The generator is
+    created and closed on this thread so a sqlite connection opened by the
+    generator is only ever used by this thread"""
+
+    def put(item) -> bool:
+        # waiting in short steps means the reader notices if the writer
+        # stops while the queue is full instead of blocking forever
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    error = None
+
+    try:
+        pending = None
+
+        for batch in relatedness_results:
+            if pending is None:
+                pending = batch
+            else:
+                pending.extend(batch)
+
+            if len(pending) >= batch_size:
+                if not put(pending):
+                    return
+                pending = None
+
+        if pending is not None and not put(pending):
+            return
+    except BaseException as e:
+        error = e
+    finally:
+        relatedness_results.close()
+
+    put(_ReaderFinished(error))
+
+
+def pipeline_results(
+    relatedness_results: Generator[PairResults, None, None],
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+    batch_size: int = PIPELINE_BATCH_SIZE,
+) -> Generator[PairResults, None, None]:
+    """Function that reads the results on a separate thread so that the
+    database query and the writing of the output happen at the same time.
+    sqlite and file writes both release the GIL so the two stages overlap.
+    The queue between them is bounded so the reader can only get queue_size
+    batches ahead of the writer
+
+    Parameters
+    ----------
+    relatedness_results : Generator[PairResults, None, None]
+        generator from database.get_relatedness. It should not have been
+        started yet
+
+    queue_size : int
+        maximum number of batches waiting to be written
+
+    batch_size : int
+        minimum number of pairs in each batch that is returned
+
+    Returns
+    -------
+    Generator[PairResults, None, None]
+        returns the same pairs as relatedness_results in larger batches
+
+    Raises
+    ------
+    Exception
+        any exception raised while reading the results is raised again in
+        the thread that is consuming this generator
+    """
+    batch_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    reader = threading.Thread(
+        target=_read_batches,
+        args=(relatedness_results, batch_queue, stop, batch_size),
+        name="relatedness-reader",
+        daemon=True,
+    )
+    reader.start()
+
+    try:
+        while True:
+            item = batch_queue.get()
+
+            if isinstance(item, _ReaderFinished):
+                if item.error is not None:
+                    raise item.error
+                return
+
+            yield item
+    finally:
+        # if the writer stops early (or fails) the reader is told to stop
+        # so that it closes the query instead of filling the queue
+        stop.set()
+        reader.join()
@@ -1,30 +1,430 @@
+import gzip
+from contextlib import ExitStack
+from importlib.util import find_spec
 from pathlib import Path
+from typing import Generator
 
-import database
+import numpy as np
+from database import (
+    MISSING_RELATEDNESS,
+    PairChunkWriter,
+    PairResults,
+    read_pair_dictionary,
+)
 
+from .output_formats import DEFAULT_COMPRESSION_LEVEL, OutputFormat
 
-def write_to_file(
-    db_results: database.dbResults, output_filename: Path, relatedness_thres: int
-) -> None:
-    """Function that will write the output to a file
+# pyarrow is only needed for the arrow and parquet output formats so it is
+# not a required dependency. It is only imported once one of those formats is
+# written because importing it takes longer than starting the rest of the cli
+PYARROW_AVAILABLE = find_spec("pyarrow") is not None
+
+# number of characters to collect before a block is written to the file
+WRITE_BLOCK_SIZE = 1 << 20
+
+OUTPUT_HEADER = "ID1\tID2\tEstimated_relatedness\n"
+
+OUTPUT_COLUMNS = ("ID1", "ID2", "Estimated_relatedness")
+
+# formats that more pairs can be appended to without rewriting the file. A
+# gzip file can be appended to because a gzip file with several members
+# decompresses to the members joined together
+APPENDABLE_FORMATS = (OutputFormat.TSV, OutputFormat.GZIP, OutputFormat.BINARY)
+
+
+class PairWriter:
+    """Base class for the writers that write batches of pairs to an output
+    file in one of the output formats. The writers are context managers that
+    close the file when the block exits"""
+
+    def write(self, pairs: PairResults) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def __enter__(self) -> "PairWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class TextPairWriter(PairWriter):
+    """Writer for the tab separated text output. The rows are formatted a
+    batch at a time and written in large blocks. If a compression level is
+    given then the file is gzip compressed. If append is True then the rows
+    are added to the end of an existing file without another header"""
+
+    def __init__(
+        self,
+        output_filename: Path,
+        block_size: int = WRITE_BLOCK_SIZE,
+        compression_level: int | None = None,
+        append: bool = False,
+    ) -> None:
+        mode = "a" if append else "w"
+
+        if compression_level is None:
+            self.output = open(
+                output_filename, mode, encoding="utf-8", buffering=block_size
+            )
+        else:
+            self.output = gzip.open(
+                output_filename,
+                f"{mode}t",
+                compresslevel=compression_level,
+                encoding="utf-8",
+            )
+
+        self.block_size = block_size
+        self.block: list[str] = []
+        self.block_length = 0
+
+        if not append:
+            self.output.write(OUTPUT_HEADER)
+
+    def write(self, pairs: PairResults) -> None:
+        formatted_pairs = format_pairs(pairs)
+
+        self.block.append(formatted_pairs)
+        self.block_length += len(formatted_pairs)
+
+        if self.block_length >= self.block_size:
+            self.output.write("".join(self.block))
+            self.block = []
+            self.block_length = 0
+
+    def close(self) -> None:
+        self.output.write("".join(self.block))
+        self.block = []
+        self.output.close()
+
+
+class BinaryPairWriter(PairWriter):
+    """Writer for the binary output. The pairs are written as chunks of
+    integer coded ID1, ID2, and relatedness arrays along with the new IDs for
+    the dictionary (see database.PairChunkWriter). Missing relatedness
+    values are stored as database.MISSING_RELATEDNESS. The file can be read
+    with database.read_pair_chunks. If append is True then the dictionary
+    is read back from the existing file and the new chunks only add the IDs
+    that aren't in it yet"""
+
+    def __init__(self, output_filename: Path, append: bool = False) -> None:
+        dictionary = None
+
+        if append:
+            with open(output_filename, "rb") as existing_file:
+                dictionary = read_pair_dictionary(existing_file)
+
+        self.output = open(output_filename, "ab" if append else "wb")
+        self.chunk_writer = PairChunkWriter(self.output, dictionary, append=append)
+
+    def write(self, pairs: PairResults) -> None:
+        self.chunk_writer.write(pairs)
+
+    def close(self) -> None:
+        self.output.close()
+
+
+class ArrowPairWriter(PairWriter):
+    """Writer for the arrow IPC file and parquet outputs. Each batch of
+    pairs is written as a record batch (or a parquet row group) with the ID
+    columns as strings and the relatedness as a nullable uint8 column.
+    Parquet files are compressed with zstd while arrow files are left
+    uncompressed so that they can be memory mapped"""
+
+    def __init__(
+        self,
+        output_filename: Path,
+        output_format: OutputFormat,
+        compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    ) -> None:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(
+                f"The {output_format.value} output format needs the pyarrow package. It can be installed with: pip install pyarrow"
+            ) from e
+
+        self.pa = pa
+
+        self.schema = pa.schema(
+            [
+                (OUTPUT_COLUMNS[0], pa.string()),
+                (OUTPUT_COLUMNS[1], pa.string()),
+                (OUTPUT_COLUMNS[2], pa.uint8()),
+            ]
+        )
+
+        if output_format == OutputFormat.PARQUET:
+            self.output = pq.ParquetWriter(
+                output_filename,
+                self.schema,
+                compression="zstd",
+                compression_level=compression_level,
+            )
+        else:
+            self.output = pa.ipc.new_file(output_filename, self.schema)
+
+    def write(self, pairs: PairResults) -> None:
+        if not len(pairs):
+            return
+
+        pa = self.pa
+
+        id1, id2, relatedness = pairs.arrays()
+
+        # only the IDs used by this batch are decoded and each ID string is
+        # only converted once no matter how many pairs it is in
+        used_ids, positions = np.unique(np.concatenate([id1, id2]), return_inverse=True)
+
+        ids = pa.array(pairs.dictionary.decode(used_ids), pa.string())
+
+        batch = pa.record_batch(
+            [
+                ids.take(pa.array(positions[: len(id1)])),
+                ids.take(pa.array(positions[len(id1) :])),
+                pa.array(relatedness, mask=relatedness == MISSING_RELATEDNESS),
+            ],
+            schema=self.schema,
+        )
+
+        self.output.write_batch(batch)
+
+    def close(self) -> None:
+        self.output.close()
+
+
+def open_pair_writer(
+    output_filename: Path,
+    output_format: OutputFormat = OutputFormat.TSV,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    block_size: int = WRITE_BLOCK_SIZE,
+    append: bool = False,
+) -> PairWriter:
+    """Function that opens the writer for an output format
 
     Parameters
     ----------
-    db_results : database.dbResults
+    output_filename : Path
+        Path to the output file
+
+    output_format : OutputFormat
+        format to write the pairs in
+
+    compression_level : int
+        compression level for the gzip and parquet formats
+
+    block_size : int
+        number of characters to collect before writing a block to a text file
+
+    append : bool
+        whether to add the pairs to the end of an existing file. Only the
+        APPENDABLE_FORMATS can be appended to
 
+    Returns
+    -------
+    PairWriter
+        returns the writer for the output format
+
+    Raises
+    ------
+    ImportError
+        if the arrow or parquet format is used without pyarrow installed
+
+    ValueError
+        if append is True for a format that can't be appended to
+    """
+    if append and output_format not in APPENDABLE_FORMATS:
+        raise ValueError(
+            f"Pairs can't be appended to a file in the {output_format.value} format"
+        )
+
+    match output_format:
+        case OutputFormat.TSV:
+            return TextPairWriter(output_filename, block_size, append=append)
+        case OutputFormat.GZIP:
+            return TextPairWriter(
+                output_filename, block_size, compression_level, append=append
+            )
+        case OutputFormat.BINARY:
+            return BinaryPairWriter(output_filename, append=append)
+        case OutputFormat.ARROW | OutputFormat.PARQUET:
+            return ArrowPairWriter(output_filename, output_format, compression_level)
+
+
+def format_pairs(pairs: PairResults) -> str:
+    """Function that formats a batch of pairs as the lines of the output file"""
+    id1s, id2s, relatedness_values = pairs.columns()[:3]
+
+    return "".join(
+        [
+            f"{id1}\t{id2}\t{relatedness}\n"
+            for id1, id2, relatedness in zip(id1s, id2s, relatedness_values)
+        ]
+    )
+
+
+def write_to_file(
+    relatedness_results: Generator[PairResults, None, None],
+    output_filename: Path,
+    block_size: int = WRITE_BLOCK_SIZE,
+    output_format: OutputFormat = OutputFormat.TSV,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    append: bool = False,
+) -> int:
+    """Function that will stream the results from the database to a file. Rows
+    are written a batch at a time so that the memory usage stays the same no
+    matter how many rows are returned
+
+    Parameters
+    ----------
+    relatedness_results : Generator[PairResults, None, None]
+        generator from database.get_relatedness that returns the pairs from
+        the database a batch at a time
 
     output_filename : Path
         Path to the output file
 
-    relatedness_thres : int
-        threashold for the minimum relatedness allowed. Should be between 0-9. Nine will be considered the highest threshold. 0 would remove all of the non related people
+    block_size : int
+        number of characters to collect before writing a block to the file
 
+    output_format : OutputFormat
+        format to write the pairs in
+
+    compression_level : int
+        compression level for the gzip and parquet formats
+
+    append : bool
+        whether to add the rows to the end of an existing output file
+
+    Returns
+    -------
+    int
+        returns the number of rows that were written to the file
     """
-    # We are going to iterate through the case results list because
-    # thats the attribute that the database results get saved as when
-    # the user determines relatedness for just a group of individuals
-    # in the determine-relatedness command
-    with open(output_filename, "w", encoding="utf-8") as output:
-        output.write("ID1\tID2\tEstimated_relatedness\n")
-        for pair_result in db_results.case_results:
-            output.write(f"{pair_result[1]}\t{pair_result[2]}\t{pair_result[3]}\n")
+    rows_written = 0
+
+    with open_pair_writer(
+        output_filename, output_format, compression_level, block_size, append
+    ) as output:
+        for batch in relatedness_results:
+            output.write(batch)
+            rows_written += len(batch)
+
+    return rows_written
+
+
+def write_classified_to_files(
+    relatedness_results: Generator[PairResults, None, None],
+    output_filenames: dict[int, Path],
+    block_size: int = WRITE_BLOCK_SIZE,
+) -> dict[int, dict[int, int]]:
+    """Function that will stream classified pairs from the database into a
+    separate file for each pair class while counting the pairs at each
+    relatedness value so that the results only have to be read once
+
+    Parameters
+    ----------
+    relatedness_results : Generator[PairResults, None, None]
+        generator from database.get_classified_relatedness that returns the
+        classified pairs a batch at a time
+
+    output_filenames : dict[int, Path]
+        dictionary mapping each pair class to the file to write those pairs to
+
+    block_size : int
+        size of the write buffer for each file
+
+    Returns
+    -------
+    dict[int, dict[int, int]]
+        returns a dictionary where the keys are the pair classes and the
+        values are dictionaries of the number of pairs at each relatedness
+        value
+    """
+    counts: dict[int, dict[int, int]] = {
+        pair_class: {} for pair_class in output_filenames
+    }
+
+    with ExitStack() as stack:
+        outputs = {
+            pair_class: stack.enter_context(
+                open(filename, "w", encoding="utf-8", buffering=block_size)
+            )
+            for pair_class, filename in output_filenames.items()
+        }
+
+        for output in outputs.values():
+            output.write(OUTPUT_HEADER)
+
+        for batch in relatedness_results:
+            class_lines: dict[int, list[str]] = {
+                pair_class: [] for pair_class in outputs
+            }
+
+            for id1, id2, relatedness, pair_class in zip(*batch.columns()):
+                class_lines[pair_class].append(f"{id1}\t{id2}\t{relatedness}\n")
+
+                class_counts = counts[pair_class]
+                class_counts[relatedness] = class_counts.get(relatedness, 0) + 1
+
+            for pair_class, lines in class_lines.items():
+                outputs[pair_class].write("".join(lines))
+
+    return counts
+
+
+def write_batches_to_files(
+    routed_results: Generator[dict[int, PairResults], None, None],
+    output_filenames: dict[int, Path],
+    block_size: int = WRITE_BLOCK_SIZE,
+    output_format: OutputFormat = OutputFormat.TSV,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+) -> dict[int, int]:
+    """Function that will stream the pairs for several cohorts into a
+    separate file for each cohort
+
+    Parameters
+    ----------
+    routed_results : Generator[dict[int, PairResults], None, None]
+        generator from database.get_batch_relatedness that returns the pairs
+        for each cohort a batch at a time
+
+    output_filenames : dict[int, Path]
+        dictionary mapping the index of each cohort to the file to write
+        those pairs to
+
+    block_size : int
+        size of the write buffer for each file
+
+    output_format : OutputFormat
+        format to write the pairs in
+
+    compression_level : int
+        compression level for the gzip and parquet formats
+
+    Returns
+    -------
+    dict[int, int]
+        returns the number of rows written for each cohort
+    """
+    rows_written = {cohort_index: 0 for cohort_index in output_filenames}
+
+    with ExitStack() as stack:
+        outputs = {
+            cohort_index: stack.enter_context(
+                open_pair_writer(filename, output_format, compression_level, block_size)
+            )
+            for cohort_index, filename in output_filenames.items()
+        }
+
+        for routed_batch in routed_results:
+            for cohort_index, pairs in routed_batch.items():
+                outputs[cohort_index].write(pairs)
+
+                rows_written[cohort_index] += len(pairs)
+
+    return rows_written
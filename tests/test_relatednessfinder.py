@@ -1,5 +1,1246 @@
-from relatednessFinder.database import get_relatedness
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from relatednessFinder.analysis import (
+    permutation_test,
+    prune_related,
+    summarize_distribution,
+    summarize_relatives,
+    write_relative_summary,
+)
+from relatednessFinder.database import (
+    AdaptiveFetchSize,
+    Backend,
+    CompiledIndex,
+    ConflictResolution,
+    ConnectionProfile,
+    IdDictionary,
+    PairClassCounter,
+    PairResults,
+    ResultCache,
+    build_indexes,
+    build_sources,
+    compile_database,
+    dbResults,
+    get_batch_relatedness,
+    get_connection,
+    get_cached_relatedness,
+    get_classified_relatedness,
+    get_classified_relatedness_counts,
+    get_federated_classified_relatedness_counts,
+    get_federated_relatedness,
+    get_incremental_relatedness,
+    get_relatedness,
+    get_relatedness_counts,
+    read_pair_chunks,
+    read_watermark,
+    write_watermark,
+)
+from relatednessFinder.database import database_methods, federation
+from relatednessFinder.database.database_methods import (
+    check_query_plan,
+    construct_query_str,
+    load_query_ids,
+)
+from relatednessFinder.server import QueryServer, query_server
+from relatednessFinder.utilities import (
+    FileReader,
+    IncorrectGridFileFormat,
+    Metrics,
+    OutputFormat,
+    pipeline_results,
+    read_manifest,
+    sort_pairs,
+    write_to_file,
+)
+from relatednessFinder.utilities import pair_sort, writer
+
+CLI_PATH = Path(__file__).parents[1] / "relatednessFinder" / "relatedness_finder.py"
+
+# budget in seconds for the imports done when the cli starts. Starting the cli
+# should only import typer and the option enums until a command runs
+IMPORT_TIME_BUDGET = 0.5
+
+# modules that should only be imported by the commands that use them
+DEFERRED_MODULES = ("numpy", "matplotlib", "pyarrow", "database.database_methods")
+
+PAIRS = [
+    ("A", "B", 1),
+    ("A", "C", 3),
+    ("B", "D", 2),
+    ("D", "E", 5),
+    ("C", "A", 4),
+]
+
+
+@pytest.fixture
+def pair_db(tmp_path):
+    db_path = tmp_path / "ersa.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE ersa (ID INTEGER PRIMARY KEY, ID1 TEXT, ID2 TEXT, estimated_relatedness INTEGER)"
+    )
+    conn.executemany(
+        "INSERT INTO ersa (ID1, ID2, estimated_relatedness) VALUES (?, ?, ?)", PAIRS
+    )
+    conn.commit()
+    conn.close()
+    return dbResults(db_path, "ersa")
+
+
+def _pairs(results):
+    return sorted(tuple(row) for batch in results for row in batch)
 
 
 def test_version():
     assert 1 == 1
+
+
+def test_get_relatedness_only_pairs_in_list(pair_db):
+    results = get_relatedness(
+        ["A", "B", "C"], pair_db, logger=logging.getLogger(__name__)
+    )
+
+    assert _pairs(results) == [("A", "B", 1), ("A", "C", 3), ("C", "A", 4)]
+
+
+def test_get_relatedness_all_connections(pair_db):
+    results = get_relatedness(
+        ["A", "B", "C"],
+        pair_db,
+        logger=logging.getLogger(__name__),
+        all_connections=True,
+    )
+
+    assert _pairs(results) == [
+        ("A", "B", 1),
+        ("A", "C", 3),
+        ("B", "D", 2),
+        ("C", "A", 4),
+    ]
+
+
+@pytest.mark.parametrize("suffix", [".txt", ".gz", ".bz2", ".xz"])
+def test_read_in_grids(tmp_path, suffix):
+    logger = logging.getLogger(__name__)
+    grid_file = tmp_path / f"grids{suffix}"
+    content = "grid,phenotype\r\nGRID1,1\nA,0\n\nB,1,2\nA,0\nC,9\n,1\nD,1"
+    opener = {".txt": open, ".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+    with opener[suffix](grid_file, "wt") as output:
+        output.write(content)
+
+    with FileReader(grid_file) as file_reader:
+        cases, controls = file_reader.read_in_grids(
+            logger=logger, cases_and_control=True
+        )
+
+    assert cases == ["GRID1", "D"]
+    assert controls == ["A"]
+    assert file_reader.delimiter == ","
+    assert file_reader.excluded_inds == 1
+    assert file_reader.duplicate_inds == 1
+    assert file_reader.invalid_lines == [(5, "B,1,2"), (8, ",1")]
+
+
+@pytest.mark.parametrize(
+    "content,expected_cases,expected_controls,expected_invalid",
+    [
+        # lines with the wrong number of fields are reported even when the
+        # chunk has twice as many fields as lines
+        ("A\t1\t0\nB\nC\t1\n", ["C"], [], [(1, "A\t1\t0"), (2, "B")]),
+        # a line without a delimiter and a line with an extra one have the
+        # same total number of delimiters as lines but are still reported
+        ("S\t1\nP\nQ\tR\t1\n", ["S"], [], [(2, "P"), (3, "Q\tR\t1")]),
+        # whitespace around the fields is removed
+        ("A\t1 \nB\t0\t\n C\t1\n", ["A", "C"], ["B"], []),
+    ],
+)
+def test_read_in_grids_invalid_lines(
+    tmp_path, content, expected_cases, expected_controls, expected_invalid
+):
+    logger = logging.getLogger(__name__)
+    grid_file = tmp_path / "grids.txt"
+    grid_file.write_text(content)
+
+    with FileReader(grid_file) as file_reader:
+        cases, controls = file_reader.read_in_grids(
+            logger=logger, cases_and_control=True
+        )
+
+    assert cases == expected_cases
+    assert controls == expected_controls
+    assert file_reader.invalid_lines == expected_invalid
+
+
+def test_read_manifest_rejects_duplicate_outputs(tmp_path):
+    logger = logging.getLogger(__name__)
+    manifest = tmp_path / "manifest.txt"
+
+    manifest.write_text("# cohorts\na.txt\tout/a.txt\nb.txt\tout/b.txt\n")
+
+    assert read_manifest(manifest, logger=logger) == [
+        (tmp_path / "a.txt", tmp_path / "out/a.txt"),
+        (tmp_path / "b.txt", tmp_path / "out/b.txt"),
+    ]
+
+    # the paths are resolved so the same file written differently still
+    # collides. read_manifest logs the error so the undecorated function is
+    # called to check it
+    manifest.write_text("# cohorts\na.txt\tout/a.txt\nb.txt\t./out/a.txt\n")
+
+    with pytest.raises(ValueError, match="out/a.txt is used on both line 2 and line 3"):
+        read_manifest.__wrapped__(manifest, logger=logger)
+
+
+def _plan_uses_index(db_obj, logger):
+    conn = sqlite3.connect(db_obj.database_path)
+    load_query_ids(conn, ["A", "B"], logger)
+    query, parameters = construct_query_str(db_obj, False, logger)
+    uses_index = check_query_plan(conn, query, logger, parameters)
+    conn.close()
+    return uses_index
+
+
+def test_build_indexes_removes_full_scan(pair_db):
+    logger = logging.getLogger(__name__)
+
+    assert not _plan_uses_index(pair_db, logger)
+
+    build_indexes(pair_db, logger=logger)
+
+    assert _plan_uses_index(pair_db, logger)
+
+
+def test_get_relatedness_threshold_filters_in_query(pair_db):
+    results = get_relatedness(
+        ["A", "B", "C", "D"],
+        pair_db,
+        logger=logging.getLogger(__name__),
+        all_connections=True,
+        relatedness_threshold=2,
+    )
+
+    assert _pairs(results) == [("A", "B", 1), ("B", "D", 2)]
+
+
+@pytest.mark.parametrize("all_connections", [False, True])
+def test_get_relatedness_workers_match_serial(pair_db, all_connections):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C", "D"]
+
+    serial = get_relatedness(
+        ids, pair_db, logger=logger, all_connections=all_connections
+    )
+    parallel = get_relatedness(
+        ids, pair_db, logger=logger, all_connections=all_connections, workers=2
+    )
+
+    assert _pairs(parallel) == _pairs(serial)
+
+
+def test_get_relatedness_workers_stream_batches(tmp_path):
+    logger = logging.getLogger(__name__)
+    ids = [f"ID{index:02d}" for index in range(20)]
+
+    db_path = tmp_path / "large.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE ersa (ID INTEGER PRIMARY KEY, ID1 TEXT, ID2 TEXT, estimated_relatedness INTEGER)"
+    )
+    conn.executemany(
+        "INSERT INTO ersa (ID1, ID2, estimated_relatedness) VALUES (?, ?, ?)",
+        [(id1, id2, 3) for id1 in ids for id2 in ids if id1 != id2] * 50,
+    )
+    conn.commit()
+    conn.close()
+
+    large_db = dbResults(db_path, "ersa")
+
+    # each shard has more rows than one fetch so the workers send the shards
+    # back in several batches instead of one list per shard
+    parallel = list(get_relatedness(ids, large_db, logger=logger, workers=2))
+
+    assert len(parallel) > 2 * database_methods.SHARDS_PER_WORKER
+    assert _pairs(parallel) == _pairs(get_relatedness(ids, large_db, logger=logger))
+
+    # closing the results early doesn't leave the workers waiting on the
+    # full queue
+    results = get_relatedness(ids, large_db, logger=logger, workers=2)
+    next(results)
+    results.close()
+
+
+def test_get_relatedness_counts_groups_in_sql(pair_db):
+    counts = get_relatedness_counts(
+        ["A", "B", "C", "D"],
+        pair_db,
+        logger=logging.getLogger(__name__),
+        all_connections=True,
+        workers=2,
+    )
+
+    assert counts == {1: 1, 2: 1, 3: 1, 4: 1, 5: 1}
+
+
+def test_summarize_distribution_from_counts():
+    summary = summarize_distribution({1: 2, 3: 1, 9: 1, None: 4})
+
+    assert summary == {"pairs": 4, "mean": 3.5, "median": 2.0, "min": 1, "max": 9}
+
+
+def test_get_classified_relatedness_counts_single_pass(pair_db):
+    counts = get_classified_relatedness_counts(
+        ["A", "B"], ["C", "D"], pair_db, logger=logging.getLogger(__name__)
+    )
+
+    assert counts == {
+        "case_case": {1: 1},
+        "case_control": {2: 1, 3: 1, 4: 1},
+        "control_control": {},
+    }
+
+    # counting the classified pairs as they are read gives the same counts
+    # as counting them in sql
+    dictionary = IdDictionary()
+    counter = PairClassCounter()
+    classified = list(
+        counter.count(
+            get_classified_relatedness(
+                ["A", "B"],
+                ["C", "D"],
+                pair_db,
+                logger=logging.getLogger(__name__),
+                dictionary=dictionary,
+            )
+        )
+    )
+
+    assert counter.to_dict() == counts
+    assert all(batch.dictionary is dictionary for batch in classified)
+
+
+def test_prune_related():
+    logger = logging.getLogger(__name__)
+    # a star around S, a chain P1-P2-P3-P4, a case-control pair, and a
+    # pair that is in the table in both directions
+    pairs = PairResults.from_rows(
+        [
+            ("S", "L1", 1),
+            ("S", "L2", 2),
+            ("L3", "S", 1),
+            ("P1", "P2", 1),
+            ("P2", "P3", 1),
+            ("P3", "P4", 1),
+            ("CASE", "CONTROL", 2),
+            ("D1", "D2", 1),
+            ("D2", "D1", 1),
+        ]
+    )
+    cases = ["S", "L1", "L2", "L3", "P1", "P2", "P3", "P4", "CASE", "D1", "D2"]
+
+    removed, kept, clusters = prune_related(
+        [pairs], cases, ["CONTROL", "LONE"], logger=logger, keep_cases=True
+    )
+
+    removed = set(removed)
+
+    assert "S" in removed and not removed & {"L1", "L2", "L3"}
+    assert "CONTROL" in removed and "CASE" not in removed
+    assert len(removed & {"P1", "P2", "P3", "P4"}) == 2
+    assert len(removed & {"D1", "D2"}) == 1
+    assert len(removed) == 5
+    assert set(kept) == set(cases + ["CONTROL", "LONE"]) - removed
+    # no two kept individuals are related
+    assert not any(id1 in kept and id2 in kept for id1, id2, _ in pairs)
+
+    assert "LONE" not in clusters
+    assert clusters["S"] == (1, 3, True)
+    assert clusters["P1"][0] == clusters["P4"][0] != clusters["D1"][0]
+    assert len({cluster for cluster, _, _ in clusters.values()}) == 4
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_permutation_test(workers):
+    logger = logging.getLogger(__name__)
+    cases = [f"CASE{index}" for index in range(20)]
+    controls = [f"CONTROL{index}" for index in range(40)]
+
+    # the cases are all 1st degree relatives of the next case while the
+    # 2nd degree pairs are spread evenly. The duplicate and self pairs and
+    # the pair with an ID outside of the cohort are dropped
+    rows = [(case1, case2, 1) for case1, case2 in zip(cases, cases[1:])]
+    rows += [
+        (id1, id2, 2) for id1, id2 in zip(cases + controls, (controls + cases)[5:])
+    ]
+    rows += [("CASE1", "CASE0", 1), ("CASE0", "CASE0", 1), ("CASE0", "OTHER", 1)]
+
+    results = permutation_test(
+        [PairResults.from_rows(rows)],
+        cases,
+        controls,
+        logger=logger,
+        permutations=300,
+        workers=workers,
+    )
+
+    assert results.relatedness_values.tolist() == [1, 2]
+    assert results.pairs.tolist() == [19, 55, 74]
+    assert results.case_case.tolist()[0] == 19
+    assert results.permuted_case_case.shape == (300, 3)
+
+    # a pair is never counted as both case-case and control-control
+    permuted_pairs = results.permuted_case_case + results.permuted_control_control
+
+    assert (permuted_pairs <= results.pairs).all()
+
+    statistics = results.statistics()
+
+    assert statistics["case_case_p_value"][0] == pytest.approx(1 / 301)
+    assert statistics["rate_difference_p_value"][0] == pytest.approx(1 / 301)
+    assert statistics["enrichment"][0] > 3
+
+    # the shuffles come from the seed so the workers don't change them
+    serial = permutation_test(
+        [PairResults.from_rows(rows)],
+        cases,
+        controls,
+        logger=logger,
+        permutations=300,
+    )
+
+    assert (serial.permuted_case_case == results.permuted_case_case).all()
+
+    # nor does the order that the IDs were added to the dictionary
+    dictionary = IdDictionary(["OTHER", *reversed(controls), *reversed(cases)])
+    reordered = permutation_test(
+        [PairResults.from_rows(rows, dictionary)],
+        cases,
+        controls,
+        logger=logger,
+        permutations=300,
+        dictionary=dictionary,
+    )
+
+    assert (reordered.permuted_case_case == results.permuted_case_case).all()
+
+
+def test_summarize_relatives(pair_db, tmp_path):
+    logger = logging.getLogger(__name__)
+
+    # D is only a relative so it doesn't get a row and F has no relatives
+    summary = summarize_relatives(
+        get_relatedness(
+            ["A", "B", "C", "F"], pair_db, logger=logger, all_connections=True
+        ),
+        ["A", "B", "C", "F"],
+        logger=logger,
+    )
+
+    assert summary.relatedness_values.tolist() == [1, 2, 3, 4]
+    assert summary.counts.tolist() == [
+        [1, 0, 1, 1],
+        [1, 1, 0, 0],
+        [0, 0, 1, 1],
+        [0, 0, 0, 0],
+    ]
+
+    output_path = tmp_path / "summary.txt"
+
+    assert write_relative_summary(summary, output_path) == 4
+    assert output_path.read_text().splitlines() == [
+        "ID\tRelatives\tClosest_relatedness\tClosest_relative\tRelatedness_1\tRelatedness_2\tRelatedness_3\tRelatedness_4",
+        "A\t3\t1\tB\t1\t0\t1\t1",
+        "B\t2\t1\tA\t1\t1\t0\t0",
+        "C\t2\t3\tA\t0\t0\t1\t1",
+        "F\t0\tNone\tNone\t0\t0\t0\t0",
+    ]
+
+
+@pytest.mark.parametrize(
+    "profile", [ConnectionProfile.READ, ConnectionProfile.IMMUTABLE]
+)
+@pytest.mark.parametrize("workers", [1, 2])
+def test_connection_profiles_match_default(pair_db, profile, workers):
+    logger = logging.getLogger(__name__)
+    profile_db = dbResults(pair_db.database_path, "ersa", profile=profile)
+
+    for all_connections in [False, True]:
+        assert _pairs(
+            get_relatedness(
+                ["A", "B", "C"],
+                profile_db,
+                logger=logger,
+                all_connections=all_connections,
+                workers=workers,
+            )
+        ) == _pairs(
+            get_relatedness(
+                ["A", "B", "C"], pair_db, logger=logger, all_connections=all_connections
+            )
+        )
+
+    connection = get_connection(pair_db.database_path, logger=logger, profile=profile)
+
+    assert connection.execute("PRAGMA query_only").fetchone()[0] == 1
+    assert connection.execute("PRAGMA temp_store").fetchone()[0] == 2
+
+    with pytest.raises(sqlite3.OperationalError):
+        connection.execute("DELETE FROM ersa")
+
+    connection.close()
+
+
+def test_adaptive_fetch_size():
+    connection = sqlite3.connect(":memory:")
+    cursor = connection.execute(
+        "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 100000) SELECT x, 'A', 'B' FROM n"
+    )
+
+    fetch_size = AdaptiveFetchSize(target_seconds=10)
+    batch_sizes = []
+
+    while rows := fetch_size.fetch(cursor):
+        batch_sizes.append(len(rows))
+
+    assert sum(batch_sizes) == fetch_size.rows == 100000
+    assert fetch_size.batches == len(batch_sizes)
+    # fast fetches grow the batch size by at most MAX_FETCH_GROWTH at a time
+    assert batch_sizes[:3] == [1024, 4096, 16384]
+
+    # the memory budget limits the batch size
+    cursor = connection.execute("SELECT 1, 'A', 'B'")
+    fetch_size = AdaptiveFetchSize(memory_budget=1, target_seconds=10, initial_size=1)
+    fetch_size.fetch(cursor)
+
+    assert fetch_size.size == 256
+
+    connection.close()
+
+
+@pytest.mark.parametrize("all_connections", [False, True])
+def test_compiled_index_matches_sqlite(pair_db, tmp_path, all_connections):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C", "Z"]
+
+    compile_database(pair_db, tmp_path / "index", logger=logger)
+
+    compiled_db = dbResults(tmp_path / "index", "ersa", backend=Backend.COMPILED)
+
+    for threshold in [0, 3]:
+        sqlite_results = get_relatedness(
+            ids,
+            pair_db,
+            logger=logger,
+            all_connections=all_connections,
+            relatedness_threshold=threshold,
+        )
+        compiled_results = get_relatedness(
+            ids,
+            compiled_db,
+            logger=logger,
+            all_connections=all_connections,
+            relatedness_threshold=threshold,
+        )
+
+        assert _pairs(compiled_results) == _pairs(sqlite_results)
+
+    assert get_classified_relatedness_counts(
+        ["A", "B"], ["C", "D"], compiled_db, logger=logger
+    ) == get_classified_relatedness_counts(
+        ["A", "B"], ["C", "D"], pair_db, logger=logger
+    )
+
+
+def test_compiled_index_checks_the_database(pair_db, tmp_path, caplog):
+    logger = logging.getLogger(__name__)
+
+    compile_database(pair_db, tmp_path / "index", logger=logger)
+
+    with caplog.at_level(logging.WARNING):
+        CompiledIndex(tmp_path / "index", "ersa", logger)
+
+    assert "has changed" not in caplog.text
+
+    conn = sqlite3.connect(pair_db.database_path)
+    conn.execute(
+        "INSERT INTO ersa (ID1, ID2, estimated_relatedness) VALUES ('A', 'Z', 255)"
+    )
+    conn.commit()
+    conn.close()
+
+    with caplog.at_level(logging.WARNING):
+        CompiledIndex(tmp_path / "index", "ersa", logger)
+
+    assert "has changed since the index" in caplog.text
+
+    # 255 would be read back from the index as a missing value so the table
+    # can't be compiled
+    assert compile_database(pair_db, tmp_path / "rejected", logger=logger) == 1
+    assert not (tmp_path / "rejected" / "metadata.json").exists()
+
+
+def test_pair_results_round_trip():
+    dictionary = IdDictionary()
+
+    first = PairResults.from_rows([("A", "B", 1), ("A", "C", None)], dictionary)
+    second = PairResults.from_rows([("C", "B", 4)])
+
+    first.extend(second)
+
+    assert list(first) == [("A", "B", 1), ("A", "C", None), ("C", "B", 4)]
+    assert len(dictionary) == 3
+    assert first.nbytes == 3 * 9
+    assert first.relatedness_counts() == {1: 1, 4: 1, None: 1}
+
+
+def test_result_cache(pair_db, tmp_path):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C"]
+    cache = ResultCache(tmp_path / "cache", logger=logger)
+
+    expected = _pairs(get_relatedness(ids, pair_db, logger=logger))
+
+    assert (
+        _pairs(get_cached_relatedness(ids, pair_db, cache, logger=logger)) == expected
+    )
+    assert len(cache.entries()) == 1
+
+    key = cache.make_key(pair_db, ["C", "B", "A", "A"])
+
+    assert _pairs(cache.get(key)) == expected
+    assert cache.get(cache.make_key(pair_db, ids, all_connections=True)) is None
+
+    # cached results are converted to the dictionary that is given even if it
+    # already has other IDs in it
+    dictionary = IdDictionary(["Z", "C"])
+    cached = list(
+        get_cached_relatedness(
+            ids, pair_db, cache, logger=logger, dictionary=dictionary
+        )
+    )
+
+    assert _pairs(cached) == expected
+    assert all(batch.dictionary is dictionary for batch in cached)
+
+    # results bigger than the cache are returned without being cached
+    small_cache = ResultCache(tmp_path / "small_cache", max_size=1, logger=logger)
+
+    assert (
+        _pairs(get_cached_relatedness(ids, pair_db, small_cache, logger=logger))
+        == expected
+    )
+    assert small_cache.entries() == []
+    assert list(small_cache.cache_dir.iterdir()) == []
+
+
+def test_result_cache_sees_rows_in_the_wal(pair_db, tmp_path):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C"]
+    cache = ResultCache(tmp_path / "cache", logger=logger)
+
+    # the writer stays open so the new row stays in the -wal file instead of
+    # being checkpointed into the database file
+    writer = sqlite3.connect(pair_db.database_path)
+    writer.execute("PRAGMA journal_mode=WAL")
+
+    before = _pairs(get_cached_relatedness(ids, pair_db, cache, logger=logger))
+
+    writer.execute(
+        "INSERT INTO ersa (ID1, ID2, estimated_relatedness) VALUES ('B', 'C', 7)"
+    )
+    writer.commit()
+
+    after = _pairs(get_cached_relatedness(ids, pair_db, cache, logger=logger))
+    writer.close()
+
+    assert ("B", "C", 7) not in before
+    assert after == sorted(before + [("B", "C", 7)])
+    assert len(cache.entries()) == 2
+
+
+def test_result_cache_removes_abandoned_partials(tmp_path):
+    cache = ResultCache(tmp_path / "cache", logger=logging.getLogger(__name__))
+
+    # a finished process stands in for one that was killed while it wrote
+    finished = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    dead_pid = int(finished.stdout)
+
+    abandoned = cache.cache_dir / f"dead.pairs.{dead_pid}.partial"
+    writing = cache.cache_dir / f"live.pairs.{os.getpid()}.partial"
+    old = cache.cache_dir / f"old.pairs.{os.getpid()}.partial"
+
+    for partial in (abandoned, writing, old):
+        partial.write_bytes(b"pairs")
+
+    os.utime(old, (0, 0))
+
+    cache.evict()
+
+    assert sorted(cache.cache_dir.iterdir()) == [writing]
+
+
+@pytest.mark.parametrize("all_connections", [False, True])
+def test_batch_relatedness_matches_single_queries(pair_db, all_connections):
+    logger = logging.getLogger(__name__)
+    cohorts = [["A", "B"], ["A", "C", "D"], ["E"], ["Z"]]
+
+    routed = {cohort_index: [] for cohort_index in range(len(cohorts))}
+
+    for routed_batch in get_batch_relatedness(
+        cohorts, pair_db, logger=logger, all_connections=all_connections
+    ):
+        for cohort_index, pairs in routed_batch.items():
+            routed[cohort_index].append(pairs)
+
+    for cohort_index, cohort in enumerate(cohorts):
+        expected = get_relatedness(
+            cohort, pair_db, logger=logger, all_connections=all_connections
+        )
+
+        assert _pairs(routed[cohort_index]) == _pairs(expected)
+
+
+def test_query_server(pair_db, tmp_path):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C"]
+
+    with QueryServer(("127.0.0.1", 0), pair_db, logger, connections=2) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        server_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        rows_written = query_server(
+            server_url,
+            ids,
+            tmp_path / "pairs.txt",
+            logger=logger,
+            database_path=pair_db.database_path,
+            table_name="ersa",
+            all_connections=True,
+        )
+
+        server.shutdown()
+
+    lines = (tmp_path / "pairs.txt").read_text().splitlines()[1:]
+    expected = _pairs(
+        get_relatedness(ids, pair_db, logger=logger, all_connections=True)
+    )
+
+    assert rows_written == len(expected)
+    assert (
+        sorted(
+            (id1, id2, int(relatedness))
+            for id1, id2, relatedness in (line.split("\t") for line in lines)
+        )
+        == expected
+    )
+
+
+def test_query_server_fails_mid_stream(pair_db, tmp_path):
+    logger = logging.getLogger(__name__)
+    output_path = tmp_path / "pairs.txt"
+
+    def failing_query(*args, **kwargs):
+        yield PairResults.from_rows([("A", "B", 1)])
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with QueryServer(("127.0.0.1", 0), pair_db, logger, connections=1) as server:
+        server.query = failing_query
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # the response ends without the final chunk so the partial output
+        # is removed instead of looking like a complete result
+        with pytest.raises(ConnectionError, match="ended before every pair"):
+            query_server(
+                f"http://127.0.0.1:{server.server_address[1]}",
+                ["A", "B"],
+                output_path,
+                logger=logger,
+            )
+
+        server.shutdown()
+
+    assert not output_path.exists()
+
+
+@pytest.mark.parametrize("output_format", list(OutputFormat))
+def test_write_to_file_formats(pair_db, tmp_path, output_format):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C", "D"]
+    output_path = tmp_path / f"pairs.{output_format.value}"
+
+    if (
+        output_format in (OutputFormat.ARROW, OutputFormat.PARQUET)
+        and not writer.PYARROW_AVAILABLE
+    ):
+        pytest.skip("pyarrow is not installed")
+
+    expected = _pairs(get_relatedness(ids, pair_db, logger=logger))
+
+    rows_written = write_to_file(
+        get_relatedness(ids, pair_db, logger=logger),
+        output_path,
+        output_format=output_format,
+        compression_level=1,
+    )
+
+    assert rows_written == len(expected)
+
+    if output_format in (OutputFormat.TSV, OutputFormat.GZIP):
+        opener = gzip.open if output_format == OutputFormat.GZIP else open
+
+        with opener(output_path, "rt") as output:
+            lines = output.read().splitlines()[1:]
+
+        written = [
+            (id1, id2, int(relatedness))
+            for id1, id2, relatedness in (line.split("\t") for line in lines)
+        ]
+    elif output_format == OutputFormat.BINARY:
+        with open(output_path, "rb") as output:
+            written = _pairs(read_pair_chunks(output))
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = (
+            pq.read_table(output_path)
+            if output_format == OutputFormat.PARQUET
+            else pa.ipc.open_file(output_path).read_all()
+        )
+
+        written = list(zip(*table.to_pydict().values()))
+
+    assert sorted(written) == expected
+
+
+def _read_output(output_path, output_format):
+    if output_format == OutputFormat.BINARY:
+        with open(output_path, "rb") as output:
+            return _pairs(read_pair_chunks(output))
+
+    opener = gzip.open if output_format == OutputFormat.GZIP else open
+
+    with opener(output_path, "rt") as output:
+        lines = output.read().splitlines()
+
+    assert lines.count(lines[0]) == 1
+
+    return sorted(
+        (id1, id2, int(relatedness))
+        for id1, id2, relatedness in (line.split("\t") for line in lines[1:])
+    )
+
+
+@pytest.mark.parametrize(
+    "output_format", [OutputFormat.TSV, OutputFormat.GZIP, OutputFormat.BINARY]
+)
+@pytest.mark.parametrize("all_connections", [False, True])
+def test_incremental_refresh(pair_db, tmp_path, output_format, all_connections):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C", "D"]
+    output_path = tmp_path / f"pairs.{output_format.value}"
+
+    def refresh():
+        results, watermark, append = get_incremental_relatedness(
+            ids,
+            pair_db,
+            output_path,
+            logger=logger,
+            all_connections=all_connections,
+            output_format=output_format.value,
+        )
+        rows_written = write_to_file(
+            results, output_path, output_format=output_format, append=append
+        )
+        write_watermark(watermark, output_path)
+
+        return rows_written, append
+
+    def expected():
+        return _pairs(
+            get_relatedness(
+                ids, pair_db, logger=logger, all_connections=all_connections
+            )
+        )
+
+    assert refresh()[1] is False
+    assert _read_output(output_path, output_format) == expected()
+    assert read_watermark(output_path).max_row_id == len(PAIRS)
+
+    conn = sqlite3.connect(pair_db.database_path)
+    conn.executemany(
+        "INSERT INTO ersa (ID1, ID2, estimated_relatedness) VALUES (?, ?, ?)",
+        [("B", "C", 2), ("A", "F", 6), ("F", "G", 1)],
+    )
+    conn.commit()
+
+    # only the new rows are queried and appended to the output
+    assert refresh() == (2 if all_connections else 1, True)
+    assert _read_output(output_path, output_format) == expected()
+
+    # pairs left by a refresh that didn't finish are removed before appending
+    with open(output_path, "ab") as output:
+        output.write(b"partial")
+
+    assert refresh() == (0, True)
+    assert _read_output(output_path, output_format) == expected()
+
+    # the results are written again if the table was rebuilt
+    conn.execute("UPDATE ersa SET estimated_relatedness = 9 WHERE ID = 8")
+    conn.commit()
+    conn.close()
+
+    assert refresh()[1] is False
+    assert _read_output(output_path, output_format) == expected()
+
+
+@pytest.mark.parametrize("all_connections", [False, True])
+def test_query_only_has_a_where_clause_with_filters(pair_db, all_connections):
+    logger = logging.getLogger(__name__)
+
+    query, parameters = construct_query_str(pair_db, all_connections, logger)
+
+    # with all_connections the second half of the union always has a filter
+    assert query.count("WHERE") == (1 if all_connections else 0)
+    assert parameters == []
+
+    query, parameters = construct_query_str(
+        pair_db, all_connections, logger, relatedness_threshold=3
+    )
+
+    assert "WHERE pairs.estimated_relatedness <= ?" in query
+    assert parameters == [3] * (2 if all_connections else 1)
+
+
+def test_incremental_query_reads_new_rows(pair_db):
+    logger = logging.getLogger(__name__)
+    query, parameters = construct_query_str(
+        pair_db, False, logger, min_row_id=3, max_row_id=5
+    )
+
+    conn = get_connection(pair_db.database_path, logger=logger)
+    load_query_ids(conn, ["A", "B", "C", "D", "E"], logger)
+
+    plan = " ".join(
+        row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", parameters)
+    )
+
+    assert "SEARCH pairs USING INTEGER PRIMARY KEY (rowid>? AND rowid<?)" in plan
+    assert sorted(conn.execute(query, parameters).fetchall()) == [
+        ("C", "A", 4),
+        ("D", "E", 5),
+    ]
+    conn.close()
+
+
+@pytest.mark.parametrize("all_connections", [False, True])
+def test_incremental_query_workers_split_the_new_rows(pair_db, all_connections):
+    logger = logging.getLogger(__name__)
+
+    assert database_methods.split_row_range(1, 5, 3) == [(1, 3), (3, 5)]
+    assert database_methods.split_row_range(5, 5, 3) == []
+
+    results = {
+        workers: get_relatedness(
+            ["A", "B", "C"],
+            pair_db,
+            logger=logger,
+            all_connections=all_connections,
+            workers=workers,
+            min_row_id=1,
+            max_row_id=5,
+        )
+        for workers in [1, 2]
+    }
+
+    assert _pairs(results[2]) == _pairs(results[1])
+    assert ("A", "B", 1) not in _pairs(results[2])
+
+
+FEDERATED_PAIRS = [
+    ("B", "A", 2),
+    ("C", "D", 6),
+    ("E", "D", None),
+    ("D", "B", 1),
+    ("B", "C", 4),
+]
+
+
+@pytest.mark.parametrize(
+    "resolution, expected_pairs",
+    [
+        (ConflictResolution.ALL, PAIRS + FEDERATED_PAIRS),
+        (ConflictResolution.FIRST, PAIRS + [("C", "D", 6), ("B", "C", 4)]),
+        (
+            ConflictResolution.CLOSEST,
+            [pair for pair in PAIRS if pair != ("B", "D", 2)]
+            + [("C", "D", 6), ("D", "B", 1), ("B", "C", 4)],
+        ),
+    ],
+)
+def test_federated_relatedness(pair_db, tmp_path, resolution, expected_pairs):
+    logger = logging.getLogger(__name__)
+    ids = ["A", "B", "C", "D", "E"]
+
+    other_path = tmp_path / "other.db"
+    conn = sqlite3.connect(other_path)
+    conn.execute(
+        "CREATE TABLE pairs (ID INTEGER PRIMARY KEY, ID1 TEXT, ID2 TEXT, estimated_relatedness INTEGER)"
+    )
+    conn.executemany(
+        "INSERT INTO pairs (ID1, ID2, estimated_relatedness) VALUES (?, ?, ?)",
+        FEDERATED_PAIRS,
+    )
+    conn.commit()
+    conn.close()
+
+    # the pairs are matched no matter which order the IDs are in and a
+    # missing relatedness is the most distant
+    sources = build_sources([pair_db.database_path, other_path], ["ersa", "pairs"])
+
+    dictionary = IdDictionary()
+    results = list(
+        get_federated_relatedness(
+            ids, sources, logger=logger, resolution=resolution, dictionary=dictionary
+        )
+    )
+
+    assert _pairs(results) == sorted(expected_pairs)
+    # the batches from every database are converted to the same dictionary
+    assert all(batch.dictionary is dictionary for batch in results)
+
+    cases, controls = ["A", "B", "C"], ["D", "E"]
+    counts = get_federated_classified_relatedness_counts(
+        cases, controls, sources, logger=logger, resolution=resolution
+    )
+    expected_counts = {name: {} for name in counts}
+    statuses = {grid: grid in cases for grid in ids}
+
+    for id1, id2, relatedness in expected_pairs:
+        name = ("control_control", "case_control", "case_case")[
+            statuses[id1] + statuses[id2]
+        ]
+        expected_counts[name][relatedness] = (
+            expected_counts[name].get(relatedness, 0) + 1
+        )
+
+    assert counts == {
+        name: dict(
+            sorted(class_counts.items(), key=lambda item: (item[0] is None, item[0]))
+        )
+        for name, class_counts in expected_counts.items()
+    }
+
+    with pytest.raises(ValueError):
+        build_sources([pair_db.database_path] * 3, ["ersa", "pairs"])
+
+
+def _batches(closed, fail_after=None):
+    try:
+        for index in range(20):
+            if index == fail_after:
+                raise RuntimeError("query failed")
+            yield PairResults.from_rows([(f"A{index}", f"B{index}", index % 9)])
+    finally:
+        closed.set()
+
+
+def test_pipeline_results():
+    closed = threading.Event()
+
+    pipelined = list(pipeline_results(_batches(closed), queue_size=2, batch_size=3))
+
+    assert [len(batch) for batch in pipelined] == [3] * 6 + [2]
+    assert _pairs(pipelined) == _pairs(_batches(threading.Event()))
+    assert closed.is_set()
+
+    # errors in the reader thread are raised in the writer
+    with pytest.raises(RuntimeError, match="query failed"):
+        list(pipeline_results(_batches(threading.Event(), fail_after=5), batch_size=1))
+
+    # stopping the writer early stops the reader and closes the query
+    closed = threading.Event()
+    pipelined = pipeline_results(_batches(closed), queue_size=1, batch_size=1)
+    next(pipelined)
+    pipelined.close()
+
+    assert closed.is_set()
+
+
+def test_merge_sources_is_bounded(monkeypatch):
+    logger = logging.getLogger(__name__)
+    monkeypatch.setattr(federation, "SOURCE_QUEUE_SIZE", 1)
+
+    closed = [threading.Event(), threading.Event()]
+    merged = federation.merge_sources(
+        [_batches(event) for event in closed], logger, ConflictResolution.ALL
+    )
+    next(merged)
+
+    # the databases wait on the full queue instead of reading every batch
+    # and they are closed once the consumer stops early
+    assert not all(event.is_set() for event in closed)
+
+    merged.close()
+
+    assert all(event.is_set() for event in closed)
+
+
+def test_merge_first_reads_later_sources_ahead_by_the_queue_size(monkeypatch):
+    logger = logging.getLogger(__name__)
+    monkeypatch.setattr(federation, "SOURCE_QUEUE_SIZE", 1)
+
+    read = [0, 0]
+
+    def counted_batches(source_index):
+        for batch in _batches(threading.Event()):
+            read[source_index] += 1
+            yield batch
+
+    merged = federation.merge_sources(
+        [counted_batches(0), counted_batches(1)], logger, ConflictResolution.FIRST
+    )
+    first = [next(merged) for _ in range(10)]
+
+    # the second database waits on its own queue instead of being drained
+    # into memory while the first database is still being returned
+    assert _pairs(first) == _pairs(list(_batches(threading.Event()))[:10])
+    assert read[1] <= 2
+
+    # every pair from the second database is already in the first
+    assert _pairs(first + list(merged)) == _pairs(_batches(threading.Event()))
+
+
+def _unsorted_batches(seed):
+    rng = random.Random(seed)
+    ids = [f"ID{index}" for index in range(40)]
+
+    # each batch has its own dictionary and the pairs are repeated in both
+    # orders with different relatedness values
+    for _ in range(30):
+        yield PairResults.from_rows(
+            [
+                (*rng.sample(ids, 2), rng.choice([1, 2, 3, None]))
+                for _ in range(rng.randint(0, 50))
+            ]
+        )
+
+
+@pytest.mark.parametrize("memory_limit", [1 << 20, 1])
+def test_sort_pairs(tmp_path, monkeypatch, memory_limit):
+    logger = logging.getLogger(__name__)
+
+    # a tiny memory limit spills every few batches and merges the runs in
+    # several passes
+    monkeypatch.setattr(pair_sort, "MIN_MERGE_BLOCK", 16)
+    monkeypatch.setattr(pair_sort, "MERGE_FAN_IN", 3)
+
+    expected = {}
+
+    for id1, id2, relatedness in (
+        pair for batch in _unsorted_batches(0) for pair in batch
+    ):
+        pair = tuple(sorted([id1, id2]))
+        closest = expected.get(pair, relatedness)
+
+        expected[pair] = min(
+            [closest, relatedness], key=lambda value: 255 if value is None else value
+        )
+
+    sorted_batches = sort_pairs(
+        _unsorted_batches(0),
+        logger=logger,
+        memory_limit=memory_limit,
+        spill_dir=tmp_path,
+    )
+
+    assert [pair for batch in sorted_batches for pair in batch] == [
+        (*pair, relatedness) for pair, relatedness in sorted(expected.items())
+    ]
+    assert not list(tmp_path.iterdir())
+
+    no_batches = (batch for batch in [])
+
+    assert list(sort_pairs(no_batches, logger=logger, memory_limit=memory_limit)) == []
+
+
+def test_metrics_report(tmp_path):
+    metrics = Metrics("test")
+
+    with metrics.stage("write") as stage_metrics:
+        batches = metrics.measure_batches("query", _batches(threading.Event()))
+        stage_metrics.add(rows=sum(len(batch) for batch in batches))
+
+    report = metrics.write(tmp_path / "metrics.json").read_text()
+    stages = json.loads(report)["stages"]
+
+    assert stages["query"]["counters"] == {"rows": 20, "batches": 20}
+    assert stages["query"]["calls"] == 21
+    assert stages["query"]["seconds_to_first_batch"] is not None
+    assert stages["write"]["counters"] == {"rows": 20}
+    # the time spent fetching the batches is not counted as writing time
+    assert stages["write"]["wall_seconds"] < metrics.report()["wall_seconds"]
+    assert "rows_per_second" in stages["write"]
+
+
+def _cli_import_times(*args):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(CLI_PATH), *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    import_times = {}
+
+    # each line is "import time: self | cumulative | name" where the name is
+    # indented by the depth of the import
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+
+        import_times[name.strip()] = (
+            int(cumulative),
+            len(name) - len(name.lstrip()) == 1,
+        )
+
+    return import_times
+
+
+@pytest.mark.parametrize("args", [["--help"], ["determine-relatedness", "--help"]])
+def test_cli_import_time_budget(args):
+    # the fastest of a few runs is used so that a busy machine doesn't fail
+    # the test. Every run starts a new interpreter so each one is a cold start
+    runs = [_cli_import_times(*args) for _ in range(3)]
+
+    startup_seconds = (
+        min(
+            sum(cumulative for cumulative, top_level in run.values() if top_level)
+            for run in runs
+        )
+        / 1e6
+    )
+
+    assert not [module for module in DEFERRED_MODULES if module in runs[0]]
+    assert startup_seconds < IMPORT_TIME_BUDGET